@@ -6,23 +6,116 @@ from nmigen_soc import wishbone
 from nmigen_soc.memory import MemoryMap
 from nmigen_boards.ulx3s import *
 from nmigen.build.dsl import *
+from nmigen.lib.cdc import FFSynchronizer, ResetSynchronizer, PulseSynchronizer
+from nmigen.lib.fifo import AsyncFIFO
 from ao68000.nmigen import ao68000soc
 from wb_to_68k import WishboneTo68000
-from m68krom import M68KROM, M68KRAM
+from wb_cdc import WishboneCDC
+from perf_csr import PerfCSR
+from intc import InterruptController
+from dma import BlitEngine
+from prefetch import Prefetcher
+from profiler import PCProfiler
+from ecp5_pll import ECP5PLL
+from wb_cache import WishboneCache
+from wb_decoder import LocalDecoder
+from sdram import SDRAMController
+from m68krom import M68KROM, M68KRAM, ShadowROM
+from regions import x68000_regions
 
+# the ao68000 and everything around it on the fpga, bridged to the host
+# 68000 bus. the cpu side runs from a pll at cpu_freq, the bus side from the
+# host bus clock, with a wishbone cdc in between.
 class System(Elaboratable):
-    def __init__(self):
+    def __init__(self, local_ram=(0x200000, 0xa00000), write_through=[],
+                 shadow_rom=True, rom_image=None, rom_offset=0, cpu_freq=50e6,
+                 bus_freq=10e6, perf_base=0xecf000, perf_leds=None,
+                 local_iack={7: None}, vpa_pin=None, bus_release="cycle", prefetch=True,
+                 regions=None, profiler=True, uart_baud=1000000, dma_base=0xecf100,
+                 dma_irq_level=4, dma_irq_vector=None, cache_host_ram=False):
+        self.cpu_freq = cpu_freq # check it against the nextpnr timing report
+        self.bus_freq = bus_freq
+        self.perf_leds = perf_leds
+        self.vpa_pin = vpa_pin
+        # local_ram is served from the sdram, shadow_rom keeps the ipl rom in
+        # block ram, see x68000_regions
+        if regions is None:
+            regions = x68000_regions(local_ram, shadow_rom, cache_host_ram)
+        self.regions = regions
         self.ao68000soc = ao68000soc()
-        self.wb_to_68k = WishboneTo68000(self.ao68000soc.bus, self.ao68000soc.fc, self.ao68000soc.ipl)
+        bus = self.ao68000soc.bus
+        fc = self.ao68000soc.fc
+        self.shadow = None
+        bram = regions.ranges(lambda r: r.target == "bram")
+        if len(bram) > 1:
+            raise ValueError("the shadow rom takes one window, not {}".format(len(bram)))
+        if bram:
+            # copied from the host after reset, or loaded from rom_image
+            (start, end), = bram
+            self.shadow = ShadowROM(bus, fc, start, (end - start - 1).bit_length(), rom_image, rom_offset)
+            bus = self.shadow.bus
+            fc = self.shadow.fc
+        # local_iack levels are acknowledged on the fpga
+        self.intc = InterruptController(bus, fc, local_iack, irq_level=dma_irq_level,
+                                        irq_vector=dma_irq_vector)
+        bus = self.intc.bus
+        fc = self.intc.fc
+        self.dma = None
+        if dma_base is not None:
+            # ahead of the cache so it sees the writes
+            self.dma = BlitEngine(bus, fc)
+            bus = self.dma.bus
+            fc = self.dma.fc
+        self.fc = fc
+        self.cache = WishboneCache(bus, fc, index_width=12, ways=2, regions=regions)
+        self.decoder = LocalDecoder(self.cache.bus, regions)
+        self.sdram = SDRAMController(clk_freq=cpu_freq)
+        # writes to the write_through ranges also go to the host
+        self.decoder.add_target(self.sdram.bus, "sdram", write_through)
+        if self.dma is not None:
+            self.decoder.add_local(self.dma.csr, dma_base, 0x100)
+        ext_bus = self.decoder.ext_bus
+        ext_fc = self.fc
+        self.prefetch = None
+        if prefetch:
+            self.prefetch = Prefetcher(ext_bus, ext_fc, regions=regions)
+            ext_bus = self.prefetch.bus
+            ext_fc = self.prefetch.fc
+        self.cdc = WishboneCDC(ext_bus, ext_fc, o_domain="bus", regions=regions)
+        # ipl goes to the cpu through the interrupt controller
+        # dtack and vpa come through synchronizers, see elaborate. without
+        # vpa_pin an iack that gets no dtack is autovectored
+        self.wb_to_68k = WishboneTo68000(self.cdc.bus, self.cdc.fc, Signal(3), release=bus_release,
+                                         regions=regions, dtack_sync=True,
+                                         iack_timeout=None if vpa_pin is not None else 16)
+        self.perf = None
+        if perf_base is not None:
+            extra = [self.intc]
+            if self.prefetch is not None:
+                extra.append(self.prefetch)
+            if self.dma is not None:
+                extra.append(self.dma)
+            self.perf = PerfCSR(self.wb_to_68k, o_domain="bus", extra=extra)
+            self.decoder.add_local(self.perf.bus, perf_base, 0x100)
+        self.profiler = None
+        if profiler:
+            # taps the cpu bus, ahead of everything that changes its timing
+            self.profiler = PCProfiler(self.ao68000soc.bus, self.ao68000soc.fc,
+                                       int(round(cpu_freq / uart_baud)))
         pass
 
     def elaborate(self, platform):
         m = Module()
         m.domains.sync = ClockDomain()
+        m.domains.bus = ClockDomain()
         clk25 = platform.request("clk25")
-        m.d.comb += ClockSignal().eq(clk25.i)
+        # the sdram is clocked half a cycle late, see SDRAMController
+        m.submodules.pll = pll = ECP5PLL(clk25.i, 25e6, self.cpu_freq, shifted_phase=180)
+        m.d.comb += ClockSignal().eq(pll.clk_out)
         #hack for ao68000 to start up correctly
-        m.d.comb += ResetSignal().eq(platform.request("button_fire",0))
+        reset = Signal()
+        m.d.comb += reset.eq(platform.request("button_fire",0) | ~pll.locked)
+        m.d.comb += ResetSignal().eq(reset)
 
         platform.add_resources([
             Resource("addr", 0, Pins("24+ 25- 25+ 26- 26+ 27- 27+ 0- 0+ 1- 1+ 2- 2+ 3- 3+ 5+ 6- 6+ 7- 7+ 8- 8+ 9-", dir="io", conn=("gpio", 0))),
@@ -48,21 +141,90 @@ class System(Elaboratable):
             Resource("rw_", 0, Pins("14+", dir="io", conn=("gpio", 0))),
             Resource("lds_", 0, Pins("14-", dir="io", conn=("gpio", 0)))
         ])
+        if self.vpa_pin is not None:
+            platform.add_resources([
+                Resource("vpa", 0, Pins(self.vpa_pin, dir="i", conn=("gpio", 0))),
+            ])
 
         timer  = Signal(24)
         m.d.sync += timer.eq(timer + 1)
 
         m.submodules.ao68000soc = self.ao68000soc
+        if self.shadow is not None:
+            m.submodules.shadow = self.shadow
+        m.submodules.intc = self.intc
+        if self.dma is not None:
+            m.submodules.dma = self.dma
+            m.d.comb += self.intc.irq.eq(self.dma.irq)
+        if self.profiler is not None:
+            m.submodules.profiler = self.profiler
+            uart = platform.request("uart", 0)
+            m.d.comb += uart.tx.o.eq(self.profiler.tx)
+            m.d.comb += self.profiler.rx.eq(uart.rx.i)
 
-        m.d.comb += self.wb_to_68k.dtack_.eq(0)
-        m.submodules.wb_to_68k = self.wb_to_68k
+        m.submodules.cache = self.cache
+        # host writes made while the bus is granted drop the cached lines,
+        # everything is flushed if too many come in at once
+        m.submodules.snoop_fifo = snoop_fifo = AsyncFIFO(width=22, depth=8, r_domain="sync", w_domain="bus")
+        m.submodules.snoop_overflow = snoop_overflow = PulseSynchronizer("bus", "sync")
+        m.d.comb += [
+            snoop_fifo.w_data.eq(self.wb_to_68k.snoop_adr),
+            snoop_fifo.w_en.eq(self.wb_to_68k.snoop),
+            snoop_overflow.i.eq(self.wb_to_68k.snoop & ~snoop_fifo.w_rdy),
+            self.cache.snoop_adr.eq(snoop_fifo.r_data),
+            self.cache.snoop_valid.eq(snoop_fifo.r_rdy),
+            snoop_fifo.r_en.eq(self.cache.snoop_ready),
+            self.cache.flush.eq(platform.request("button_fire", 1) | snoop_overflow.o),
+        ]
+        m.submodules.decoder = self.decoder
+        if self.prefetch is not None:
+            m.submodules.prefetch = self.prefetch
+            m.submodules.prefetch_invalidate = FFSynchronizer(self.wb_to_68k.granted, self.prefetch.invalidate)
+        m.submodules.cdc = self.cdc
+        if self.perf is not None:
+            m.submodules.perf = self.perf
+
+        m.submodules.sdram = self.sdram
+        sdram = platform.request("sdram", 0)
+        m.d.comb += [
+            sdram.clk.o.eq(pll.clk_shifted),
+            sdram.clk_en.o.eq(self.sdram.clk_en),
+            sdram.cs.o.eq(self.sdram.cs),
+            sdram.ras.o.eq(self.sdram.ras),
+            sdram.cas.o.eq(self.sdram.cas),
+            sdram.we.o.eq(self.sdram.we),
+            sdram.a.o.eq(self.sdram.a),
+            sdram.ba.o.eq(self.sdram.ba),
+            sdram.dqm.o.eq(self.sdram.dqm),
+            sdram.dq.o.eq(self.sdram.dq_o),
+            sdram.dq.oe.eq(self.sdram.dq_oe),
+            self.sdram.dq_i.eq(sdram.dq.i),
+        ]
+
+        # the bridge runs on the host 68000 clock
+        bus_clk = platform.request("clk", 0)
+        platform.add_clock_constraint(bus_clk.i, self.bus_freq)
+        m.d.comb += ClockSignal("bus").eq(bus_clk.i)
+        m.submodules.bus_reset = ResetSynchronizer(reset, domain="bus")
+        m.submodules.wb_to_68k = DomainRenamer("bus")(self.wb_to_68k)
+        m.submodules.dtack_sync = FFSynchronizer(platform.request("dtack", 0).i, self.wb_to_68k.dtack_, o_domain="bus", reset=1)
+        m.submodules.br_sync = FFSynchronizer(platform.request("br", 0).i, self.wb_to_68k.br_, o_domain="bus", reset=1)
+        m.submodules.bgack_sync = FFSynchronizer(platform.request("bgack", 0).i, self.wb_to_68k.bgack_, o_domain="bus", reset=1)
+        if self.vpa_pin is not None:
+            m.submodules.vpa_sync = FFSynchronizer(platform.request("vpa", 0).i, self.wb_to_68k.vpa_, o_domain="bus", reset=1)
+        m.d.comb += self.intc.ipl_.eq(platform.request("ipl", 0).i)
+        m.d.comb += self.ao68000soc.ipl.eq(self.intc.ipl)
 
         plat_data = platform.request("data", 0)
         data_dir = platform.request("data_dir")
 
         leds = [platform.request("led", i) for i in range(0,8)]
         for i in range(0, 8):
-            m.d.comb += leds[i].eq(self.ao68000soc.bus.adr[i+15])
+            if self.perf_leds is not None:
+                # a few blinks a second when counting every bus clock
+                m.d.comb += leds[i].eq(self.wb_to_68k.perf_live[self.perf_leds][i+20])
+            else:
+                m.d.comb += leds[i].eq(self.ao68000soc.bus.adr[i+15])
 
         bus_assert = self.wb_to_68k.bus_assert
 
@@ -88,7 +250,7 @@ class System(Elaboratable):
         rw_ = platform.request("rw_")
         m.d.comb += addr.o.eq(self.wb_to_68k.addr)
         m.d.comb += addr.oe.eq(bus_assert)
-        m.d.comb += fc.o.eq(self.ao68000soc.fc)
+        m.d.comb += fc.o.eq(self.wb_to_68k.fc)
         m.d.comb += fc.oe.eq(bus_assert)
         m.d.comb += as_.o.eq(self.wb_to_68k.as_)
         m.d.comb += as_.oe.eq(bus_assert)
@@ -98,6 +260,9 @@ class System(Elaboratable):
         m.d.comb += lds_.oe.eq(bus_assert)
         m.d.comb += rw_.o.eq(self.wb_to_68k.rw_)
         m.d.comb += rw_.oe.eq(bus_assert)
+        m.d.comb += self.wb_to_68k.i_addr.eq(addr.i)
+        m.d.comb += self.wb_to_68k.i_rw_.eq(rw_.i)
+        m.submodules.as_sync = FFSynchronizer(as_.i, self.wb_to_68k.i_as_, o_domain="bus", reset=1)
 
         # temporary hack for led counter
         #m.d.comb += self.wb_to_68k.i_data.eq(0)
@@ -1,30 +1,302 @@
 #!/usr/bin/python3
 
+import argparse
+import unittest
 from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.sim import *
 from nmigen_boards.tinyfpga_bx import *
 from nmigen.build.dsl import *
-from m68krom import M68KROM
+from nmigen_soc import wishbone
+from m68krom import M68KRAM
+from wb_to_68k import WishboneTo68000
 
+# stands in for the x68000 on the other end of the bridge. answers 68000
+# bus cycles like a memory, from an M68KRAM of 2**addr_width words aliased
+# over the whole address space and loaded from filename if given.
+# dtack comes wait clocks after the strobes, plus a random number ANDed with
+# wait_random, so 2**n-1 gives 0 to 2**n-1 more. it is also gated with the as
+# pin directly and so negates as soon as as does, like the decode on a real
+# board.
+# every br_period clocks br is asserted, bg is waited for and the bus is held
+# for br_hold clocks. every irq_period clocks ipl is driven to irq_level for
+# irq_hold clocks. a period of 0 turns them off.
+# the bus clock is clk_div clocks, at least 4 so a negated as is always seen.
+# cycles counts completed bus cycles, cycles_per_second is latched from it
+# every clk_freq clocks. with counters it also reads back from the top two
+# words, high half first, so the bridge side can measure its throughput.
+class BusExerciser(Elaboratable):
+    def __init__(self, addr_width=4, filename=None, file_offset=0, wait=0, wait_random=0,
+                 br_period=0, br_hold=16, irq_period=0, irq_level=7, irq_hold=16,
+                 clk_freq=16e6, clk_div=4, counters=True):
+        assert clk_div >= 4 and clk_div % 2 == 0
+        self.addr_width = addr_width
+        self.wait = wait
+        self.wait_random = wait_random
+        self.br_period = br_period
+        self.br_hold = br_hold
+        self.irq_period = irq_period
+        self.irq_level = irq_level
+        self.irq_hold = irq_hold
+        self.clk_freq = clk_freq
+        self.clk_div = clk_div
+        self.counters = counters
+        self.ram = M68KRAM(addr_width, filename, file_offset)
+        self.addr = Signal(addr_width)
+        self.i_data = Signal(16)
+        self.o_data = Signal(16)
+        self.data_oe = Signal()
+        self.as_ = Signal(reset = 1)
+        self.uds_ = Signal(reset = 1)
+        self.lds_ = Signal(reset = 1)
+        self.rw_ = Signal(reset = 1)
+        self.dtack_ = Signal(reset = 1)
+        self.br_ = Signal(reset = 1)
+        self.bg_ = Signal(reset = 1)
+        self.ipl_ = Signal(3, reset = 7)
+        self.bus_clk = Signal()
+        self.cycles = Signal(32)
+        self.cycles_per_second = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.ram = ram = self.ram
+
+        # the strobes and buses come from another clock
+        addr = Signal(self.addr_width)
+        i_data = Signal(16)
+        as_ = Signal(reset = 1)
+        uds_ = Signal(reset = 1)
+        lds_ = Signal(reset = 1)
+        rw_ = Signal(reset = 1)
+        bg_ = Signal(reset = 1)
+        m.submodules.addr_sync = FFSynchronizer(self.addr, addr)
+        m.submodules.data_sync = FFSynchronizer(self.i_data, i_data)
+        m.submodules.as_sync = FFSynchronizer(self.as_, as_, reset=1)
+        m.submodules.uds_sync = FFSynchronizer(self.uds_, uds_, reset=1)
+        m.submodules.lds_sync = FFSynchronizer(self.lds_, lds_, reset=1)
+        m.submodules.rw_sync = FFSynchronizer(self.rw_, rw_, reset=1)
+        m.submodules.bg_sync = FFSynchronizer(self.bg_, bg_, reset=1)
+
+        clk_count = Signal(range(self.clk_div // 2))
+        with m.If(clk_count == self.clk_div // 2 - 1):
+            m.d.sync += clk_count.eq(0)
+            m.d.sync += self.bus_clk.eq(~self.bus_clk)
+        with m.Else():
+            m.d.sync += clk_count.eq(clk_count + 1)
+
+        lfsr = Signal(16, reset = 1)
+        m.d.sync += lfsr.eq(Mux(lfsr[0], (lfsr >> 1) ^ 0xb400, lfsr >> 1))
+
+        # memory cycles
+        strobe = Signal()
+        started = Signal()
+        wait = Signal(range(self.wait + self.wait_random + 1))
+        dtack = Signal()
+        m.d.comb += strobe.eq(~as_ & (~uds_ | ~lds_))
+        m.d.comb += ram.addr.eq(addr)
+        m.d.comb += ram.i_data.eq(i_data)
+        m.d.comb += ram.uds_.eq(uds_)
+        m.d.comb += ram.lds_.eq(lds_)
+        m.d.comb += ram.as_.eq(as_)
+        with m.If(as_):
+            m.d.sync += started.eq(0)
+            m.d.sync += dtack.eq(0)
+            with m.If(dtack):
+                m.d.sync += self.cycles.eq(self.cycles + 1)
+        with m.Elif(strobe & ~started):
+            m.d.sync += started.eq(1)
+            m.d.sync += wait.eq(self.wait + (lfsr & self.wait_random))
+        with m.Elif(started & (wait != 0)):
+            m.d.sync += wait.eq(wait - 1)
+        with m.Elif(started & ~dtack & (~rw_ | ~ram.dtack_)):
+            m.d.sync += dtack.eq(1)
+            # one clock of write enable
+            m.d.comb += ram.rw_.eq(rw_)
+        m.d.comb += self.dtack_.eq(~(dtack & ~self.as_))
+
+        m.d.comb += self.o_data.eq(ram.o_data)
+        if self.counters:
+            with m.If(addr == 2**self.addr_width - 2):
+                m.d.comb += self.o_data.eq(self.cycles_per_second[16:32])
+            with m.Elif(addr == 2**self.addr_width - 1):
+                m.d.comb += self.o_data.eq(self.cycles_per_second[0:16])
+        m.d.comb += self.data_oe.eq(started & rw_ & ~self.as_)
+
+        second = Signal(range(int(self.clk_freq)))
+        last_cycles = Signal(32)
+        with m.If(second == int(self.clk_freq) - 1):
+            m.d.sync += second.eq(0)
+            m.d.sync += self.cycles_per_second.eq(self.cycles - last_cycles)
+            m.d.sync += last_cycles.eq(self.cycles)
+        with m.Else():
+            m.d.sync += second.eq(second + 1)
+
+        # bus requests
+        if self.br_period:
+            br_timer = Signal(range(max(self.br_period, self.br_hold)))
+            with m.FSM():
+                with m.State("IDLE"):
+                    m.d.sync += br_timer.eq(br_timer + 1)
+                    with m.If(br_timer == self.br_period - 1):
+                        m.d.sync += br_timer.eq(0)
+                        m.next = "REQUEST"
+                with m.State("REQUEST"):
+                    m.d.comb += self.br_.eq(0)
+                    with m.If(~bg_):
+                        m.next = "HOLD"
+                with m.State("HOLD"):
+                    m.d.comb += self.br_.eq(0)
+                    m.d.sync += br_timer.eq(br_timer + 1)
+                    with m.If(br_timer == self.br_hold - 1):
+                        m.d.sync += br_timer.eq(0)
+                        m.next = "IDLE"
+
+        # interrupts
+        if self.irq_period:
+            irq_timer = Signal(range(self.irq_period))
+            m.d.sync += irq_timer.eq(irq_timer + 1)
+            with m.If(irq_timer == self.irq_period - 1):
+                m.d.sync += irq_timer.eq(0)
+            with m.If(irq_timer < self.irq_hold):
+                m.d.comb += self.ipl_.eq(~self.irq_level)
+
+        return m
+
+# on a tinyfpga bx. the pins only go around 4 address lines and no fc, so
+# the ram is 16 words. bgack is not driven, pull it up on the anubis side.
 class System(Elaboratable):
-    def __init__(self):
-        self.rom = M68KROM(4, 'exerciser.bin', 0)
+    def __init__(self, **kwargs):
+        self.exerciser = BusExerciser(4, **kwargs)
         pass
 
     def elaborate(self, platform):
         m = Module()
         platform.add_resources([
              Resource("data", 0, Pins("1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16", dir="io", conn=("gpio", 0))),
-             Resource("addr", 0, Pins("17 18 19 20", dir="i", conn=("gpio", 0)))
+             Resource("addr", 0, Pins("17 18 19 20", dir="i", conn=("gpio", 0))),
+             Resource("as_", 0, Pins("21", dir="i", conn=("gpio", 0))),
+             Resource("uds_", 0, Pins("22", dir="i", conn=("gpio", 0))),
+             Resource("lds_", 0, Pins("23", dir="i", conn=("gpio", 0))),
+             Resource("rw_", 0, Pins("24", dir="i", conn=("gpio", 0))),
+             Resource("dtack", 0, Pins("25", dir="o", conn=("gpio", 0))),
+             Resource("clk", 0, Pins("26", dir="o", conn=("gpio", 0))),
+             Resource("br", 0, Pins("27", dir="o", conn=("gpio", 0))),
+             Resource("bg", 0, Pins("28", dir="i", conn=("gpio", 0))),
+             Resource("ipl", 0, Pins("29 30 31", dir="o", conn=("gpio", 0))),
         ])
+        ex = self.exerciser
+        m.submodules.exerciser = ex
         data_pins = platform.request("data")
-        addr_pins = platform.request("addr")
-        m.d.comb += self.rom.addr.eq(addr_pins)
-        m.d.comb += data_pins.o.eq(self.rom.data)
-        m.d.comb += data_pins.oe.eq(0xffff)
-        m.submodules += self.rom
+        m.d.comb += ex.addr.eq(platform.request("addr").i)
+        m.d.comb += ex.i_data.eq(data_pins.i)
+        m.d.comb += data_pins.o.eq(ex.o_data)
+        m.d.comb += data_pins.oe.eq(Repl(ex.data_oe, 16))
+        m.d.comb += ex.as_.eq(platform.request("as_").i)
+        m.d.comb += ex.uds_.eq(platform.request("uds_").i)
+        m.d.comb += ex.lds_.eq(platform.request("lds_").i)
+        m.d.comb += ex.rw_.eq(platform.request("rw_").i)
+        m.d.comb += platform.request("dtack").o.eq(ex.dtack_)
+        m.d.comb += platform.request("clk").o.eq(ex.bus_clk)
+        m.d.comb += platform.request("br").o.eq(ex.br_)
+        m.d.comb += ex.bg_.eq(platform.request("bg").i)
+        m.d.comb += platform.request("ipl").o.eq(ex.ipl_)
+        # blinks with the bus cycles
+        m.d.comb += platform.request("led").eq(ex.cycles[20])
         return m
 
+class Test(unittest.TestCase):
+    def test_bridge(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        # the bridge settings of anubis.System
+        bridge = WishboneTo68000(wb, wb_fc, Signal(3), dtack_sync=True)
+        ex = BusExerciser(4, wait=1, wait_random=3, br_period=150, br_hold=10,
+                          irq_period=200, irq_level=7, irq_hold=8, clk_freq=2000)
+        m = Module()
+        m.domains.bus = ClockDomain()
+        m.submodules.bridge = DomainRenamer("bus")(bridge)
+        m.submodules.ex = ex
+        # as in anubis.System
+        m.submodules.dtack_sync = FFSynchronizer(ex.dtack_, bridge.dtack_, o_domain="bus", reset=1)
+        m.submodules.br_sync = FFSynchronizer(ex.br_, bridge.br_, o_domain="bus", reset=1)
+        m.d.comb += [
+            ClockSignal("bus").eq(ex.bus_clk),
+            ex.addr.eq(bridge.addr),
+            ex.i_data.eq(bridge.o_data),
+            bridge.i_data.eq(ex.o_data),
+            ex.as_.eq(bridge.as_),
+            ex.uds_.eq(bridge.uds_),
+            ex.lds_.eq(bridge.lds_),
+            ex.rw_.eq(bridge.rw_),
+            ex.bg_.eq(bridge.bg_),
+        ]
+        seen = {"grants": 0, "ipl": set()}
+
+        def watch():
+            yield Passive()
+            bg_ = 1
+            while True:
+                yield Tick()
+                if bg_ and not (yield bridge.bg_):
+                    seen["grants"] += 1
+                bg_ = yield bridge.bg_
+                seen["ipl"].add((yield ex.ipl_))
+
+        def access(adr, we=0, dat_w=0):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.dat_w.eq(dat_w)
+            yield wb.sel.eq(0xf)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            while (yield wb.ack) == 0:
+                yield Tick("bus")
+                yield Delay(1e-9)
+            dat_r = yield wb.dat_r
+            yield Tick("bus")
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            yield Tick("bus")
+            return dat_r
+
+        def sim_test():
+            for i in range(3):
+                yield from access(0x10 + i, we=1, dat_w=0x12345678 * (i + 1) & 0xffffffff)
+            for i in range(100):
+                self.assertEqual((yield from access(0x10 + i % 3)), 0x12345678 * (i % 3 + 1) & 0xffffffff)
+            # 2 bus cycles a longword
+            self.assertEqual((yield ex.cycles), 2 * 103)
+            # the ram is aliased every 32 bytes
+            self.assertEqual((yield from access(0x31)), 0x12345678 * 2 & 0xffffffff)
+            # the top longword is cycles_per_second, here per 2000 clocks
+            rate = yield from access(0x7)
+            self.assertGreater(rate, 50)
+            self.assertLess(rate, 2000 // 8)
+            self.assertGreater(seen["grants"], 0)
+            self.assertEqual(seen["ipl"], {7, 0})
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(watch, domain="bus")
+        sim.add_sync_process(sim_test, domain="bus")
+        sim.run()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", help="load the ram from this")
+    parser.add_argument("--wait", type=int, default=0, help="dtack wait clocks")
+    parser.add_argument("--wait-random", type=int, default=0, help="mask of random extra wait clocks")
+    parser.add_argument("--br-period", type=int, default=0, help="clocks between bus requests")
+    parser.add_argument("--br-hold", type=int, default=16, help="clocks the bus is held")
+    parser.add_argument("--irq-period", type=int, default=0, help="clocks between interrupts")
+    parser.add_argument("--irq-level", type=int, default=7)
+    parser.add_argument("--irq-hold", type=int, default=16, help="clocks ipl is held")
+    parser.add_argument("--clk-div", type=int, default=4, help="bus clock divider")
+    args = parser.parse_args()
     platform = TinyFPGABXPlatform()
-    sys = System()
+    sys = System(filename=args.image, wait=args.wait, wait_random=args.wait_random,
+                 br_period=args.br_period, br_hold=args.br_hold, irq_period=args.irq_period,
+                 irq_level=args.irq_level, irq_hold=args.irq_hold, clk_div=args.clk_div)
     platform.build(sys, do_program=True)
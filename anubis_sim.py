@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
+import argparse
+import subprocess
 from nmigen import *
-from nmigen.cli import main
+from nmigen.back import rtlil
+from nmigen.cli import main_parser, main_runner
 from nmigen_soc import wishbone
 from nmigen_soc.memory import MemoryMap
 from ao68000.nmigen import ao68000soc
 from wb_to_68k import WishboneTo68000
-from m68krom import M68KROM, M68KRAM
+from wb_decoder import LocalDecoder
+from prefetch import Prefetcher
+from dma import BlitEngine
+from m68krom import M68KROM, M68KRAM, LocalMemory
+from regions import RegionDecoder, x68000_regions
 
 #cd_sync = ClockDomain()
 
@@ -56,17 +63,88 @@ class WishboneROM(Elaboratable):
             m.d.sync += self.bus.ack.eq(0)
         return m
 
+# local_ram is the (base, size) byte window served by the local ram path,
+# the same as the sdram window of the hardware System. in simulation an
+# aliased 32 bit LocalMemory on the decoder stands in for the sdram.
+# local_rom serves the ipl rom from a 32 bit LocalMemory too, like the
+# ShadowROM of the hardware System. local accesses are one longword a clock
+# after the request and never reach the 16 bit bridge.
+# the host side is decoded with the same region map, the ipl rom region is
+# served from rom and the rest from one aliased M68KRAM. dtack comes
+# min_wait clocks after the strobes, and once the memory gives it.
+# registered_rom reads the host ipl rom through a clocked port so it maps to
+# block ram.
+# rom is the ipl rom image, the reset vectors come from offset 0x10000.
+# a longword write to done_addr ends a benchmark run, bench_done goes high
+# and bench_insns holds the value written. the bench_ counters are ports
+# so the simulation driver can report them. bench_host_cycles counts the
+# transactions on the host bridge, prefetches included.
+# the sim_ ports are for the triggers of the cxxrtl runner: sim_addr is the
+# byte address of the last cpu access, sim_access pulses after each one and
+# sim_fetch after program fetches. sim_pc holds the last fetch address.
+# dma_base puts a BlitEngine between the cpu and the decoder as in the
+# hardware System. there is no interrupt controller here, so poll its done
+# bit.
 class System(Elaboratable):
-    def __init__(self):
+    def __init__(self, local_ram=(0x200000, 0xa00000), rom='../x68kd11s/iplrom/iplromxv.dat',
+                 done_addr=0xecfff0, prefetch=True, regions=None, registered_rom=True,
+                 local_rom=True, dma_base=0xecf100):
         #self.bus_decoder = wishbone.Decoder(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
         #self.ao68000wrapper = AO68000Wrapper(bus = self.bus_decoder.bus)
         #self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        if regions is None:
+            regions = x68000_regions(local_ram, shadow_rom=local_rom)
+        self.regions = regions
         self.ao68000soc = ao68000soc()
         self.addr_byte = Signal(24)
-        self.wb_to_68k = WishboneTo68000(self.ao68000soc.bus, self.ao68000soc.fc, self.ao68000soc.ipl)
-        self.boot_rom = M68KROM(0x4, '../x68kd11s/iplrom/iplromxv.dat', 0x10000)
-        self.ipl_rom = M68KROM(17, '../x68kd11s/iplrom/iplromxv.dat', 0x0)
+        self.dma = None
+        cpu_bus = self.ao68000soc.bus
+        cpu_fc = self.ao68000soc.fc
+        if dma_base is not None:
+            self.dma = BlitEngine(cpu_bus, cpu_fc)
+            cpu_bus = self.dma.bus
+            cpu_fc = self.dma.fc
+        self.decoder = LocalDecoder(cpu_bus, regions)
+        if self.dma is not None:
+            self.decoder.add_local(self.dma.csr, dma_base, 0x100)
+        ext_bus = self.decoder.ext_bus
+        ext_fc = cpu_fc
+        self.prefetch = None
+        if prefetch:
+            self.prefetch = Prefetcher(ext_bus, ext_fc, regions=regions)
+            ext_bus = self.prefetch.bus
+            ext_fc = self.prefetch.fc
+        self.wb_to_68k = WishboneTo68000(ext_bus, ext_fc, self.ao68000soc.ipl, regions=regions)
+        self.host = RegionDecoder(regions)
+        self.local_ram = LocalMemory(15)
+        self.decoder.add_target(self.local_ram.bus, "sdram")
+        self.local_rom = None
+        self.ipl_rom = None
+        bram = regions.ranges(lambda r: r.target == "bram")
+        if len(bram) > 1:
+            raise ValueError("the local rom takes one window, not {}".format(len(bram)))
+        if bram:
+            (start, end), = bram
+            self.local_rom = LocalMemory((end - start - 1).bit_length() - 2, rom, 0, writable=False,
+                                         base=start)
+            self.decoder.add_target(self.local_rom.bus, "bram")
+        else:
+            self.ipl_rom = M68KROM(17, rom, 0x0, registered=registered_rom, base=0xfe0000)
+        self.boot_rom = M68KROM(0x4, rom, 0x10000, base=0xff0000)
         self.ram = M68KRAM(16)
+        self.done_addr = done_addr
+        self.bench_done = Signal()
+        self.bench_insns = Signal(32)
+        self.bench_reads = Signal(32)
+        self.bench_writes = Signal(32)
+        self.bench_host_cycles = Signal(32)
+        self.sim_addr = Signal(24)
+        self.sim_access = Signal()
+        self.sim_fetch = Signal()
+        self.sim_pc = Signal(24)
+        self.ports = [self.bench_done, self.bench_insns, self.bench_reads,
+                      self.bench_writes, self.bench_host_cycles,
+                      self.sim_addr, self.sim_access, self.sim_fetch, self.sim_pc]
         pass
 
     def elaborate(self, platform):
@@ -77,29 +155,132 @@ class System(Elaboratable):
         #m.submodules.ao68000wrapper = self.ao68000wrapper
         m.d.comb += self.addr_byte.eq(self.ao68000soc.bus.adr << 2)
         m.d.comb += self.boot_rom.addr.eq(self.wb_to_68k.addr)
-        m.d.comb += self.ipl_rom.addr.eq(self.wb_to_68k.addr - (0xfe0000 >> 1))
+        if self.ipl_rom is not None:
+            m.d.comb += self.ipl_rom.addr.eq(self.wb_to_68k.addr - (0xfe0000 >> 1))
         m.d.comb += self.ram.addr.eq(self.wb_to_68k.addr)
-        m.d.comb += self.wb_to_68k.dtack_.eq(0)
+        for mem in (self.boot_rom, self.ipl_rom, self.ram):
+            if mem is not None:
+                m.d.comb += mem.as_.eq(self.wb_to_68k.as_)
+        host = self.host
+        host_wait = Signal(4)
+        m.d.comb += host.addr.eq(self.wb_to_68k.addr << 1)
+        with m.If(~self.wb_to_68k.uds_ | ~self.wb_to_68k.lds_):
+            with m.If(host_wait != 15):
+                m.d.sync += host_wait.eq(host_wait + 1)
+        with m.Else():
+            m.d.sync += host_wait.eq(0)
+        host_dtack_ = Signal()
+        m.d.comb += self.wb_to_68k.dtack_.eq((host_wait < host.min_wait) | host_dtack_)
+        # the reset vectors are overlaid on the bottom of ram
         with m.If(self.wb_to_68k.addr < 4):
             m.d.comb += self.wb_to_68k.i_data.eq(self.boot_rom.data)
-        with m.Elif(self.wb_to_68k.addr >= (0xfe0000 >> 1)):
-            m.d.comb += self.wb_to_68k.i_data.eq(self.ipl_rom.data)
+            m.d.comb += host_dtack_.eq(self.boot_rom.dtack_)
+        if self.ipl_rom is not None:
+            with m.Elif(host.region == self.regions.index("ipl_rom")):
+                m.d.comb += self.wb_to_68k.i_data.eq(self.ipl_rom.data)
+                m.d.comb += host_dtack_.eq(self.ipl_rom.dtack_)
         with m.Else():
             m.d.comb += self.wb_to_68k.i_data.eq(self.ram.o_data)
+            m.d.comb += host_dtack_.eq(self.ram.dtack_)
         m.d.comb += self.ram.i_data.eq(self.wb_to_68k.o_data)
-        with m.If(self.wb_to_68k.addr < (0x800000 >> 1)):
+        m.d.comb += self.ram.uds_.eq(self.wb_to_68k.uds_)
+        m.d.comb += self.ram.lds_.eq(self.wb_to_68k.lds_)
+        # local_ram may split host main ram in two
+        with m.If(Cat(host.region == i for i, r in enumerate(self.regions)
+                      if r.name == "main_ram").any()):
             m.d.comb += self.ram.rw_.eq(self.wb_to_68k.rw_)
+
+        # benchmark counters: cpu wishbone transactions and bridge beats
+        bus = self.ao68000soc.bus
+        with m.If(bus.cyc & bus.stb & bus.ack & ~self.bench_done):
+            with m.If(bus.we):
+                m.d.sync += self.bench_writes.eq(self.bench_writes + 1)
+                with m.If(bus.adr == self.done_addr >> 2):
+                    m.d.sync += self.bench_done.eq(1)
+                    m.d.sync += self.bench_insns.eq(bus.dat_w)
+            with m.Else():
+                m.d.sync += self.bench_reads.eq(self.bench_reads + 1)
+        with m.If(self.wb_to_68k.wb.ack & ~self.bench_done):
+            m.d.sync += self.bench_host_cycles.eq(self.bench_host_cycles + 1)
+
+        # runner triggers
+        fetch = Signal()
+        m.d.comb += fetch.eq(~bus.we & ((self.ao68000soc.fc == 2) | (self.ao68000soc.fc == 6)))
+        m.d.sync += self.sim_access.eq(bus.cyc & bus.stb & bus.ack)
+        m.d.sync += self.sim_fetch.eq(bus.cyc & bus.stb & bus.ack & fetch)
+        with m.If(bus.cyc & bus.stb & bus.ack):
+            m.d.sync += self.sim_addr.eq(self.addr_byte)
+            with m.If(fetch):
+                m.d.sync += self.sim_pc.eq(self.addr_byte)
+
         m.submodules.ao68000soc = self.ao68000soc
+        if self.dma is not None:
+            m.submodules.dma = self.dma
+        m.submodules.decoder = self.decoder
+        if self.prefetch is not None:
+            m.submodules.prefetch = self.prefetch
         m.submodules.wb_to_68k = self.wb_to_68k
+        m.submodules.host = self.host
+        m.submodules.local_ram = self.local_ram
+        if self.local_rom is not None:
+            m.submodules.local_rom = self.local_rom
         m.submodules.boot_rom = self.boot_rom
-        m.submodules.ipl_rom = self.ipl_rom
+        if self.ipl_rom is not None:
+            m.submodules.ipl_rom = self.ipl_rom
         m.submodules.ram = self.ram
         #m.submodules.bus_decoder = self.bus_decoder
         return m
 
 
 if __name__ == "__main__":
-    sys = System()
+    parser = main_parser()
+    parser.add_argument("--rom", default='../x68kd11s/iplrom/iplromxv.dat',
+                        help="ipl rom image, a benchmark from bench/")
+    parser.add_argument("--no-prefetch", action="store_true",
+                        help="no read ahead of program fetches")
+    parser.add_argument("--host-rom", action="store_true",
+                        help="serve the ipl rom over the host bridge instead of locally")
+    # run builds tb from main.cpp with the Makefile and runs it
+    p_action = next(a for a in parser._actions if isinstance(a, argparse._SubParsersAction))
+    p_run = p_action.add_parser("run", help="build and run the cxxrtl simulation")
+    p_run.add_argument("-c", "--cycles", type=lambda x: int(x, 0), default=1000,
+                       help="stop after COUNT clocks")
+    p_run.add_argument("--until-pc", type=lambda x: int(x, 0),
+                       help="stop at the first program fetch from ADDR")
+    p_run.add_argument("--ignore-done", action="store_true",
+                       help="keep going after the benchmark done marker")
+    p_run.add_argument("--progress", type=lambda x: int(x, 0),
+                       help="print the simulation rate every COUNT clocks")
+    p_run.add_argument("-v", "--vcd", help="trace to VCD, nothing is traced without it")
+    p_run.add_argument("--trace-start", type=lambda x: int(x, 0), help="trace from clock N")
+    p_run.add_argument("--trace-end", type=lambda x: int(x, 0), help="trace up to clock N")
+    p_run.add_argument("--trace-pc", type=lambda x: int(x, 0),
+                       help="trace from the first program fetch from ADDR")
+    p_run.add_argument("--trace-addr", type=lambda x: int(x, 0),
+                       help="trace from the first cpu access to ADDR")
+    p_run.add_argument("--trace-length", type=lambda x: int(x, 0),
+                       help="trace COUNT clocks after the trigger")
+    p_run.add_argument("--ring", type=lambda x: int(x, 0),
+                       help="keep the last COUNT clocks before the trigger, or of the trace")
+    p_run.add_argument("--no-build", action="store_true", help="run tb as it is")
+    args = parser.parse_args()
+    sys = System(rom=args.rom, prefetch=not args.no_prefetch, local_rom=not args.host_rom)
     clk = ClockSignal()
     rst = ResetSignal()
-    main(sys, ports=[clk, rst])
+    # the module main.cpp and tb_iverilog.v instantiate
+    name = "anubis"
+    if args.action == "run":
+        if not args.no_build:
+            with open("top.il", "w") as f:
+                f.write(rtlil.convert(sys, name=name, ports=[clk, rst] + sys.ports))
+            subprocess.run(["make", "-W", "top.il", "tb"], check=True)
+        tb = ["./tb"]
+        for name in ["cycles", "until_pc", "progress", "vcd", "trace_start", "trace_end",
+                     "trace_pc", "trace_addr", "trace_length", "ring"]:
+            value = getattr(args, name)
+            if value is not None:
+                tb += ["--" + name.replace("_", "-"), str(value)]
+        if args.ignore_done:
+            tb.append("--ignore-done")
+        exit(subprocess.run(tb).returncode)
+    main_runner(parser, args, sys, name=name, ports=[clk, rst] + sys.ports)
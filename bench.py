@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# builds each workload in bench/, runs it on the cxxrtl simulation of
+# anubis_sim.System until it writes its completion marker and prints the
+# results as json. needs the m68k binutils, yosys, a c++ compiler and the
+# unicorn python module.
+
+import argparse
+import glob
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROM_BASE = 0xfe0000
+ROM_SIZE = 0x20000
+DONE_ADDR = 0xecfff0
+
+def build_workload(source):
+    base = os.path.splitext(source)[0]
+    subprocess.run(["m68k-linux-gnu-as", "-mcpu=68000", "-I", "bench", source, "-o", base + ".o"], check=True)
+    subprocess.run(["m68k-linux-gnu-ld", "-Ttext=0x%x" % ROM_BASE, base + ".o", "-o", base + ".elf"], check=True)
+    subprocess.run(["m68k-linux-gnu-objcopy", "-O", "binary", "--pad-to=0x%x" % (ROM_BASE + ROM_SIZE),
+                    base + ".elf", base + ".bin"], check=True)
+    return base + ".bin"
+
+# the instruction count a workload writes to DONE_ADDR is counted by hand in
+# its source. check it against the instructions retired up to that write on
+# unicorn's 68000, so an edited workload can't report a stale count.
+def check_insns(rom, max_insns=100000000):
+    from unicorn import Uc, UC_ARCH_M68K, UC_MODE_BIG_ENDIAN, UC_HOOK_CODE, UC_HOOK_MEM_WRITE
+    from unicorn.m68k_const import UC_CPU_M68K_M68000, UC_M68K_REG_A7
+    with open(rom, "rb") as f:
+        image = f.read()
+    uc = Uc(UC_ARCH_M68K, UC_MODE_BIG_ENDIAN)
+    uc.ctl_set_cpu_model(UC_CPU_M68K_M68000)
+    uc.mem_map(0, 1 << 24)
+    uc.mem_write(ROM_BASE, image)
+    # the reset vectors, as the simulation reads them
+    sp, pc = struct.unpack(">II", image[0x10000:0x10008])
+    uc.reg_write(UC_M68K_REG_A7, sp)
+    retired = [0]
+    done = []
+
+    def code(uc, address, size, user_data):
+        retired[0] += 1
+
+    def write(uc, access, address, size, value, user_data):
+        done.append((value & 0xffffffff, retired[0]))
+        uc.emu_stop()
+
+    uc.hook_add(UC_HOOK_CODE, code)
+    uc.hook_add(UC_HOOK_MEM_WRITE, write, begin=DONE_ADDR, end=DONE_ADDR)
+    uc.emu_start(pc, 1 << 32, count=max_insns)
+    if not done:
+        raise RuntimeError("{}: no done marker after {} instructions".format(rom, max_insns))
+    reported, traced = done[0]
+    if reported != traced:
+        raise RuntimeError("{}: reports {} instructions, retires {}".format(rom, reported, traced))
+    return traced
+
+# a run that doesn't reach the done marker is an error, not a result
+def run(rom, max_cycles):
+    result = subprocess.run(["./anubis_sim.py", "--rom", rom, "run", "--cycles", str(max_cycles)],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("{}: simulation exited with {}".format(rom, result.returncode))
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    if not stats["done"]:
+        raise RuntimeError("{}: not done after {} cycles".format(rom, max_cycles))
+    return stats
+
+class Test(unittest.TestCase):
+    def test_check_insns(self):
+        def image(insns):
+            code = struct.pack(">HHHHIIH",
+                               0x7002,          # moveq #2,%d0
+                               0x51c8, 0xfffe,  # dbra %d0,. three times
+                               0x23fc, insns, DONE_ADDR,  # move.l #insns,DONE_ADDR
+                               0x60fe)          # bra .
+            data = bytearray(ROM_SIZE)
+            data[:len(code)] = code
+            data[0x10000:0x10008] = struct.pack(">II", 0x8000, ROM_BASE)
+            f = tempfile.NamedTemporaryFile(suffix=".bin", delete=False)
+            f.write(data)
+            f.close()
+            self.addCleanup(os.remove, f.name)
+            return f.name
+
+        self.assertEqual(check_insns(image(5)), 5)
+        with self.assertRaises(RuntimeError):
+            check_insns(image(4))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workloads", nargs="*", help="bench/*.S by default")
+    parser.add_argument("--max-cycles", type=int, default=10000000)
+    parser.add_argument("-o", "--output", help="write results here as well as to stdout")
+    args = parser.parse_args()
+
+    results = {}
+    for source in args.workloads or sorted(glob.glob("bench/*.S")):
+        name = os.path.splitext(os.path.basename(source))[0]
+        rom = build_workload(source)
+        check_insns(rom)
+        results[name] = run(rom, args.max_cycles)
+        print(name, json.dumps(results[name]), file=sys.stderr)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
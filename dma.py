@@ -0,0 +1,424 @@
+import unittest
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from wb_util import connect_wishbone
+
+
+# block copy and fill engine, a second wishbone master on the cpu bus.
+# it sits between the cpu side and the cache like the other blocks, and
+# shares the bus with the cpu one transaction at a time: when the owner's
+# transaction ends and the other side is waiting, the other side gets the
+# next one, and an idle engine hands the bus straight back to the cpu.
+# locked cpu cycles (tas) are never split. going through the cache
+# keeps it coherent, and the decoder sends each access to the local windows
+# or the host bridge from the address as it does for the cpu.
+# a transfer is rows of count elements of size bytes each, the elements of a
+# row are contiguous and each row starts stride bytes after the last one.
+# every element is read from the source and written to the destination, or
+# with fill the fill pattern is written. only the byte lanes of the element
+# are accessed, so i/o registers can be source or destination. words must
+# be even, longs on a longword boundary, the low address bits are ignored.
+# registers on csr, 32 bits each:
+# 0x00 source, 0x04 destination, byte addresses
+# 0x08 count, elements per row
+# 0x0c rows, 1 after reset
+# 0x10 source stride, 0x14 destination stride, bytes, wrap around for
+#      negative strides
+# 0x18 fill pattern, the low bits of it for bytes and words
+# 0x1c control. bits 0-1 size (0 byte, 1 word, 2 long), bit 2 fill, bit 3
+#      interrupt enable. writing bit 4 starts a transfer, bit 5 clears done
+#      and error, bit 7 stops the transfer after the element in progress.
+#      reads back bit 4 busy, bit 5 done, bit 6 error (the transfer ended on
+#      a bus err or rty).
+# irq is high while done is set with the interrupt enabled. the other
+# registers can't be written while busy.
+class BlitEngine(Elaboratable):
+    def __init__(self, wb, wb_fc, dma_fc=5):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.dma_fc = dma_fc
+        self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.fc = Signal(3)
+        self.csr = wishbone.Interface(addr_width = 6, data_width = 32, granularity = 8)
+        self.irq = Signal()
+        self.busy = Signal()
+        self.perf_snapshot = Signal()
+        self.perf_clear = Signal()
+        names = ["blits", "blit_elements", "blit_busy", "blit_wait", "cpu_blit_wait"]
+        self.perf = [(name, Signal(32, name="perf_" + name)) for name in names]
+        self.perf_live = {name: Signal(32, name="count_" + name) for name in names}
+
+    def elaborate(self, platform):
+        m = Module()
+        master = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+
+        # arbiter
+        owner = Signal() # 0 cpu, 1 dma
+        cpu_request = Signal()
+        dma_request = Signal()
+        done = Signal()
+        m.d.comb += [
+            cpu_request.eq(self.wb.cyc & self.wb.stb),
+            dma_request.eq(master.cyc & master.stb),
+            done.eq(self.bus.ack | self.bus.err | self.bus.rty),
+        ]
+        with m.If(owner == 0):
+            connect_wishbone(m, self.wb, self.bus, self.wb_fc, self.fc)
+            with m.If(dma_request & (~cpu_request | done) & ~self.wb.lock):
+                m.d.sync += owner.eq(1)
+        with m.Else():
+            connect_wishbone(m, master, self.bus, self.dma_fc, self.fc)
+            with m.If(~dma_request | (cpu_request & done)):
+                m.d.sync += owner.eq(0)
+
+        # registers
+        src = Signal(24)
+        dst = Signal(24)
+        count = Signal(16)
+        rows = Signal(16, reset = 1)
+        src_stride = Signal(24)
+        dst_stride = Signal(24)
+        fill_data = Signal(32)
+        size = Signal(2)
+        fill = Signal()
+        irq_enable = Signal()
+        complete = Signal()
+        error = Signal()
+        start = Signal()
+        stop = Signal()
+        regs = [src, dst, count, rows, src_stride, dst_stride, fill_data,
+                Cat(size, fill, irq_enable, self.busy, complete, error)]
+
+        ack = Signal()
+        write = Signal()
+        m.d.sync += ack.eq(self.csr.cyc & self.csr.stb & ~ack)
+        m.d.comb += self.csr.ack.eq(ack)
+        m.d.comb += write.eq(self.csr.cyc & self.csr.stb & self.csr.we & ~ack)
+        with m.Switch(self.csr.adr):
+            for i, reg in enumerate(regs):
+                with m.Case(i):
+                    m.d.comb += self.csr.dat_r.eq(reg)
+                    if i == len(regs) - 1:
+                        with m.If(write & self.csr.sel[0]):
+                            with m.If(~self.busy):
+                                m.d.sync += Cat(size, fill, irq_enable).eq(self.csr.dat_w)
+                                m.d.comb += start.eq(self.csr.dat_w[4])
+                            with m.If(self.csr.dat_w[5]):
+                                m.d.sync += [complete.eq(0), error.eq(0)]
+                            m.d.comb += stop.eq(self.csr.dat_w[7])
+                    else:
+                        with m.If(write & ~self.busy):
+                            for b in range((len(reg) + 7) // 8):
+                                with m.If(self.csr.sel[b]):
+                                    m.d.sync += reg[b*8:b*8+8].eq(self.csr.dat_w[b*8:b*8+8])
+        m.d.comb += self.irq.eq(complete & irq_enable)
+
+        # transfer
+        src_row = Signal(24)
+        dst_row = Signal(24)
+        src_adr = Signal(24)
+        dst_adr = Signal(24)
+        left = Signal(16)
+        rows_left = Signal(16)
+        data = Signal(32)
+        stopping = Signal()
+        element = Signal()
+
+        def lanes(adr):
+            return Mux(size == 0, Const(0b1000, 4) >> adr[0:2],
+                   Mux(size == 1, Mux(adr[1], 0b0011, 0b1100), 0b1111))
+
+        step = Signal(3)
+        m.d.comb += step.eq(Mux(size == 0, 1, Mux(size == 1, 2, 4)))
+        read_data = Signal(32)
+        m.d.comb += read_data.eq(Mux(size == 0, master.dat_r.word_select(~src_adr[0:2], 8),
+                                 Mux(size == 1, master.dat_r.word_select(~src_adr[1], 16),
+                                     master.dat_r)))
+
+        with m.If(stop & self.busy):
+            m.d.sync += stopping.eq(1)
+
+        # the control bits written with start are in place a clock later
+        go = Signal()
+        m.d.sync += go.eq(start)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                m.d.comb += self.busy.eq(go)
+                m.d.sync += stopping.eq(0)
+                with m.If(go):
+                    m.d.sync += [
+                        complete.eq(0),
+                        error.eq(0),
+                        src_row.eq(src),
+                        dst_row.eq(dst),
+                        src_adr.eq(src),
+                        dst_adr.eq(dst),
+                        left.eq(count),
+                        rows_left.eq(rows),
+                    ]
+                    with m.If((count == 0) | (rows == 0)):
+                        m.d.sync += complete.eq(1)
+                    with m.Elif(fill):
+                        m.d.sync += data.eq(fill_data)
+                        m.next = "WRITE"
+                    with m.Else():
+                        m.next = "READ"
+            with m.State("READ"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    master.adr.eq(src_adr[2:]),
+                    master.sel.eq(lanes(src_adr)),
+                    master.cyc.eq(1),
+                    master.stb.eq(1),
+                ]
+                with m.If(master.ack):
+                    m.d.sync += data.eq(read_data)
+                    m.next = "WRITE"
+                with m.If(master.err | master.rty):
+                    m.d.sync += [complete.eq(1), error.eq(1)]
+                    m.next = "IDLE"
+            with m.State("WRITE"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    master.adr.eq(dst_adr[2:]),
+                    master.sel.eq(lanes(dst_adr)),
+                    master.dat_w.eq(Mux(size == 0, Repl(data[0:8], 4),
+                                    Mux(size == 1, Repl(data[0:16], 2), data))),
+                    master.we.eq(1),
+                    master.cyc.eq(1),
+                    master.stb.eq(1),
+                ]
+                with m.If(master.ack):
+                    m.d.comb += element.eq(1)
+                    with m.If(left != 1):
+                        m.d.sync += [
+                            src_adr.eq(src_adr + step),
+                            dst_adr.eq(dst_adr + step),
+                            left.eq(left - 1),
+                        ]
+                    with m.Else():
+                        m.d.sync += [
+                            src_row.eq(src_row + src_stride),
+                            dst_row.eq(dst_row + dst_stride),
+                            src_adr.eq(src_row + src_stride),
+                            dst_adr.eq(dst_row + dst_stride),
+                            left.eq(count),
+                            rows_left.eq(rows_left - 1),
+                        ]
+                    with m.If(((left == 1) & (rows_left == 1)) | stopping | stop):
+                        m.d.sync += complete.eq(1)
+                        m.next = "IDLE"
+                    with m.Elif(~fill):
+                        m.next = "READ"
+                with m.If(master.err | master.rty):
+                    m.d.sync += [complete.eq(1), error.eq(1)]
+                    m.next = "IDLE"
+
+        blits = self.perf_live["blits"]
+        elements = self.perf_live["blit_elements"]
+        busy = self.perf_live["blit_busy"]
+        wait = self.perf_live["blit_wait"]
+        cpu_wait = self.perf_live["cpu_blit_wait"]
+        with m.If(self.perf_clear):
+            m.d.sync += [blits.eq(0), elements.eq(0), busy.eq(0), wait.eq(0), cpu_wait.eq(0)]
+        with m.Else():
+            with m.If(go):
+                m.d.sync += blits.eq(blits + 1)
+            with m.If(element):
+                m.d.sync += elements.eq(elements + 1)
+            with m.If(self.busy):
+                m.d.sync += busy.eq(busy + 1)
+            # clocks one side waits for a transaction of the other
+            with m.If(dma_request & (owner == 0)):
+                m.d.sync += wait.eq(wait + 1)
+            with m.If(cpu_request & (owner == 1)):
+                m.d.sync += cpu_wait.eq(cpu_wait + 1)
+        for name, snapshot in self.perf:
+            with m.If(self.perf_snapshot):
+                m.d.sync += snapshot.eq(self.perf_live[name])
+
+        return m
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.wb_fc = Signal(3)
+        self.dut = BlitEngine(self.wb, self.wb_fc)
+        # bytes, big endian like the 68000
+        self.mem = bytearray(range(256)) * 256
+        self.accesses = []
+
+    def run_sim(self, test, latency=2, err_adr=None):
+        dut = self.dut
+
+        # a slave with a few clocks of wait states
+        def slave():
+            yield Passive()
+            waited = 0
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.bus.ack) | (yield dut.bus.err):
+                    yield dut.bus.ack.eq(0)
+                    yield dut.bus.err.eq(0)
+                    waited = 0
+                    continue
+                if not ((yield dut.bus.cyc) & (yield dut.bus.stb)):
+                    continue
+                waited += 1
+                if waited < latency:
+                    continue
+                adr = (yield dut.bus.adr)
+                sel = (yield dut.bus.sel)
+                we = (yield dut.bus.we)
+                self.accesses.append((adr, sel, we, (yield dut.fc)))
+                if adr == err_adr:
+                    yield dut.bus.err.eq(1)
+                    continue
+                if we:
+                    dat = (yield dut.bus.dat_w)
+                    for b in range(4):
+                        if sel & (8 >> b):
+                            self.mem[adr*4 + b] = dat >> (24 - b*8) & 0xff
+                else:
+                    yield dut.bus.dat_r.eq(int.from_bytes(self.mem[adr*4:adr*4 + 4], "big"))
+                yield dut.bus.ack.eq(1)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(slave)
+        sim.add_sync_process(test)
+        sim.run()
+
+    def access(self, bus, adr, we=0, sel=0xf, dat=0, fc=None):
+        yield bus.adr.eq(adr)
+        yield bus.we.eq(we)
+        yield bus.sel.eq(sel)
+        yield bus.dat_w.eq(dat)
+        if fc is not None:
+            yield self.wb_fc.eq(fc)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        yield Delay(1e-9)
+        while (yield bus.ack) == 0 and not (hasattr(bus, "err") and (yield bus.err)):
+            yield Tick()
+            yield Delay(1e-9)
+        dat_r = yield bus.dat_r
+        yield Tick()
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        return dat_r
+
+    def blit(self, src=0, dst=0, count=0, rows=1, src_stride=0, dst_stride=0,
+             fill_data=0, control=0):
+        csr = self.dut.csr
+        for i, value in enumerate([src, dst, count, rows, src_stride, dst_stride, fill_data]):
+            yield from self.access(csr, i, we=1, dat=value)
+        yield from self.access(csr, 7, we=1, dat=control | 0x10)
+        while (yield from self.access(csr, 7)) & 0x10:
+            pass
+        return (yield from self.access(csr, 7))
+
+    def test_copy(self):
+        expected = bytearray(self.mem)
+
+        def sim_test():
+            # bytes to an odd address
+            self.assertEqual((yield from self.blit(src=0x1001, dst=0x2003, count=7, control=0)), 0x20)
+            expected[0x2003:0x200a] = expected[0x1001:0x1008]
+            self.assertEqual(self.mem, expected)
+            # only the lanes of each byte are read and written
+            self.assertEqual(self.accesses[0], (0x1000 >> 2, 0b0100, 0, 5))
+            self.assertEqual(self.accesses[1], (0x2000 >> 2, 0b0001, 1, 5))
+            # words, from the low half of a longword
+            yield from self.blit(src=0x1202, dst=0x3000, count=5, control=1)
+            expected[0x3000:0x300a] = expected[0x1202:0x120c]
+            self.assertEqual(self.mem, expected)
+            # longs, three rows of two with different strides
+            yield from self.blit(src=0x1400, dst=0x4000, count=2, rows=3,
+                                 src_stride=0x10, dst_stride=0x40, control=2)
+            for row in range(3):
+                expected[0x4000 + row*0x40:0x4008 + row*0x40] = expected[0x1400 + row*0x10:0x1408 + row*0x10]
+            self.assertEqual(self.mem, expected)
+            # nothing to do
+            n = len(self.accesses)
+            self.assertEqual((yield from self.blit(count=0, control=2)), 0x22)
+            self.assertEqual(len(self.accesses), n)
+
+        self.run_sim(sim_test)
+
+    def test_fill(self):
+        expected = bytearray(self.mem)
+
+        def sim_test():
+            # words, rows going down through memory with a negative stride
+            yield from self.blit(dst=0x3100, count=3, rows=4, dst_stride=(-0x40) & 0xffffff,
+                                 fill_data=0x1234abcd, control=0x5)
+            for row in range(4):
+                expected[0x3100 - row*0x40:0x3106 - row*0x40] = b"\xab\xcd" * 3
+            self.assertEqual(self.mem, expected)
+            # nothing is read
+            self.assertEqual([a for a in self.accesses if not a[2]], [])
+
+        self.run_sim(sim_test)
+
+    def test_shared(self):
+        dut = self.dut
+
+        def sim_test():
+            yield from self.access(dut.csr, 0, we=1, dat=0x1000)
+            yield from self.access(dut.csr, 1, we=1, dat=0x6000)
+            yield from self.access(dut.csr, 2, we=1, dat=64)
+            yield from self.access(dut.csr, 7, we=1, dat=0x1a)
+            self.assertTrue((yield dut.busy))
+            # the cpu gets its turn in between
+            for i in range(4):
+                dat = yield from self.access(self.wb, 0x800 + i, fc=6)
+                self.assertEqual(dat, int.from_bytes(self.mem[0x2000 + i*4:0x2004 + i*4], "big"))
+                self.assertTrue((yield dut.busy))
+            self.assertIn((0x800, 0xf, 0, 6), self.accesses)
+            while (yield dut.busy):
+                yield Tick()
+            yield Settle()
+            self.assertEqual((yield dut.irq), 1)
+            self.assertEqual(self.mem[0x6000:0x6100], self.mem[0x1000:0x1100])
+            # once idle the bus is back with the cpu, a request goes straight
+            # through
+            yield self.wb.adr.eq(0x123)
+            yield self.wb.cyc.eq(1)
+            yield self.wb.stb.eq(1)
+            yield Settle()
+            self.assertEqual(((yield dut.bus.cyc), (yield dut.bus.adr)), (1, 0x123))
+            yield self.wb.cyc.eq(0)
+            yield self.wb.stb.eq(0)
+            yield from self.access(dut.csr, 7, we=1, sel=0x1, dat=0x20)
+            yield Settle()
+            self.assertEqual((yield dut.irq), 0)
+            yield dut.perf_snapshot.eq(1)
+            yield Tick()
+            yield dut.perf_snapshot.eq(0)
+            yield Tick()
+            perf = {}
+            for name, snapshot in dut.perf:
+                perf[name] = yield snapshot
+            self.assertEqual(perf["blits"], 1)
+            self.assertEqual(perf["blit_elements"], 64)
+            self.assertGreater(perf["blit_busy"], 64 * 2 * 2)
+            self.assertGreater(perf["blit_wait"], 0)
+            self.assertGreater(perf["cpu_blit_wait"], 0)
+
+        self.run_sim(sim_test)
+
+    def test_error(self):
+        def sim_test():
+            # stops at the bus error with the error bit set
+            status = yield from self.blit(src=0x1000, dst=0x2000, count=16, control=2)
+            self.assertEqual(status, 0x62)
+            self.assertEqual(self.accesses[-1][0], 0x1010 >> 2)
+
+        self.run_sim(sim_test, err_adr=0x1010 >> 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from nmigen import *
+
+
+# ecp5 pll, feedback from CLKOP. the dividers are searched for the output
+# frequency closest to the one asked for. with shifted_phase, clk_shifted is
+# the same clock from CLKOS, lagging clk_out by that many degrees rounded to
+# an eighth of a vco cycle.
+class ECP5PLL(Elaboratable):
+    def __init__(self, clk_in, freq_in, freq_out, shifted_phase=None):
+        self.clk_in = clk_in
+        self.freq_in = freq_in
+        self.clk_out = Signal()
+        self.clk_shifted = Signal()
+        self.locked = Signal()
+        self.clki_div, self.clkfb_div, self.clkop_div, self.freq_out = self.search(freq_in, freq_out)
+        self.shifted_phase = shifted_phase
+
+    @staticmethod
+    def search(freq_in, freq_out):
+        best = None
+        for clki_div in range(1, 129):
+            f_pfd = freq_in / clki_div
+            if f_pfd < 3.125e6 or f_pfd > 400e6:
+                continue
+            for clkfb_div in range(1, 81):
+                f_out = f_pfd * clkfb_div
+                for clkop_div in range(1, 129):
+                    f_vco = f_out * clkop_div
+                    if f_vco < 400e6 or f_vco > 800e6:
+                        continue
+                    error = abs(f_out - freq_out)
+                    if best is None or error < best[0]:
+                        best = (error, clki_div, clkfb_div, clkop_div, f_out)
+        if best is None:
+            raise ValueError("no ecp5 pll setting for {} Hz from {} Hz".format(freq_out, freq_in))
+        return best[1:]
+
+    # CPHASE and FPHASE of an output with divider div, phase degrees after
+    # CLKOP
+    @staticmethod
+    def phase_setting(div, phase):
+        steps = round(phase / 360 * div * 8)
+        return div - 1 + steps // 8, steps % 8
+
+    def elaborate(self, platform):
+        m = Module()
+        clkos = {}
+        if self.shifted_phase is not None:
+            cphase, fphase = self.phase_setting(self.clkop_div, self.shifted_phase)
+            clkos = dict(
+                p_CLKOS_ENABLE = "ENABLED",
+                p_CLKOS_DIV = self.clkop_div,
+                p_CLKOS_CPHASE = cphase,
+                p_CLKOS_FPHASE = fphase,
+                o_CLKOS = self.clk_shifted,
+                a_FREQUENCY_PIN_CLKOS = str(self.freq_out / 1e6),
+            )
+        m.submodules.pll = Instance("EHXPLLL",
+            p_PLLRST_ENA = "DISABLED",
+            p_INTFB_WAKE = "DISABLED",
+            p_STDBY_ENABLE = "DISABLED",
+            p_DPHASE_SOURCE = "DISABLED",
+            p_OUTDIVIDER_MUXA = "DIVA",
+            p_OUTDIVIDER_MUXB = "DIVB",
+            p_OUTDIVIDER_MUXC = "DIVC",
+            p_OUTDIVIDER_MUXD = "DIVD",
+            p_CLKI_DIV = self.clki_div,
+            p_CLKOP_ENABLE = "ENABLED",
+            p_CLKOP_DIV = self.clkop_div,
+            p_CLKOP_CPHASE = self.clkop_div - 1,
+            p_CLKOP_FPHASE = 0,
+            p_FEEDBK_PATH = "CLKOP",
+            p_CLKFB_DIV = self.clkfb_div,
+            i_RST = 0,
+            i_STDBY = 0,
+            i_CLKI = self.clk_in,
+            o_CLKOP = self.clk_out,
+            i_CLKFB = self.clk_out,
+            i_PHASESEL0 = 0,
+            i_PHASESEL1 = 0,
+            i_PHASEDIR = 1,
+            i_PHASESTEP = 1,
+            i_PHASELOADREG = 1,
+            i_PLLWAKESYNC = 0,
+            i_ENCLKOP = 0,
+            o_LOCK = self.locked,
+            a_FREQUENCY_PIN_CLKI = str(self.freq_in / 1e6),
+            a_FREQUENCY_PIN_CLKOP = str(self.freq_out / 1e6),
+            a_ICP_CURRENT = "12",
+            a_LPF_RESISTOR = "8",
+            a_MFG_ENABLE_FILTEROPAMP = "1",
+            a_MFG_GMCREF_SEL = "2",
+            **clkos
+        )
+        return m
+
+class Test(unittest.TestCase):
+    def test_search(self):
+        for freq in (25e6, 50e6, 75e6, 100e6):
+            clki_div, clkfb_div, clkop_div, freq_out = ECP5PLL.search(25e6, freq)
+            self.assertEqual(freq_out, freq)
+            self.assertEqual(25e6 / clki_div * clkfb_div, freq)
+            self.assertTrue(400e6 <= freq * clkop_div <= 800e6)
+        # not reachable exactly, closest is used
+        self.assertAlmostEqual(ECP5PLL.search(25e6, 66.666e6)[3], 66.666e6, delta=0.5e6)
+
+    def test_phase(self):
+        self.assertEqual(ECP5PLL.phase_setting(12, 0), (11, 0))
+        self.assertEqual(ECP5PLL.phase_setting(12, 180), (17, 0))
+        self.assertEqual(ECP5PLL.phase_setting(12, 90), (14, 0))
+        self.assertEqual(ECP5PLL.phase_setting(5, 180), (6, 4))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# builds M68KROM and M68KRAM on their own for the ulx3s ecp5 with yosys and
+# nextpnr, combinational and registered reads, and prints the utilization
+# and fmax from the nextpnr report of each. the memory sits between input
+# and output registers so the path through it is what limits fmax. yosys
+# may merge one of them into the block ram, so the output goes through a
+# second register and the block ram's own clock to out is timed as well.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from nmigen import *
+from nmigen.back import rtlil
+from m68krom import M68KROM, M68KRAM
+
+RESOURCES = ["TRELLIS_COMB", "TRELLIS_FF", "TRELLIS_RAMW", "DP16KD"]
+
+class MemoryTop(Elaboratable):
+    def __init__(self, mem):
+        self.mem = mem
+        self.addr = Signal(len(mem.addr))
+        self.i_data = Signal(16)
+        self.rw_ = Signal()
+        self.data = Signal(16)
+        self.valid = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.mem = mem = self.mem
+        m.d.sync += mem.addr.eq(self.addr)
+        m.d.sync += self.valid.eq(mem.valid)
+        data = Signal(16)
+        if isinstance(mem, M68KRAM):
+            m.d.sync += mem.i_data.eq(self.i_data)
+            m.d.sync += mem.rw_.eq(self.rw_)
+            m.d.sync += data.eq(mem.o_data)
+        else:
+            m.d.sync += data.eq(mem.data)
+        m.d.sync += self.data.eq(data)
+        return m
+
+def variants(addr_width, image):
+    return [
+        ("rom", lambda: M68KROM(addr_width, image, 0)),
+        ("rom registered", lambda: M68KROM(addr_width, image, 0, registered=True)),
+        ("ram registered", lambda: M68KRAM(addr_width, image, 0)),
+    ]
+
+def build(top, workdir, name, device, package, freq):
+    base = os.path.join(workdir, name.replace(" ", "_"))
+    ports = [ClockSignal(), ResetSignal(), top.addr, top.i_data, top.rw_, top.data, top.valid]
+    with open(base + ".il", "w") as f:
+        f.write(rtlil.convert(top, ports=ports))
+    subprocess.run(["yosys", "-q", "-p", "read_rtlil {0}.il; synth_ecp5 -top top -json {0}.json".format(base)],
+                   check=True)
+    # a design that misses freq still reports what it achieved
+    subprocess.run(["nextpnr-ecp5", "--" + device, "--package", package, "--json", base + ".json",
+                    "--freq", str(freq), "--timing-allow-fail", "--report", base + "_report.json",
+                    "--quiet"], check=True)
+    with open(base + "_report.json") as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--addr-width", type=int, action="append",
+                        help="memory size in 16 bit words, log2 (default 10 and 12)")
+    parser.add_argument("--device", default="85k")
+    parser.add_argument("--package", default="CABGA381")
+    parser.add_argument("--freq", type=float, default=200, help="target MHz")
+    parser.add_argument("-o", "--output", help="write the reports here as json")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        image = os.path.join(workdir, "image.bin")
+        for addr_width in args.addr_width or [10, 12]:
+            with open(image, "wb") as f:
+                f.write(os.urandom(2 << addr_width))
+            for name, make in variants(addr_width, image):
+                key = "{} {}".format(name, addr_width)
+                print("building", key, file=sys.stderr)
+                report = build(MemoryTop(make()), workdir, key, args.device, args.package, args.freq)
+                results[key] = {
+                    "fmax": min(clk["achieved"] for clk in report["fmax"].values()),
+                    "utilization": {r: report["utilization"].get(r, {}).get("used", 0) for r in RESOURCES},
+                }
+
+    print("{:20} {:>8} ".format("", "fmax") + " ".join("{:>13}".format(r) for r in RESOURCES))
+    for key, result in results.items():
+        print("{:20} {:8.1f} ".format(key, result["fmax"]) +
+              " ".join("{:13d}".format(result["utilization"][r]) for r in RESOURCES))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
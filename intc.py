@@ -0,0 +1,272 @@
+import unittest
+from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from wb_util import connect_wishbone
+
+
+# interrupt path from the host ipl pins to the cpu.
+# ipl_ is the active low level on the pins. it is synchronized and only passed
+# on to the cpu as ipl once it has been the same for filter_clocks clocks, so
+# the skew between the three lines while the level changes is never seen as
+# a different level.
+# interrupt acknowledge cycles for levels in local_iack are answered here
+# instead of going out to the host: None autovectors (rty to the cpu), a
+# number is returned as the vector. other levels pass through to the bridge,
+# which turns vpa, or no dtack within its iack_timeout, into rty.
+# irq is an interrupt from the fpga at irq_level, merged with the host level.
+# its acknowledge is answered here while it is high, with irq_vector or
+# autovectored if that is None, so the level can be shared with the host.
+# the clocks from a new level reaching the cpu to its interrupt acknowledge
+# are measured, the perf registers work like the WishboneTo68000 ones.
+class InterruptController(Elaboratable):
+    def __init__(self, wb, wb_fc, local_iack={}, filter_clocks=2, irq_level=None, irq_vector=None):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.local_iack = local_iack
+        self.filter_clocks = filter_clocks
+        self.irq_level = irq_level
+        self.irq_vector = irq_vector
+        self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.fc = Signal(3)
+        self.ipl_ = Signal(3, reset = 7)
+        self.ipl = Signal(3)
+        self.irq = Signal()
+        self.perf_snapshot = Signal()
+        self.perf_clear = Signal()
+        names = ["irqs", "irq_latency_last", "irq_latency_max", "irq_latency_total"]
+        self.perf = [(name, Signal(32, name="perf_" + name)) for name in names]
+        self.perf_live = {name: Signal(32, name="count_" + name) for name in names}
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # glitch filter
+        ipl_sync = Signal(3)
+        m.submodules.ipl_sync = FFSynchronizer(~self.ipl_, ipl_sync)
+        candidate = Signal(3)
+        host_ipl = Signal(3)
+        stable = Signal(range(self.filter_clocks + 1))
+        with m.If(ipl_sync != candidate):
+            m.d.sync += candidate.eq(ipl_sync)
+            m.d.sync += stable.eq(0)
+        with m.Elif(stable != self.filter_clocks):
+            m.d.sync += stable.eq(stable + 1)
+        with m.Else():
+            m.d.sync += host_ipl.eq(candidate)
+        m.d.comb += self.ipl.eq(host_ipl)
+        if self.irq_level is not None:
+            with m.If(self.irq & (host_ipl < self.irq_level)):
+                m.d.comb += self.ipl.eq(self.irq_level)
+
+        request = Signal()
+        iack = Signal()
+        level = Signal(3)
+        local = Signal()
+        m.d.comb += [
+            request.eq(self.wb.cyc & self.wb.stb),
+            iack.eq(self.wb_fc == 0x7),
+            level.eq(self.wb.adr[0:3]),
+        ]
+        ack = Signal()
+        vector = Signal(8)
+        autovector = Signal()
+        def answer(l, v):
+            m.d.comb += local.eq(iack)
+            if v is None:
+                m.d.comb += vector.eq(0x18 + l)
+                m.d.comb += autovector.eq(1)
+            else:
+                m.d.comb += vector.eq(v)
+                m.d.comb += autovector.eq(0)
+        for l, v in self.local_iack.items():
+            with m.If(level == l):
+                answer(l, v)
+        if self.irq_level is not None:
+            with m.If((level == self.irq_level) & self.irq):
+                answer(self.irq_level, self.irq_vector)
+
+        with m.If(local):
+            m.d.sync += ack.eq(request & ~ack)
+            m.d.comb += self.wb.dat_r.eq(vector)
+            m.d.comb += self.wb.ack.eq(ack & ~autovector)
+            m.d.comb += self.wb.rty.eq(ack & autovector)
+        with m.Else():
+            connect_wishbone(m, self.wb, self.bus, self.wb_fc, self.fc)
+
+        # interrupt entry latency, from a new nonzero level to the start of
+        # the acknowledge cycle. a level the cpu has masked keeps counting.
+        last_ipl = Signal(3)
+        pending = Signal()
+        timer = Signal(32)
+        taken = Signal()
+        m.d.sync += last_ipl.eq(self.ipl)
+        with m.If(self.ipl != last_ipl):
+            m.d.sync += pending.eq(self.ipl != 0)
+            m.d.sync += timer.eq(1)
+        with m.Elif(request & iack & pending):
+            m.d.comb += taken.eq(1)
+            m.d.sync += pending.eq(0)
+        with m.Else():
+            m.d.sync += timer.eq(timer + 1)
+
+        irqs = self.perf_live["irqs"]
+        last = self.perf_live["irq_latency_last"]
+        max_ = self.perf_live["irq_latency_max"]
+        total = self.perf_live["irq_latency_total"]
+        with m.If(self.perf_clear):
+            m.d.sync += [irqs.eq(0), last.eq(0), max_.eq(0), total.eq(0)]
+        with m.Elif(taken):
+            m.d.sync += [
+                irqs.eq(irqs + 1),
+                last.eq(timer),
+                total.eq(total + timer),
+            ]
+            with m.If(timer > max_):
+                m.d.sync += max_.eq(timer)
+        for name, snapshot in self.perf:
+            with m.If(self.perf_snapshot):
+                m.d.sync += snapshot.eq(self.perf_live[name])
+
+        return m
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.wb_fc = Signal(3)
+
+    def access(self, adr, fc=5):
+        wb = self.wb
+        yield wb.adr.eq(adr)
+        yield wb.sel.eq(0x3)
+        yield self.wb_fc.eq(fc)
+        yield wb.cyc.eq(1)
+        yield wb.stb.eq(1)
+        yield Delay(1e-9)
+        while ((yield wb.ack) | (yield wb.rty)) == 0:
+            yield Tick()
+            yield Delay(1e-9)
+        result = ((yield wb.ack), (yield wb.rty), (yield wb.dat_r))
+        yield Tick()
+        yield wb.cyc.eq(0)
+        yield wb.stb.eq(0)
+        return result
+
+    def test_filter(self):
+        dut = InterruptController(self.wb, self.wb_fc, filter_clocks=2)
+
+        def sim_test():
+            yield dut.ipl_.eq(~3)
+            for i in range(2 + 3):
+                yield Tick()
+                yield Settle()
+                self.assertEqual((yield dut.ipl), 0)
+            yield Tick()
+            yield Settle()
+            self.assertEqual((yield dut.ipl), 3)
+            # a one clock glitch on the way from 3 to 4 never shows up
+            yield dut.ipl_.eq(~7)
+            yield Tick()
+            yield dut.ipl_.eq(~4)
+            for i in range(10):
+                yield Tick()
+                yield Settle()
+                self.assertIn((yield dut.ipl), (3, 4))
+            self.assertEqual((yield dut.ipl), 4)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_iack(self):
+        dut = InterruptController(self.wb, self.wb_fc, local_iack={7: None, 5: 0x40})
+
+        def host():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.bus.ack):
+                    yield dut.bus.ack.eq(0)
+                    continue
+                if (yield dut.bus.cyc) & (yield dut.bus.stb):
+                    yield dut.bus.dat_r.eq(0x1000 + (yield dut.fc))
+                    yield dut.bus.ack.eq(1)
+
+        def sim_test():
+            yield dut.ipl_.eq(~7)
+            for i in range(6):
+                yield Tick()
+            self.assertEqual((yield from self.access(0x3fffffff, fc=7)), (0, 1, 0x1f))
+            yield dut.ipl_.eq(~5)
+            for i in range(6):
+                yield Tick()
+            self.assertEqual((yield from self.access(0x3ffffffd, fc=7)), (1, 0, 0x40))
+            # other levels and everything else go to the host
+            self.assertEqual((yield from self.access(0x3ffffffe, fc=7)), (1, 0, 0x1007))
+            self.assertEqual((yield from self.access(0x100, fc=5)), (1, 0, 0x1005))
+            yield dut.perf_snapshot.eq(1)
+            yield Tick()
+            yield dut.perf_snapshot.eq(0)
+            yield Tick()
+            perf = {}
+            for name, snapshot in dut.perf:
+                perf[name] = yield snapshot
+            self.assertEqual(perf["irqs"], 2)
+            self.assertGreater(perf["irq_latency_max"], 0)
+            self.assertGreaterEqual(perf["irq_latency_max"], perf["irq_latency_last"])
+            self.assertGreater(perf["irq_latency_total"], perf["irq_latency_max"])
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(host)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_irq(self):
+        dut = InterruptController(self.wb, self.wb_fc, irq_level=4, irq_vector=0x60)
+
+        def host():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.bus.ack):
+                    yield dut.bus.ack.eq(0)
+                    continue
+                if (yield dut.bus.cyc) & (yield dut.bus.stb):
+                    yield dut.bus.dat_r.eq(0x1000 + (yield dut.fc))
+                    yield dut.bus.ack.eq(1)
+
+        def sim_test():
+            yield dut.irq.eq(1)
+            yield Settle()
+            self.assertEqual((yield dut.ipl), 4)
+            self.assertEqual((yield from self.access(0x3ffffffc, fc=7)), (1, 0, 0x60))
+            # a higher host level wins, the lower one waits
+            yield dut.ipl_.eq(~6)
+            for i in range(8):
+                yield Tick()
+            self.assertEqual((yield dut.ipl), 6)
+            yield dut.ipl_.eq(~2)
+            for i in range(8):
+                yield Tick()
+            self.assertEqual((yield dut.ipl), 4)
+            # the host gets the acknowledge once irq is gone
+            yield dut.irq.eq(0)
+            yield dut.ipl_.eq(~4)
+            for i in range(8):
+                yield Tick()
+            self.assertEqual((yield dut.ipl), 4)
+            self.assertEqual((yield from self.access(0x3ffffffc, fc=7)), (1, 0, 0x1007))
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(host)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from wb_to_68k import WishboneTo68000
+
+
+# dtack latency profiles, latency() is the number of clocks dtack stays
+# negated after uds or lds is asserted for a bus cycle at a byte address
+
+class Fixed:
+    def __init__(self, clocks):
+        self.clocks = clocks
+
+    def latency(self, addr):
+        return self.clocks
+
+class Random:
+    def __init__(self, low, high, seed=0):
+        self.low = low
+        self.high = high
+        self.random = random.Random(seed)
+
+    def latency(self, addr):
+        return self.random.randint(self.low, self.high)
+
+# ranges is a list of (start, end, profile), end exclusive
+class ByRange:
+    def __init__(self, ranges, default=Fixed(0)):
+        self.ranges = ranges
+        self.default = default
+
+    def latency(self, addr):
+        for start, end, profile in self.ranges:
+            if start <= addr < end:
+                return profile.latency(addr)
+        return self.default.latency(addr)
+
+# rough x68000 at 10MHz: dram with an occasional refresh stall, vram behind
+# the video controller arbitration, slow i/o
+X68000 = ByRange([
+    (0x000000, 0xc00000, Random(0, 1)),
+    (0xc00000, 0xe80000, Random(1, 4)),
+    (0xe80000, 0x1000000, Random(2, 6)),
+])
+
+def default_word(addr):
+    return (addr * 0x9e37 + 0x1234) & 0xffff
+
+# 68000 bus slave with a backing memory of 16 bit words, driving the pins of
+# a WishboneTo68000. words that were never written read as default_word.
+class M68KSlave:
+    def __init__(self, bridge, latency=Fixed(0), memory=None):
+        self.bridge = bridge
+        self.latency = latency
+        self.memory = {} if memory is None else memory
+        self.cycles = 0
+
+    def process(self):
+        b = self.bridge
+        yield Passive()
+        waited = 0
+        wait = 0
+        while True:
+            yield Tick()
+            yield Settle()
+            uds_ = yield b.uds_
+            lds_ = yield b.lds_
+            if uds_ & lds_:
+                waited = 0
+                yield b.dtack_.eq(1)
+                continue
+            addr = yield b.addr
+            if waited == 0:
+                wait = self.latency.latency(addr << 1)
+            if waited == wait:
+                self.cycles += 1
+                word = self.memory.get(addr, default_word(addr))
+                if (yield b.rw_):
+                    yield b.i_data.eq(word)
+                else:
+                    data = yield b.o_data
+                    if not uds_:
+                        word = (word & 0x00ff) | (data & 0xff00)
+                    if not lds_:
+                        word = (word & 0xff00) | (data & 0x00ff)
+                    self.memory[addr] = word
+                yield b.dtack_.eq(0)
+            waited += 1
+
+# random byte, word and longword reads and writes on a wishbone bus, read
+# data is checked against a model of the memory. ranges is a list of
+# (start, end) byte address ranges to pick addresses from.
+class WishboneMaster:
+    def __init__(self, wb, wb_fc, count=1000, ranges=[(0x000000, 0x1000)], seed=0):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.count = count
+        self.ranges = ranges
+        self.random = random.Random(seed)
+        self.model = {}
+        self.errors = []
+        self.clocks = 0
+
+    def byte(self, addr):
+        word = self.model.get(addr >> 1, default_word(addr >> 1))
+        return word & 0xff if addr & 1 else word >> 8
+
+    def set_byte(self, addr, value):
+        word = self.model.get(addr >> 1, default_word(addr >> 1))
+        if addr & 1:
+            word = (word & 0xff00) | value
+        else:
+            word = (word & 0x00ff) | (value << 8)
+        self.model[addr >> 1] = word
+
+    def process(self):
+        wb = self.wb
+        for i in range(self.count):
+            start, end = self.random.choice(self.ranges)
+            adr = self.random.randrange(start, end) >> 2
+            sel = self.random.choice([0x1, 0x2, 0x4, 0x8, 0x3, 0xc, 0xf])
+            we = self.random.randrange(2)
+            dat = self.random.getrandbits(32)
+            yield wb.adr.eq(adr)
+            yield wb.sel.eq(sel)
+            yield wb.we.eq(we)
+            yield wb.dat_w.eq(dat)
+            yield self.wb_fc.eq(self.random.choice([1, 2, 5, 6]))
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            while (yield wb.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+                self.clocks += 1
+            dat_r = yield wb.dat_r
+            for lane in range(4):
+                if sel & (1 << lane):
+                    addr = (adr << 2) + 3 - lane
+                    if we:
+                        self.set_byte(addr, (dat >> (lane * 8)) & 0xff)
+                    elif (dat_r >> (lane * 8)) & 0xff != self.byte(addr):
+                        self.errors.append((adr, sel, dat_r))
+            yield Tick()
+            self.clocks += 1
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+
+# runs count random transactions through a bridge against a latency profile,
+# returns transactions per 1000 clocks and the read data errors
+def measure(latency, count=1000, ranges=[(0x000000, 0x1000)], seed=0, **bridge_args):
+    wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+    wb_fc = Signal(3)
+    bridge = WishboneTo68000(wb, wb_fc, Signal(3), **bridge_args)
+    slave = M68KSlave(bridge, latency)
+    master = WishboneMaster(wb, wb_fc, count, ranges, seed)
+    sim = Simulator(bridge)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(slave.process)
+    sim.add_sync_process(master.process)
+    sim.run()
+    return count * 1000 / master.clocks, master.errors
+
+PROFILES = [
+    ("zero wait", Fixed(0)),
+    ("fixed 2", Fixed(2)),
+    ("random 0-4", Random(0, 4)),
+    ("x68000", X68000),
+]
+
+# main ram, graphics vram and i/o
+X68000_RANGES = [(0x000000, 0x1000), (0xc00000, 0xc01000), (0xe82000, 0xe82400)]
+
+class Test(unittest.TestCase):
+    def test_profiles(self):
+        for name, latency in PROFILES:
+            for write_depth in (0, 4):
+                tpk, errors = measure(latency, 300, X68000_RANGES, write_depth=write_depth)
+                self.assertEqual(errors, [], (name, write_depth))
+                self.assertGreater(tpk, 0)
+
+    def test_slave_latency(self):
+        # one word read per 68000 cycle, clocks per transaction grow by the
+        # latency
+        base, errors = measure(Fixed(0), 200, [(0, 0x100)], write_depth=0)
+        slow, errors = measure(Fixed(3), 200, [(0, 0x100)], write_depth=0)
+        self.assertGreater(base, slow)
+
+if __name__ == "__main__":
+    for name, latency in PROFILES:
+        for write_depth in (0, 4):
+            tpk, errors = measure(latency, 5000, X68000_RANGES, write_depth=write_depth)
+            print("{:12} write_depth {}: {:6.1f} transactions per 1000 clocks{}".format(
+                name, write_depth, tpk, ", %d errors" % len(errors) if errors else ""))
@@ -1,43 +1,177 @@
 import unittest
+import struct
+import tempfile
 from nmigen import *
 from nmigen_soc import wishbone
+from nmigen.sim import *
+from memimage import load
+from wb_util import connect_wishbone
 
+# filename is anything memimage.load takes: a raw binary, s-record or elf
+# file, or a list of segments. a raw file is read from file_offset, linked
+# images are placed by address with the memory starting at base.
+# valid is high when data belongs to addr. with registered the read port is
+# clocked so the rom always maps to block ram, data follows addr a clock
+# later. otherwise the read is combinational and valid is always high, it
+# only maps to block ram where yosys can merge a register next to it.
+# dtack_ is valid as a 68000 slave answers it, asserted while as_ is and the
+# data is good, so whatever sits on the 68000 side of a bridge only has to
+# pass it on. on wishbone use LocalMemory, which acks instead.
 class M68KROM(Elaboratable):
-    def __init__(self, addr_width, filename, file_offset):
+    def __init__(self, addr_width, filename, file_offset, registered=False, base=0):
         self.depth = 2**addr_width
+        self.registered = registered
         self.addr = Signal(addr_width)
         self.data = Signal(16)
-        f = open(filename, 'rb')
-        f.seek(file_offset)
-        byte_content = f.read(self.depth)
-        dat = [byte_content[i] << 8 | byte_content[i + 1] for i in range(0, self.depth, 2)]
+        self.valid = Signal()
+        self.as_ = Signal(reset=1)
+        self.dtack_ = Signal(reset=1)
+        dat = load(filename, self.depth, file_offset, base)
         self.mem = Memory(width=16, depth=self.depth, init=dat)
 
     def elaborate(self, platform):
         m = Module()
-        m.submodules.rdport = rdport = self.mem.read_port(domain="comb")
+        if self.registered:
+            m.submodules.rdport = rdport = self.mem.read_port(transparent=False)
+            read_valid(m, self.addr, self.valid)
+        else:
+            m.submodules.rdport = rdport = self.mem.read_port(domain="comb")
+            m.d.comb += self.valid.eq(1)
         m.d.comb += rdport.addr.eq(self.addr)
         m.d.comb += self.data.eq(rdport.data)
+        m.d.comb += self.dtack_.eq(self.as_ | ~self.valid)
         return m
 
+# valid for a clocked read port, the address has not changed since the last
+# clock
+def read_valid(m, addr, valid):
+    addr_r = Signal.like(addr)
+    started = Signal()
+    m.d.sync += addr_r.eq(addr)
+    m.d.sync += started.eq(1)
+    m.d.comb += valid.eq(started & (addr_r == addr))
+
+# the read port is clocked, valid and dtack_ work as for a registered
+# M68KROM
 class M68KRAM(Elaboratable):
-    def __init__(self, addr_width):
+    def __init__(self, addr_width, filename=None, file_offset=0, base=0):
         self.depth = 2**addr_width
         self.addr = Signal(addr_width)
+        self.valid = Signal()
         self.o_data = Signal(16)
         self.i_data = Signal(16)
         self.rw_ = Signal(reset=1)
-        self.mem = Memory(width=16, depth=self.depth)
+        self.uds_ = Signal()
+        self.lds_ = Signal()
+        self.as_ = Signal(reset=1)
+        self.dtack_ = Signal(reset=1)
+        dat = None
+        if filename is not None:
+            dat = load(filename, self.depth * 2, file_offset, base)
+        self.mem = Memory(width=16, depth=self.depth, init=dat)
 
     def elaborate(self, platform):
         m = Module()
         m.submodules.rdport = rdport = self.mem.read_port()
-        m.submodules.wrport = wrport = self.mem.write_port()
+        m.submodules.wrport = wrport = self.mem.write_port(granularity=8)
         m.d.comb += rdport.addr.eq(self.addr)
         m.d.comb += wrport.addr.eq(self.addr)
         m.d.comb += self.o_data.eq(rdport.data)
         m.d.comb += wrport.data.eq(self.i_data)
-        m.d.comb += wrport.en.eq(~self.rw_)
+        m.d.comb += wrport.en.eq(Cat(~self.lds_, ~self.uds_) & Repl(~self.rw_, 2))
+        read_valid(m, self.addr, self.valid)
+        m.d.comb += self.dtack_.eq(self.as_ | ~self.valid)
+        return m
+
+# block ram copy of a host rom window, sits between the cpu wishbone bus and
+# the rest of the system. without a filename the rom is copied from the host
+# bus once after reset, the cpu is stalled until the copy is done. afterwards
+# reads in the window are answered locally and never reach the host bus.
+# addr_width is the size of the window in bytes.
+class ShadowROM(Elaboratable):
+    def __init__(self, wb, wb_fc, base=0xfe0000, addr_width=17, filename=None, file_offset=0):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.base = base
+        self.addr_width = addr_width
+        self.depth = 2**(addr_width - 2)
+        self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.fc = Signal(3)
+        self.loaded = Signal(reset = filename is not None)
+        dat = None
+        if filename is not None:
+            dat = load(filename, self.depth * 4, file_offset, base, width=32)
+        self.mem = Memory(width=32, depth=self.depth, init=dat)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rdport = rdport = self.mem.read_port(transparent=False)
+        m.submodules.wrport = wrport = self.mem.write_port()
+
+        addr = Signal(24) # 68000 byte address
+        m.d.comb += addr.eq(self.wb.adr << 2)
+        in_window = Signal()
+        m.d.comb += in_window.eq((addr >= self.base) &
+                                 (addr < self.base + 2**self.addr_width) &
+                                 (self.wb_fc != 0x7) & ~self.wb.we)
+        copy_index = Signal(range(self.depth))
+        ack = Signal()
+
+        m.d.comb += rdport.addr.eq(self.wb.adr)
+        m.d.comb += wrport.addr.eq(copy_index)
+        m.d.comb += wrport.data.eq(self.bus.dat_r)
+
+        with m.If(~self.loaded):
+            # copy the rom from the host, one longword at a time
+            m.d.comb += [
+                self.bus.adr.eq((self.base >> 2) + copy_index),
+                self.bus.sel.eq(0xf),
+                self.bus.cyc.eq(1),
+                self.bus.stb.eq(1),
+                self.fc.eq(0x6), # supervisor program
+            ]
+            with m.If(self.bus.ack):
+                m.d.comb += wrport.en.eq(1)
+                m.d.sync += copy_index.eq(copy_index + 1)
+                with m.If(copy_index == self.depth - 1):
+                    m.d.sync += self.loaded.eq(1)
+        with m.Elif(in_window):
+            m.d.sync += ack.eq(self.wb.cyc & self.wb.stb & ~ack)
+            m.d.comb += self.wb.ack.eq(ack)
+            m.d.comb += self.wb.dat_r.eq(rdport.data)
+        with m.Else():
+            connect_wishbone(m, self.wb, self.bus, self.wb_fc, self.fc)
+        return m
+
+# 32 bit block ram on a local wishbone port, for LocalDecoder. every access
+# is a single longword or byte lane write acked a clock after the request,
+# with none of the 16 bit splitting of the 68000 bus. addr_width is the size
+# in longwords, the window is aliased beyond it. without writable writes are
+# acked and dropped.
+class LocalMemory(Elaboratable):
+    def __init__(self, addr_width, filename=None, file_offset=0, writable=True, base=0):
+        self.depth = 2**addr_width
+        self.writable = writable
+        self.bus = wishbone.Interface(addr_width = addr_width, data_width = 32, granularity = 8)
+        dat = None
+        if filename is not None:
+            dat = load(filename, self.depth * 4, file_offset, base, width=32)
+        self.mem = Memory(width=32, depth=self.depth, init=dat)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rdport = rdport = self.mem.read_port(transparent=False)
+        m.d.comb += rdport.addr.eq(self.bus.adr)
+        m.d.comb += self.bus.dat_r.eq(rdport.data)
+        ack = Signal()
+        m.d.sync += ack.eq(self.bus.cyc & self.bus.stb & ~ack)
+        m.d.comb += self.bus.ack.eq(ack)
+        if self.writable:
+            m.submodules.wrport = wrport = self.mem.write_port(granularity=8)
+            m.d.comb += wrport.addr.eq(self.bus.adr)
+            m.d.comb += wrport.data.eq(self.bus.dat_w)
+            with m.If(self.bus.cyc & self.bus.stb & self.bus.we & ~ack):
+                m.d.comb += wrport.en.eq(self.bus.sel)
         return m
 
 class Test(unittest.TestCase):
@@ -54,6 +188,56 @@ class Test(unittest.TestCase):
         sim.add_clock(1e-6)
         sim.add_sync_process(sim_test)
         sim.run()
+    def test_registered(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(bytes(range(64)))
+            f.flush()
+            dut = M68KROM(5, f.name, 0, registered=True)
+
+            def sim_test():
+                yield dut.addr.eq(3)
+                yield Settle()
+                self.assertEqual((yield dut.valid), 0)
+                yield Tick()
+                yield Settle()
+                self.assertEqual(((yield dut.valid), (yield dut.data)), (1, 0x0607))
+                # no dtack without as
+                self.assertEqual((yield dut.dtack_), 1)
+                yield dut.as_.eq(0)
+                yield dut.addr.eq(4)
+                yield Settle()
+                self.assertEqual(((yield dut.valid), (yield dut.dtack_)), (0, 1))
+                yield Tick()
+                yield Settle()
+                self.assertEqual(((yield dut.valid), (yield dut.data)), (1, 0x0809))
+                self.assertEqual((yield dut.dtack_), 0)
+
+            sim = Simulator(dut)
+            sim.add_clock(1e-6)
+            sim.add_sync_process(sim_test)
+            sim.run()
+    def test_elf(self):
+        # a linked image goes by address, the rom starts at base
+        data = bytearray(0x100)
+        data[:16] = b"\x7fELF\x01\x02\x01" + bytes(9)
+        struct.pack_into(">I", data, 0x1c, 52)
+        struct.pack_into(">HH", data, 0x2a, 32, 1)
+        struct.pack_into(">IIIIIIII", data, 52, 1, 0x80, 0xff0004, 0xff0004, 4, 4, 5, 4)
+        data[0x80:0x84] = b"\x12\x34\x56\x78"
+        with tempfile.NamedTemporaryFile(suffix=".elf") as f:
+            f.write(data)
+            f.flush()
+            dut = M68KROM(4, f.name, 0x10000, base=0xff0000)
+
+        def sim_test():
+            for addr, data in ((0, 0), (2, 0x1234), (3, 0x5678)):
+                yield dut.addr.eq(addr)
+                yield Settle()
+                self.assertEqual((yield dut.data), data)
+
+        sim = Simulator(dut)
+        sim.add_process(sim_test)
+        sim.run()
     def test_ram(self):
         dut = M68KRAM(4)
 
@@ -81,8 +265,163 @@ class Test(unittest.TestCase):
         sim.add_clock(1e-6)
         sim.add_sync_process(sim_test)
         sim.run()
+    def test_ram_bytes(self):
+        dut = M68KRAM(4)
+
+        def sim_test():
+            yield dut.addr.eq(2)
+            yield dut.rw_.eq(0)
+            yield dut.i_data.eq(0x1234)
+            yield Tick()
+            yield dut.uds_.eq(1)
+            yield dut.i_data.eq(0xaaaa)
+            yield Tick()
+            yield dut.uds_.eq(0)
+            yield dut.lds_.eq(1)
+            yield dut.i_data.eq(0x55bb)
+            yield Tick()
+            yield dut.rw_.eq(1)
+            yield Tick()
+            yield Settle()
+            self.assertEqual((yield dut.o_data), 0x55aa)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def run_shadow(self, dut, test):
+        self.accesses = []
+
+        def slave():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.bus.ack):
+                    yield dut.bus.ack.eq(0)
+                    continue
+                if (yield dut.bus.cyc) & (yield dut.bus.stb):
+                    adr = yield dut.bus.adr
+                    self.accesses.append((adr, (yield dut.fc)))
+                    yield dut.bus.dat_r.eq(adr ^ 0x55555555)
+                    yield dut.bus.ack.eq(1)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(slave)
+        sim.add_sync_process(test)
+        sim.run()
+
+    def read(self, dut, adr, fc=6):
+        yield dut.wb.adr.eq(adr)
+        yield dut.wb_fc.eq(fc)
+        yield dut.wb.sel.eq(0xf)
+        yield dut.wb.cyc.eq(1)
+        yield dut.wb.stb.eq(1)
+        yield Delay(1e-9)
+        clocks = 1
+        while (yield dut.wb.ack) == 0:
+            yield Tick()
+            yield Delay(1e-9)
+            clocks += 1
+        dat_r = yield dut.wb.dat_r
+        yield Tick()
+        yield dut.wb.cyc.eq(0)
+        yield dut.wb.stb.eq(0)
+        return dat_r, clocks
+
+    def test_shadow(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = ShadowROM(wb, Signal(3), base=0xfe0000, addr_width=6)
+
+        def sim_test():
+            # the cpu waits for the copy
+            dat_r, clocks = yield from self.read(dut, 0xfe0004 >> 2)
+            self.assertEqual(dat_r, (0xfe0004 >> 2) ^ 0x55555555)
+            self.assertEqual(self.accesses, [((0xfe0000 >> 2) + i, 6) for i in range(16)])
+            self.assertEqual((yield dut.loaded), 1)
+            del self.accesses[:]
+            for i in range(16):
+                dat_r, clocks = yield from self.read(dut, (0xfe0000 >> 2) + i)
+                self.assertEqual(dat_r, ((0xfe0000 >> 2) + i) ^ 0x55555555)
+                self.assertEqual(clocks, 2)
+            self.assertEqual(self.accesses, [])
+            # outside the window and cpu space go to the host
+            yield from self.read(dut, 0xfe0040 >> 2)
+            yield from self.read(dut, 0x3fffffff, fc=7)
+            self.assertEqual(self.accesses, [(0xfe0040 >> 2, 6), (0x3fffffff, 7)])
+
+        self.run_shadow(dut, sim_test)
+
+    def test_shadow_image(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(bytes(range(64)))
+            f.flush()
+            wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+            dut = ShadowROM(wb, Signal(3), base=0xfe0000, addr_width=6, filename=f.name)
+
+        def sim_test():
+            dat_r, clocks = yield from self.read(dut, (0xfe0000 >> 2) + 1)
+            self.assertEqual(dat_r, 0x04050607)
+            self.assertEqual(clocks, 2)
+            self.assertEqual(self.accesses, [])
+
+        self.run_shadow(dut, sim_test)
+
+    def test_local(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(bytes(range(64)))
+            f.flush()
+            dut = LocalMemory(4, f.name)
+
+        def access(adr, we=0, sel=0xf, dat_w=0):
+            yield dut.bus.adr.eq(adr)
+            yield dut.bus.we.eq(we)
+            yield dut.bus.sel.eq(sel)
+            yield dut.bus.dat_w.eq(dat_w)
+            yield dut.bus.cyc.eq(1)
+            yield dut.bus.stb.eq(1)
+            yield Delay(1e-9)
+            clocks = 1
+            while (yield dut.bus.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+                clocks += 1
+            dat_r = yield dut.bus.dat_r
+            yield Tick()
+            yield dut.bus.cyc.eq(0)
+            yield dut.bus.stb.eq(0)
+            return dat_r, clocks
+
+        def sim_test():
+            self.assertEqual((yield from access(1)), (0x04050607, 2))
+            yield from access(2, we=1, sel=0x9, dat_w=0xaabbccdd)
+            self.assertEqual((yield from access(2)), (0xaa090add, 2))
+            # back to back
+            yield dut.bus.adr.eq(3)
+            yield dut.bus.we.eq(0)
+            yield dut.bus.cyc.eq(1)
+            yield dut.bus.stb.eq(1)
+            yield Tick()
+            yield Delay(1e-9)
+            self.assertEqual(((yield dut.bus.ack), (yield dut.bus.dat_r)), (1, 0x0c0d0e0f))
+            yield dut.bus.adr.eq(4)
+            yield Tick()
+            yield Tick()
+            yield Delay(1e-9)
+            self.assertEqual(((yield dut.bus.ack), (yield dut.bus.dat_r)), (1, 0x10111213))
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(sim_test)
+        sim.run()
 
 if __name__ == "__main__":
     test = Test()
     test.test_simple()
     test.test_ram()
+    test.test_ram_bytes()
+    test.test_shadow()
+    test.test_shadow_image()
+    test.test_local()
@@ -1,34 +1,231 @@
 #include <iostream>
 #include <fstream>
+#include <cstdlib>
+#include <cstring>
+#include <chrono>
+#include <deque>
+#include <memory>
+#include <string>
 #include <backends/cxxrtl/cxxrtl_vcd.h>
 #include "top.cpp"
-    
+
 using namespace std;
-    
-int main()
+
+// usage: tb [options], numbers may be hex with 0x
+//   --cycles N         stop after N clocks (default 1000)
+//   --until-pc ADDR    stop at the first program fetch from ADDR
+//   --ignore-done      keep going after the benchmark done marker
+//   --progress N       print the simulation rate every N clocks
+//   --vcd FILE         trace to FILE, nothing is traced without it
+//   --trace-start N    trace from clock N
+//   --trace-end N      trace up to clock N
+//   --trace-pc ADDR    trace from the first program fetch from ADDR
+//   --trace-addr ADDR  trace from the first cpu access to ADDR
+//   --trace-length N   trace N clocks after the trigger
+//   --ring N           keep at least the last N clocks before the trigger,
+//                      or without a trigger the last N clocks of the trace
+// prints the counters, why it stopped and the simulation rate as one line
+// of json. the exit code is 0 if it stopped at the done marker or pc.
+
+// the longword the cpu last accessed, for the address triggers
+static bool access_at(cxxrtl_design::p_anubis &top, long addr, bool fetch)
 {
+  if (!(fetch ? top.p_sim__fetch : top.p_sim__access).get<bool>())
+    return false;
+  return top.p_sim__addr.get<uint32_t>() == (uint32_t)(addr & ~3);
+}
+
+// vcd written either straight to the file or, while ring is set, kept in
+// segments of which only the newest are written. every segment comes from a
+// new writer so it starts with all values and older ones can be dropped.
+struct tracer {
+  cxxrtl::debug_items &items;
+  ofstream file;
+  unique_ptr<cxxrtl::vcd_writer> vcd;
+  bool header = false;
+  bool ring = false;
+  size_t ring_segments = 0;
+  long segment_cycles = 0;
+  long segment_left = 0;
+  deque<string> segments;
+
+  tracer(cxxrtl::debug_items &items, const char *name, long ring_cycles)
+    : items(items), file(name)
+  {
+    if (ring_cycles > 0) {
+      segment_cycles = ring_cycles / 8 + 1;
+      ring_segments = 9;
+    }
+  }
+
+  void restart()
+  {
+    vcd.reset(new cxxrtl::vcd_writer);
+    vcd->timescale(1, "us");
+    vcd->add_without_memories(items);
+  }
+
+  // the header goes in once, at the top
+  void write(string &text)
+  {
+    size_t end = text.find("$enddefinitions $end\n");
+    if (header && end != string::npos)
+      text.erase(0, end + strlen("$enddefinitions $end\n"));
+    header = true;
+    file << text;
+    text.clear();
+  }
+
+  // one clock, two samples
+  void sample(long cycle, bool clk)
+  {
+    if (ring && !clk && segment_left-- == 0) {
+      if (vcd)
+        segments.push_back(std::move(vcd->buffer));
+      while (segments.size() > ring_segments)
+        segments.pop_front();
+      vcd.reset();
+      segment_left = segment_cycles - 1;
+    }
+    if (!vcd)
+      restart();
+    vcd->sample(cycle*2 + clk);
+    if (!ring && vcd->buffer.size() > (1 << 20))
+      write(vcd->buffer);
+  }
+
+  // write out the ring and go on straight to the file
+  void flush()
+  {
+    for (auto &segment : segments)
+      write(segment);
+    segments.clear();
+    if (vcd)
+      write(vcd->buffer);
+    if (ring)
+      vcd.reset();
+    ring = false;
+  }
+};
+
+int main(int argc, char **argv)
+{
+  long max_cycles = 1000;
+  long until_pc = -1;
+  bool ignore_done = false;
+  long progress = 0;
+  const char *vcd_name = nullptr;
+  long trace_start = 0;
+  long trace_end = -1;
+  long trace_pc = -1;
+  long trace_addr = -1;
+  long trace_length = -1;
+  long ring_cycles = 0;
+  for (int i = 1; i < argc; i++) {
+    string opt = argv[i];
+    if (opt == "--ignore-done") {
+      ignore_done = true;
+      continue;
+    }
+    if (i + 1 >= argc) {
+      cerr << "tb: " << opt << " needs a value" << endl;
+      return 2;
+    }
+    const char *value = argv[++i];
+    long n = strtol(value, nullptr, 0);
+    if (opt == "--cycles") max_cycles = n;
+    else if (opt == "--until-pc") until_pc = n;
+    else if (opt == "--progress") progress = n;
+    else if (opt == "--vcd") vcd_name = value;
+    else if (opt == "--trace-start") trace_start = n;
+    else if (opt == "--trace-end") trace_end = n;
+    else if (opt == "--trace-pc") trace_pc = n;
+    else if (opt == "--trace-addr") trace_addr = n;
+    else if (opt == "--trace-length") trace_length = n;
+    else if (opt == "--ring") ring_cycles = n;
+    else {
+      cerr << "tb: unknown option " << opt << endl;
+      return 2;
+    }
+  }
+
   cxxrtl_design::p_anubis top;
   cxxrtl::debug_items all_debug_items;
-  top.debug_info(all_debug_items);
-  cxxrtl::vcd_writer vcd;
-  vcd.timescale(1, "us");
-  vcd.add_without_memories(all_debug_items);
-  std::ofstream waves("waves_cxxrtl.vcd");
-  top.step();
-  vcd.sample(0);
-    
-  bool prev_led = 0;
-    
+  unique_ptr<tracer> trace;
+  if (vcd_name) {
+    top.debug_info(all_debug_items);
+    trace.reset(new tracer(all_debug_items, vcd_name, ring_cycles));
+  }
+  // without a trigger the trace is triggered at trace_start
+  bool has_trigger = trace_pc >= 0 || trace_addr >= 0;
+  bool triggered = !has_trigger;
+  long trace_stop = trace_end;
+  if (!has_trigger && trace_length >= 0 && (trace_stop < 0 || trace_start + trace_length < trace_stop))
+    trace_stop = trace_start + trace_length;
+
+  auto start = chrono::steady_clock::now();
+  auto seconds = [&]() {
+    return chrono::duration<double>(chrono::steady_clock::now() - start).count();
+  };
+
   top.step();
-  for(int cycle=0;cycle<1000;++cycle){
-    
+  long cycle;
+  const char *stop = "cycles";
+  for(cycle=0;cycle<max_cycles;++cycle){
+    bool window = trace && cycle >= trace_start && (trace_stop < 0 || cycle < trace_stop);
+    bool sampling = window && (triggered || ring_cycles > 0);
+    if (window && cycle == trace_start)
+      trace->ring = ring_cycles > 0;
+
     top.p_clk.set<bool>(false);
     top.step();
-    vcd.sample(cycle*2 + 0);
+    if (sampling)
+      trace->sample(cycle, false);
     top.p_clk.set<bool>(true);
     top.step();
-    vcd.sample(cycle*2 + 1);
-    waves << vcd.buffer;
-    vcd.buffer.clear();
+    if (sampling)
+      trace->sample(cycle, true);
+
+    if (window && !triggered &&
+        ((trace_pc >= 0 && access_at(top, trace_pc, true)) ||
+         (trace_addr >= 0 && access_at(top, trace_addr, false)))) {
+      triggered = true;
+      trace->flush();
+      if (trace_length >= 0 && (trace_stop < 0 || cycle + 1 + trace_length < trace_stop))
+        trace_stop = cycle + 1 + trace_length;
+    }
+    if (trace && cycle + 1 == trace_stop)
+      trace->flush();
+    if (progress && (cycle + 1) % progress == 0)
+      cerr << "cycle " << cycle + 1 << ", " << (long)((cycle + 1) / seconds()) << " cycles/s" << endl;
+    if (until_pc >= 0 && access_at(top, until_pc, true)) {
+      stop = "pc";
+      break;
+    }
+    if (!ignore_done && top.p_bench__done.get<bool>()) {
+      stop = "done";
+      break;
+    }
   }
+  double elapsed = seconds();
+  if (trace)
+    trace->flush();
+  // a break leaves cycle on the clock that was just run
+  long clocks = strcmp(stop, "cycles") != 0 ? cycle + 1 : cycle;
+
+  bool done = top.p_bench__done.get<bool>();
+  uint32_t insns = top.p_bench__insns.get<uint32_t>();
+  cout << "{\"done\": " << (done ? "true" : "false")
+       << ", \"stop\": \"" << stop << "\""
+       << ", \"clocks\": " << clocks
+       << ", \"reads\": " << top.p_bench__reads.get<uint32_t>()
+       << ", \"writes\": " << top.p_bench__writes.get<uint32_t>()
+       << ", \"host_cycles\": " << top.p_bench__host__cycles.get<uint32_t>()
+       << ", \"insns\": " << insns
+       << ", \"cpi\": " << (insns ? (double)clocks / insns : 0.0)
+       << ", \"pc\": " << top.p_sim__pc.get<uint32_t>()
+       << ", \"sim_seconds\": " << elapsed
+       << ", \"cycles_per_second\": " << (elapsed > 0 ? clocks / elapsed : 0.0)
+       << "}" << endl;
+  return strcmp(stop, "cycles") != 0 ? 0 : 1;
 }
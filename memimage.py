@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+
+# memory images for M68KROM, M68KRAM and ShadowROM initialization.
+# an image is a window of the address space, base to base + size, filled in
+# from raw binaries, s-records and elf files. words() converts it to the
+# big endian init list for a Memory, without a per word python loop.
+
+SREC_EXTENSIONS = (".srec", ".s19", ".s28", ".s37", ".mot", ".sx")
+
+_word_cache = {}
+
+def _read(path, offset=0, length=None):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0 or offset >= size:
+            return b""
+        end = size if length is None else min(size, offset + length)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[offset:end]
+
+def _typecode(width):
+    for code in "BHILQ":
+        if array.array(code).itemsize * 8 == width:
+            return code
+    raise ValueError("no array type for {} bit words".format(width))
+
+# big endian bytes to a list of width bit words, cached by content
+def to_words(data, width=16):
+    key = (hashlib.sha256(data).digest(), width)
+    words = _word_cache.get(key)
+    if words is None:
+        step = width // 8
+        if len(data) % step:
+            data = bytes(data) + bytes(step - len(data) % step)
+        a = array.array(_typecode(width))
+        a.frombytes(data)
+        if sys.byteorder == "little" and width > 8:
+            a.byteswap()
+        words = a.tolist()
+        _word_cache[key] = words
+    return words
+
+# yields (address, data) for the data records of a motorola s-record file
+def srec_records(text):
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != "S" or len(line) < 4:
+            raise ValueError("line {}: not an s-record".format(n))
+        record = bytes.fromhex(line[2:])
+        if len(record) != record[0] + 1 or sum(record) & 0xff != 0xff:
+            raise ValueError("line {}: bad length or checksum".format(n))
+        addr_len = {"1": 2, "2": 3, "3": 4}.get(line[1])
+        if addr_len is None:
+            continue
+        addr = int.from_bytes(record[1:1 + addr_len], "big")
+        yield addr, record[1 + addr_len:-1]
+
+# yields (physical address, data) for the PT_LOAD segments of an elf file
+def elf_segments(data):
+    if data[:4] != b"\x7fELF":
+        raise ValueError("not an elf file")
+    bits = {1: 32, 2: 64}[data[4]]
+    endian = {1: "<", 2: ">"}[data[5]]
+    if bits == 32:
+        phoff, = struct.unpack_from(endian + "I", data, 0x1c)
+        phentsize, phnum = struct.unpack_from(endian + "HH", data, 0x2a)
+        fmt = endian + "IIIIIIII"
+    else:
+        phoff, = struct.unpack_from(endian + "Q", data, 0x20)
+        phentsize, phnum = struct.unpack_from(endian + "HH", data, 0x36)
+        fmt = endian + "IIQQQQQQ"
+    for i in range(phnum):
+        fields = struct.unpack_from(fmt, data, phoff + i * phentsize)
+        if bits == 32:
+            p_type, p_offset, p_vaddr, p_paddr, p_filesz = fields[:5]
+        else:
+            p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = fields[:6]
+        if p_type == 1 and p_filesz:
+            yield p_paddr, data[p_offset:p_offset + p_filesz]
+
+class MemoryImage:
+    def __init__(self, size, base=0, fill=0):
+        self.base = base
+        self.size = size
+        self.data = bytearray([fill]) * size
+
+    # copies data to addr, clipped to the window
+    def add(self, data, addr):
+        start = max(addr, self.base)
+        end = min(addr + len(data), self.base + self.size)
+        if start < end:
+            self.data[start - self.base:end - self.base] = data[start - addr:end - addr]
+
+    # raw files go to addr, base by default, starting offset bytes into the
+    # file. s-records and elf files carry their own addresses.
+    def add_file(self, path, addr=None, offset=0, length=None):
+        if path.lower().endswith(SREC_EXTENSIONS):
+            with open(path) as f:
+                for a, data in srec_records(f.read()):
+                    self.add(data, a)
+            return
+        if _read(path, 0, 4) == b"\x7fELF":
+            for a, segment in elf_segments(_read(path)):
+                self.add(segment, a)
+        else:
+            self.add(_read(path, offset, length), self.base if addr is None else addr)
+
+    def words(self, width=16):
+        return to_words(bytes(self.data), width)
+
+# init list for a memory of size bytes at address base, from one file or a
+# list of (path, addr) or (path, addr, file_offset) segments. a single raw
+# file is read from file_offset, s-records and elf files are placed by their
+# own addresses.
+def load(source, size, file_offset=0, base=0, width=16, fill=0):
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        if not path.lower().endswith(SREC_EXTENSIONS) and _read(path, 0, 4) != b"\x7fELF":
+            return to_words(_read(path, file_offset, size), width)
+        image = MemoryImage(size, base=base, fill=fill)
+        image.add_file(path)
+    else:
+        image = MemoryImage(size, base=base, fill=fill)
+        for segment in source:
+            path, addr = segment[:2]
+            offset = segment[2] if len(segment) > 2 else 0
+            image.add_file(path, addr, offset)
+    return image.words(width)
+
+class Test(unittest.TestCase):
+    def tmpfile(self, data, suffix=""):
+        f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        f.write(data)
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        return f.name
+
+    def test_raw(self):
+        path = self.tmpfile(bytes(range(256)))
+        self.assertEqual(load(path, 8), [0x0001, 0x0203, 0x0405, 0x0607])
+        self.assertEqual(load(path, 8, file_offset=0x10), [0x1011, 0x1213, 0x1415, 0x1617])
+        self.assertEqual(load(path, 8, width=32), [0x00010203, 0x04050607])
+        # short files are padded out to a whole word
+        self.assertEqual(load(path, 8, file_offset=0xfd), [0xfdfe, 0xff00])
+        # same as the old per word conversion
+        data = os.urandom(4096)
+        path = self.tmpfile(data)
+        self.assertEqual(load(path, 4096), [data[i] << 8 | data[i + 1] for i in range(0, 4096, 2)])
+
+    def test_srec(self):
+        def record(kind, addr, data, addr_len):
+            body = bytes([addr_len + len(data) + 1]) + addr.to_bytes(addr_len, "big") + data
+            return "S%d%s%02X\n" % (kind, body.hex().upper(), 0xff - (sum(body) & 0xff))
+        text = "S00600004844521B\n" + record(2, 0xfe0004, b"\x12\x34\x56", 3) + record(3, 0xfe0000, b"\xab", 4)
+        path = self.tmpfile(text.encode(), ".srec")
+        self.assertEqual(load(path, 8, base=0xfe0000), [0xab00, 0x0000, 0x1234, 0x5600])
+        bad = self.tmpfile(text.replace("1B", "1C").encode(), ".s28")
+        with self.assertRaises(ValueError):
+            load(bad, 8)
+
+    def test_elf(self):
+        # 32 bit big endian with two PT_LOAD segments and a PT_NOTE
+        phoff = 52
+        segments = [(1, 0x100, 0xfe0002, b"\x11\x22"), (4, 0x110, 0, b"\x99"),
+                    (1, 0x120, 0xfe0006, b"\x33\x44\x55")]
+        data = bytearray(0x200)
+        data[:16] = b"\x7fELF\x01\x02\x01" + bytes(9)
+        struct.pack_into(">I", data, 0x1c, phoff)
+        struct.pack_into(">HH", data, 0x2a, 32, len(segments))
+        for i, (p_type, offset, paddr, content) in enumerate(segments):
+            struct.pack_into(">IIIIIIII", data, phoff + i * 32, p_type, offset, paddr, paddr,
+                             len(content), len(content), 5, 4)
+            data[offset:offset + len(content)] = content
+        path = self.tmpfile(bytes(data), ".elf")
+        self.assertEqual(load(path, 8, base=0xfe0000, fill=0xff),
+                         [0xffff, 0x1122, 0xffff, 0x3344])
+
+    def test_segments(self):
+        a = self.tmpfile(b"\xaa" * 16)
+        b = self.tmpfile(b"\x00\x01\x02\x03\xbb\xbb")
+        words = load([(a, 0x100), (b, 0x104, 4)], 16, base=0x100)
+        self.assertEqual(words, [0xaaaa, 0xaaaa, 0xbbbb, 0xaaaa, 0xaaaa, 0xaaaa, 0xaaaa, 0xaaaa])
+
+    def test_cache(self):
+        path = self.tmpfile(os.urandom(1024))
+        self.assertIs(load(path, 1024), load(path, 1024))
+        self.assertIsNot(load(path, 1024, width=32), load(path, 1024))
+
+# elaboration time for large memories, old per word conversion against
+# load(), and the nmigen Memory built from it
+def benchmark(sizes):
+    from nmigen import Memory
+    for size in sizes:
+        path = tempfile.NamedTemporaryFile(delete=False).name
+        try:
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                byte_content = f.read(size)
+            old = [byte_content[i] << 8 | byte_content[i + 1] for i in range(0, size, 2)]
+            t_old = time.perf_counter() - start
+            _word_cache.clear()
+            start = time.perf_counter()
+            new = load(path, size)
+            t_new = time.perf_counter() - start
+            start = time.perf_counter()
+            load(path, size)
+            t_cached = time.perf_counter() - start
+            assert old == new
+            start = time.perf_counter()
+            Memory(width=16, depth=size // 2, init=new)
+            t_mem = time.perf_counter() - start
+            print("{:5d}KB: per word {:7.1f}ms, load {:6.1f}ms, cached {:6.1f}ms, Memory() {:8.1f}ms".format(
+                size // 1024, t_old * 1e3, t_new * 1e3, t_cached * 1e3, t_mem * 1e3))
+        finally:
+            os.unlink(path)
+
+if __name__ == "__main__":
+    benchmark([int(kb) * 1024 for kb in sys.argv[1:]] or [128, 1024, 4096])
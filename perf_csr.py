@@ -0,0 +1,147 @@
+import unittest
+from nmigen import *
+from nmigen.lib.cdc import PulseSynchronizer
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from wb_to_68k import WishboneTo68000
+
+
+# cpu readable copy of the WishboneTo68000 performance counters.
+# 0x00: write bit 0 to snapshot, bit 1 to clear the counters, both may be set.
+#       reads back bit 0 set once the snapshot has been taken.
+# 0x04 onwards: the counters in bridge.perf order, 32 bits each, then those
+#       of each of extra, which count in the sync domain.
+# the snapshot registers only change on a snapshot, so they are read across
+# the clock domains without synchronizing.
+class PerfCSR(Elaboratable):
+    def __init__(self, bridge, o_domain="bus", extra=[]):
+        self.bridge = bridge
+        self.o_domain = o_domain
+        self.extra = extra
+        self.bus = wishbone.Interface(addr_width = 6, data_width = 32, granularity = 8)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.snapshot_sync = snapshot_sync = PulseSynchronizer("sync", self.o_domain)
+        m.submodules.clear_sync = clear_sync = PulseSynchronizer("sync", self.o_domain)
+        m.submodules.done_sync = done_sync = PulseSynchronizer(self.o_domain, "sync")
+        m.d.comb += [
+            self.bridge.perf_snapshot.eq(snapshot_sync.o),
+            self.bridge.perf_clear.eq(clear_sync.o),
+            done_sync.i.eq(snapshot_sync.o),
+        ]
+        counters = list(self.bridge.perf)
+        for source in self.extra:
+            counters += source.perf
+
+        valid = Signal()
+        ack = Signal()
+        with m.If(done_sync.o):
+            m.d.sync += valid.eq(1)
+
+        m.d.sync += ack.eq(self.bus.cyc & self.bus.stb & ~ack)
+        m.d.comb += self.bus.ack.eq(ack)
+        with m.Switch(self.bus.adr):
+            with m.Case(0):
+                m.d.comb += self.bus.dat_r.eq(valid)
+            for i, (name, counter) in enumerate(counters):
+                with m.Case(i + 1):
+                    m.d.comb += self.bus.dat_r.eq(counter)
+
+        with m.If(self.bus.cyc & self.bus.stb & self.bus.we & ~ack &
+                  (self.bus.adr == 0) & self.bus.sel[0]):
+            m.d.comb += snapshot_sync.i.eq(self.bus.dat_w[0])
+            m.d.comb += clear_sync.i.eq(self.bus.dat_w[1])
+            for source in self.extra:
+                m.d.comb += source.perf_snapshot.eq(self.bus.dat_w[0])
+                m.d.comb += source.perf_clear.eq(self.bus.dat_w[1])
+            with m.If(self.bus.dat_w[0]):
+                m.d.sync += valid.eq(0)
+
+        return m
+
+class Test(unittest.TestCase):
+    def test_simple(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        bridge = WishboneTo68000(wb, Signal(3), Signal(3), write_depth=0)
+        dut = PerfCSR(bridge, o_domain="sync")
+        m = Module()
+        m.submodules.bridge = bridge
+        m.submodules.dut = dut
+        names = [name for name, counter in bridge.perf]
+
+        # two clocks of wait states on every 68000 cycle
+        def bus():
+            yield Passive()
+            waited = 0
+            while True:
+                yield Tick()
+                yield Settle()
+                if ((yield bridge.uds_) & (yield bridge.lds_)) == 0:
+                    waited += 1
+                    yield bridge.dtack_.eq(waited <= 2)
+                else:
+                    waited = 0
+                    yield bridge.dtack_.eq(1)
+
+        def access(bus, adr, we=0, sel=0xf, dat=0):
+            yield bus.adr.eq(adr)
+            yield bus.we.eq(we)
+            yield bus.sel.eq(sel)
+            yield bus.dat_w.eq(dat)
+            yield bus.cyc.eq(1)
+            yield bus.stb.eq(1)
+            yield Delay(1e-9)
+            while (yield bus.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+            dat_r = yield bus.dat_r
+            yield Tick()
+            yield bus.cyc.eq(0)
+            yield bus.stb.eq(0)
+            return dat_r
+
+        def read_counters():
+            yield from access(dut.bus, 0, we=1, sel=0x1, dat=0x1)
+            while (yield from access(dut.bus, 0)) != 1:
+                pass
+            counters = {}
+            for i, name in enumerate(names):
+                counters[name] = yield from access(dut.bus, i + 1)
+            return counters
+
+        def sim_test():
+            # the clear takes a few clocks to get through the synchronizer
+            yield from access(dut.bus, 0, we=1, sel=0x1, dat=0x2)
+            for i in range(4):
+                yield Tick()
+            yield from access(wb, 0x100)
+            yield from access(wb, 0x100, sel=0x1)
+            yield from access(wb, 0x100, we=1, sel=0x3)
+            counters = yield from read_counters()
+            self.assertEqual(counters["reads"], 2)
+            self.assertEqual(counters["writes"], 1)
+            self.assertEqual(counters["longwords"], 1)
+            self.assertEqual(counters["bytes"], 1)
+            # four 68000 cycles, two clocks of waiting each
+            self.assertEqual(counters["dtack_wait0"] + counters["dtack_wait1"], 8)
+            self.assertEqual(counters["dtack_latency2"], 4)
+            self.assertEqual(sum(counters["dtack_latency%d" % i] for i in range(8)), 4)
+            self.assertGreater(counters["clocks"], 16)
+            # snapshot and clear, counting starts again from zero
+            yield from access(dut.bus, 0, we=1, sel=0x1, dat=0x3)
+            for i in range(4):
+                yield Tick()
+            yield from access(wb, 0x100, sel=0x1)
+            counters = yield from read_counters()
+            self.assertEqual(counters["reads"], 1)
+            self.assertEqual(counters["dtack_latency2"], 1)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(bus)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
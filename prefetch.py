@@ -0,0 +1,271 @@
+import unittest
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from wb_util import connect_wishbone
+from regions import RegionDecoder, x68000_regions
+
+
+# sequential read ahead for program fetches on the way to the host bus.
+# after a program space read (program_fc) from a prefetchable range the next
+# longword is read into a one entry buffer while the cpu executes, and a
+# fetch of it is acked in the same cycle. a fetch of the longword still being
+# read gets the data as soon as it arrives. anything else waits for the
+# prefetch to finish and then goes through, a program fetch elsewhere (a
+# branch) starts over from there. writes to the buffered longword drop it,
+# and invalidate drops the buffer, and any prefetch it overlapped, while
+# another master owns the bus.
+# prefetchable is a list of (start, end) byte address ranges, end exclusive.
+# the default is main ram and the ipl rom, never i/o. with a RegionMap as
+# regions its prefetchable regions are used instead.
+class Prefetcher(Elaboratable):
+    def __init__(self, wb, wb_fc, prefetchable=[(0x000000, 0xc00000), (0xfe0000, 0x1000000)],
+                 program_fc=[2, 6], regions=None):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.prefetchable = prefetchable
+        self.program_fc = program_fc
+        self.regions = regions
+        self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.fc = Signal(3)
+        self.invalidate = Signal()
+        self.perf_snapshot = Signal()
+        self.perf_clear = Signal()
+        names = ["prefetches", "prefetch_hits", "prefetch_discards"]
+        self.perf = [(name, Signal(32, name="perf_" + name)) for name in names]
+        self.perf_live = {name: Signal(32, name="count_" + name) for name in names}
+
+    def elaborate(self, platform):
+        m = Module()
+        addr = Signal(24) # 68000 byte address
+        m.d.comb += addr.eq(self.wb.adr << 2)
+        request = Signal()
+        fetch = Signal()
+        next_ok = Signal()
+        m.d.comb += request.eq(self.wb.cyc & self.wb.stb)
+        m.d.comb += fetch.eq(~self.wb.we & Cat(self.wb_fc == fc for fc in self.program_fc).any())
+        # the next longword is in the same range as this one
+        if self.regions is not None:
+            m.submodules.regions = regions = RegionDecoder(self.regions)
+            m.d.comb += regions.addr.eq(addr + 4)
+            m.d.comb += next_ok.eq(regions.prefetchable & (self.wb.adr[:22] != 0x3fffff))
+        else:
+            m.d.comb += next_ok.eq(Cat((addr >= start) & (addr + 4 < end)
+                                       for start, end in self.prefetchable).any())
+
+        pf_adr = Signal(30)
+        pf_fc = Signal(3)
+        inflight = Signal()
+        buf_valid = Signal()
+        buf_used = Signal()
+        buf_adr = Signal(30)
+        buf_fc = Signal(3)
+        buf_data = Signal(32)
+        hit = Signal()
+        inflight_hit = Signal()
+        discard = Signal()
+        m.d.comb += hit.eq(request & fetch & buf_valid & (buf_adr == self.wb.adr) & (buf_fc == self.wb_fc))
+        m.d.comb += inflight_hit.eq(request & fetch & (pf_adr == self.wb.adr) & (pf_fc == self.wb_fc))
+
+        def start(adr):
+            with m.If(next_ok):
+                m.d.sync += inflight.eq(1)
+                m.d.sync += pf_adr.eq(adr + 1)
+                m.d.sync += pf_fc.eq(self.wb_fc)
+
+        # the ack of a prefetch comes back through the cdc and may arrive
+        # after invalidate has dropped again, so remember it until then
+        stale = Signal()
+        drop = Signal()
+        m.d.comb += drop.eq(self.invalidate | stale)
+        with m.If(~inflight | self.bus.ack | self.bus.err | self.bus.rty):
+            m.d.sync += stale.eq(0)
+        with m.Elif(self.invalidate):
+            m.d.sync += stale.eq(1)
+
+        with m.If(inflight):
+            m.d.comb += [
+                self.bus.adr.eq(pf_adr),
+                self.bus.sel.eq(0xf),
+                self.bus.cyc.eq(1),
+                self.bus.stb.eq(1),
+                self.fc.eq(pf_fc),
+            ]
+            with m.If(self.bus.ack):
+                m.d.sync += inflight.eq(0)
+                with m.If(inflight_hit & ~drop):
+                    m.d.comb += self.wb.ack.eq(1)
+                    m.d.comb += self.wb.dat_r.eq(self.bus.dat_r)
+                    start(pf_adr)
+                with m.Elif(~drop):
+                    m.d.comb += discard.eq(buf_valid & ~buf_used)
+                    m.d.sync += [
+                        buf_valid.eq(1),
+                        buf_used.eq(0),
+                        buf_adr.eq(pf_adr),
+                        buf_fc.eq(pf_fc),
+                        buf_data.eq(self.bus.dat_r),
+                    ]
+            with m.If(self.bus.err | self.bus.rty):
+                m.d.sync += inflight.eq(0)
+        with m.Elif(hit):
+            m.d.comb += self.wb.ack.eq(1)
+            m.d.comb += self.wb.dat_r.eq(buf_data)
+            m.d.sync += buf_used.eq(1)
+            start(buf_adr)
+        with m.Else():
+            connect_wishbone(m, self.wb, self.bus, self.wb_fc, self.fc)
+            with m.If(request & self.bus.ack):
+                with m.If(fetch):
+                    start(self.wb.adr)
+                with m.If(self.wb.we & (self.wb.adr == buf_adr)):
+                    m.d.comb += discard.eq(buf_valid & ~buf_used)
+                    m.d.sync += buf_valid.eq(0)
+        with m.If(self.invalidate):
+            m.d.comb += discard.eq(buf_valid & ~buf_used)
+            m.d.sync += buf_valid.eq(0)
+
+        events = [
+            inflight & self.bus.ack,
+            hit | (inflight & self.bus.ack & inflight_hit & ~drop),
+            discard,
+        ]
+        for (name, snapshot), event in zip(self.perf, events):
+            counter = self.perf_live[name]
+            with m.If(self.perf_clear):
+                m.d.sync += counter.eq(0)
+            with m.Elif(event):
+                m.d.sync += counter.eq(counter + 1)
+            with m.If(self.perf_snapshot):
+                m.d.sync += snapshot.eq(counter)
+
+        return m
+
+class Test(unittest.TestCase):
+    def test_simple(self):
+        self.check_simple()
+
+    def test_regions(self):
+        # same prefetchable ranges as the default, from the region lookup
+        self.check_simple(x68000_regions())
+
+    def check_simple(self, regions=None):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        dut = Prefetcher(wb, wb_fc, regions=regions)
+        seen = []
+
+        # two clocks of wait states
+        def host():
+            yield Passive()
+            waited = 0
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.bus.ack):
+                    yield dut.bus.ack.eq(0)
+                    waited = 0
+                    continue
+                if (yield dut.bus.cyc) & (yield dut.bus.stb):
+                    if waited == 0:
+                        seen.append(((yield dut.bus.adr), (yield dut.bus.we), (yield dut.fc)))
+                    waited += 1
+                    if waited > 2:
+                        yield dut.bus.dat_r.eq((yield dut.bus.adr) * 3)
+                        yield dut.bus.ack.eq(1)
+                else:
+                    waited = 0
+
+        def access(adr, fc=6, we=0, idle=0):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.sel.eq(0xf)
+            yield wb_fc.eq(fc)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            clocks = 1
+            while (yield wb.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+                clocks += 1
+            dat_r = yield wb.dat_r
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            # the cpu executing
+            for i in range(idle):
+                yield Tick()
+            return dat_r, clocks
+
+        def sim_test():
+            # straight line code, every fetch after the first is a buffer hit
+            yield from access(0x100, idle=6)
+            for i in range(1, 4):
+                dat_r, clocks = yield from access(0x100 + i, idle=6)
+                self.assertEqual((dat_r, clocks), ((0x100 + i) * 3, 1))
+            # a fetch of the longword being prefetched waits for it, no
+            # second read is made
+            dat_r, clocks = yield from access(0x104)
+            self.assertEqual(dat_r, 0x104 * 3)
+            self.assertEqual([s[0] for s in seen], list(range(0x100, 0x105)))
+            for i in range(6):
+                yield Tick()
+            del seen[:]
+            # a branch goes through after the prefetch, data reads and i/o
+            # are never prefetched
+            yield from access(0x200)
+            yield from access(0x300, fc=5, idle=6)
+            yield from access((0xe88000 >> 2), fc=6, idle=6)
+            self.assertEqual(seen, [(0x200, 0, 6), (0x201, 0, 6), (0x300, 0, 5),
+                                    (0xe88000 >> 2, 0, 6)])
+            # a write drops the buffered longword
+            del seen[:]
+            yield from access(0x400, idle=6)
+            yield from access(0x401, we=1, fc=5)
+            dat_r, clocks = yield from access(0x401)
+            self.assertGreater(clocks, 1)
+            # so does a bus grant
+            yield from access(0x500, idle=6)
+            yield dut.invalidate.eq(1)
+            yield Tick()
+            yield dut.invalidate.eq(0)
+            dat_r, clocks = yield from access(0x501)
+            self.assertEqual(dat_r, 0x501 * 3)
+            self.assertGreater(clocks, 1)
+            # and a grant that ends before the prefetch it overlapped
+            # finishes, neither fills the buffer nor answers a fetch
+            yield from access(0x600)
+            yield dut.invalidate.eq(1)
+            yield Tick()
+            yield dut.invalidate.eq(0)
+            dat_r, clocks = yield from access(0x601)
+            self.assertEqual(dat_r, 0x601 * 3)
+            self.assertGreater(clocks, 4)
+            yield from access(0x700)
+            yield dut.invalidate.eq(1)
+            yield Tick()
+            yield dut.invalidate.eq(0)
+            for i in range(6):
+                yield Tick()
+            dat_r, clocks = yield from access(0x701)
+            self.assertEqual(dat_r, 0x701 * 3)
+            self.assertGreater(clocks, 1)
+            yield dut.perf_snapshot.eq(1)
+            yield Tick()
+            yield dut.perf_snapshot.eq(0)
+            yield Tick()
+            perf = {}
+            for name, snapshot in dut.perf:
+                perf[name] = yield snapshot
+            self.assertEqual(perf["prefetch_hits"], 4)
+            self.assertGreater(perf["prefetch_discards"], 1)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(host)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
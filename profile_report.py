@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# flat profile from the pc samples of profiler.PCProfiler. reads a dump
+# saved from the uart, or with --port runs the profiler for a while over a
+# serial port (needs pyserial) and reads it from there. prints the hottest
+# address ranges of bucket bytes, named from symbols if given: an elf, read
+# with the m68k binutils nm, or the output of nm -n.
+
+import argparse
+import bisect
+import collections
+import subprocess
+import sys
+import time
+
+def records(dump):
+    value = None
+    for byte in dump:
+        if byte & 0x80:
+            value, left = byte & 0x7f, 3
+        elif value is not None:
+            value, left = value << 7 | byte, left - 1
+            if left == 0:
+                yield value
+                value = None
+
+def capture(port, baud, seconds, interval, cpu_freq):
+    import serial
+    clocks = int(interval * cpu_freq)
+    if not 0 < clocks < 1 << 24:
+        raise ValueError("the interval is 1 to 2**24-1 clocks")
+    with serial.Serial(port, baud, timeout=0.5) as s:
+        s.write(b"p")
+        s.write(b"c")
+        s.write(b"i" + bytes([clocks >> 16 & 0xff, clocks >> 8 & 0xff, clocks & 0xff]))
+        time.sleep(0.1)
+        s.reset_input_buffer()
+        s.write(b"s")
+        dump = bytearray()
+        end = time.time() + seconds
+        while time.time() < end:
+            dump += s.read(max(s.in_waiting, 1))
+        s.write(b"p")
+        # the rest of the fifo and the status record
+        while True:
+            data = s.read(4096)
+            if not data:
+                break
+            dump += data
+        return bytes(dump)
+
+def load_symbols(filename, nm):
+    with open(filename, "rb") as f:
+        elf = f.read(4) == b"\x7fELF"
+    if elf:
+        text = subprocess.run([nm, "-n", filename], stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout
+    else:
+        with open(filename) as f:
+            text = f.read()
+    symbols = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] in "tTwW":
+            symbols.append((int(fields[0], 16) & 0xffffff, fields[2]))
+    return sorted(symbols)
+
+def symbolize(symbols, addr):
+    i = bisect.bisect_right([s[0] for s in symbols], addr) - 1
+    if i < 0:
+        return ""
+    base, name = symbols[i]
+    return "{}+0x{:x}".format(name, addr - base)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dump", nargs="?", help="raw bytes from the profiler uart")
+    parser.add_argument("--port", help="capture from this serial port instead")
+    parser.add_argument("--baud", type=int, default=1000000)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=100e-6, help="seconds between samples")
+    parser.add_argument("--cpu-freq", type=float, default=50e6)
+    parser.add_argument("-o", "--output", help="save the captured dump here")
+    parser.add_argument("--bucket", type=lambda x: int(x, 0), default=64, help="bytes per address range")
+    parser.add_argument("--symbols", help="elf or nm -n output")
+    parser.add_argument("--nm", default="m68k-linux-gnu-nm")
+    parser.add_argument("-n", "--top", type=int, default=40)
+    args = parser.parse_args()
+
+    if args.port:
+        dump = capture(args.port, args.baud, args.seconds, args.interval, args.cpu_freq)
+        if args.output:
+            with open(args.output, "wb") as f:
+                f.write(dump)
+    elif args.dump:
+        with open(args.dump, "rb") as f:
+            dump = f.read()
+    else:
+        parser.error("a dump file or --port is needed")
+    symbols = load_symbols(args.symbols, args.nm) if args.symbols else []
+
+    hist = collections.Counter()
+    dropped = 0
+    for record in records(dump):
+        if record & (1 << 27):
+            dropped = record & ((1 << 27) - 1)
+        else:
+            addr = (record & 0x3fffff) << 2
+            hist[addr - addr % args.bucket] += 1
+    total = sum(hist.values())
+    print("{} samples, {} dropped".format(total, dropped))
+    if total == 0:
+        sys.exit(1)
+    cumulative = 0
+    print("{:>8} {:>7} {:>7}  {:17} {}".format("samples", "%", "cum %", "range", "symbol"))
+    for addr, count in hist.most_common(args.top):
+        cumulative += count
+        print("{:8d} {:7.2f} {:7.2f}  {:06x}-{:06x}    {}".format(
+            count, 100 * count / total, 100 * cumulative / total, addr, addr + args.bucket - 1,
+            symbolize(symbols, addr)))
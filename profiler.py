@@ -0,0 +1,214 @@
+import unittest
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from uart import UARTTx, UARTRx
+
+
+# pc sampling profiler. while running, every interval clocks the longword
+# address of the latest program fetch on the cpu bus is queued in a block
+# ram fifo and sent out of the uart. it only watches the bus, so the cpu
+# runs exactly as it would without it. samples that find the fifo full are
+# dropped and counted.
+# commands on rx, one byte each: "s" start, "p" stop, "c" clear (empties the
+# fifo and zeroes the dropped count), "i" and three more bytes, most
+# significant first, sets the interval in clocks.
+# records are four bytes of 7 bits, the first one with bit 7 set, 28 bits
+# most significant first. bit 27 clear: a sample, the longword address in
+# bits 0-21. bit 27 set: the dropped count in bits 0-26, sent on every stop.
+class PCProfiler(Elaboratable):
+    def __init__(self, wb, wb_fc, divisor, interval=4000, depth=2048, program_fc=[2, 6]):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.divisor = divisor
+        self.depth = depth
+        self.program_fc = program_fc
+        self.interval = Signal(24, reset = interval)
+        self.running = Signal()
+        self.dropped = Signal(27)
+        self.tx = Signal(reset = 1)
+        self.rx = Signal(reset = 1)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.uart_tx = uart_tx = UARTTx(self.divisor)
+        m.submodules.uart_rx = uart_rx = UARTRx(self.divisor)
+        m.d.comb += self.tx.eq(uart_tx.tx)
+        m.d.comb += uart_rx.rx.eq(self.rx)
+        clear = Signal()
+        fifo = SyncFIFOBuffered(width=28, depth=self.depth)
+        m.submodules.fifo = ResetInserter(clear)(fifo)
+
+        # latest program fetch
+        pc = Signal(22)
+        seen = Signal()
+        with m.If(self.wb.cyc & self.wb.stb & Cat(self.wb_fc == fc for fc in self.program_fc).any()):
+            m.d.sync += pc.eq(self.wb.adr)
+            m.d.sync += seen.eq(1)
+
+        # commands
+        arg_count = Signal(2)
+        status = Signal()
+        with m.If(uart_rx.valid):
+            with m.If(arg_count != 0):
+                m.d.sync += self.interval.eq(Cat(uart_rx.data, self.interval[:16]))
+                m.d.sync += arg_count.eq(arg_count - 1)
+            with m.Elif(uart_rx.data == ord("s")):
+                m.d.sync += self.running.eq(1)
+            with m.Elif(uart_rx.data == ord("p")):
+                m.d.sync += self.running.eq(0)
+                m.d.sync += status.eq(1)
+            with m.Elif(uart_rx.data == ord("c")):
+                m.d.comb += clear.eq(1)
+                m.d.sync += self.dropped.eq(0)
+                m.d.sync += status.eq(0)
+            with m.Elif(uart_rx.data == ord("i")):
+                m.d.sync += arg_count.eq(3)
+
+        # sampling
+        timer = Signal(24)
+        with m.If(~self.running | (timer == 0)):
+            m.d.sync += timer.eq(self.interval - 1)
+        with m.Else():
+            m.d.sync += timer.eq(timer - 1)
+        with m.If(self.running & (timer == 0) & seen):
+            m.d.comb += fifo.w_data.eq(pc)
+            m.d.comb += fifo.w_en.eq(1)
+            with m.If(~fifo.w_rdy):
+                m.d.sync += self.dropped.eq(self.dropped + 1)
+        with m.Elif(status & ~clear):
+            m.d.comb += fifo.w_data.eq(Cat(self.dropped, 1))
+            m.d.comb += fifo.w_en.eq(1)
+            with m.If(fifo.w_rdy):
+                m.d.sync += status.eq(0)
+
+        # records out, seven bits at a time
+        record = Signal(28)
+        left = Signal(range(5))
+        m.d.comb += uart_tx.data.eq(Cat(record[21:28], left == 4))
+        m.d.comb += uart_tx.valid.eq(left != 0)
+        with m.If(left == 0):
+            m.d.comb += fifo.r_en.eq(1)
+            with m.If(fifo.r_rdy):
+                m.d.sync += record.eq(fifo.r_data)
+                m.d.sync += left.eq(4)
+        with m.Elif(uart_tx.ready):
+            m.d.sync += record.eq(record << 7)
+            m.d.sync += left.eq(left - 1)
+        with m.If(clear):
+            m.d.sync += left.eq(0)
+
+        return m
+
+class Test(unittest.TestCase):
+    def test_simple(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        dut = PCProfiler(wb, wb_fc, divisor=4, interval=100, depth=16)
+        m = Module()
+        m.submodules.dut = dut
+        m.submodules.host_tx = host_tx = UARTTx(4)
+        m.submodules.host_rx = host_rx = UARTRx(4)
+        m.d.comb += dut.rx.eq(host_tx.tx)
+        m.d.comb += host_rx.rx.eq(dut.tx)
+        received = []
+
+        def receiver():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield host_rx.valid):
+                    received.append((yield host_rx.data))
+
+        def records():
+            out = []
+            for i in range(0, len(received) - 3, 4):
+                self.assertEqual([b >> 7 for b in received[i:i + 4]], [1, 0, 0, 0])
+                value = 0
+                for b in received[i:i + 4]:
+                    value = value << 7 | (b & 0x7f)
+                out.append(value)
+            return out
+
+        def send(byte):
+            yield host_tx.data.eq(byte)
+            yield host_tx.valid.eq(1)
+            yield Settle()
+            while not (yield host_tx.ready):
+                yield Tick()
+                yield Settle()
+            yield Tick()
+            yield host_tx.valid.eq(0)
+            # through the receiver
+            for i in range(50):
+                yield Tick()
+
+        def cpu():
+            yield Passive()
+            adr = 0x3f8000
+            while True:
+                # a program fetch, then a data read
+                yield wb.adr.eq(adr)
+                yield wb_fc.eq(6)
+                yield wb.cyc.eq(1)
+                yield wb.stb.eq(1)
+                yield Tick()
+                yield wb_fc.eq(5)
+                yield wb.adr.eq(0x1234)
+                yield Tick()
+                yield wb.cyc.eq(0)
+                yield wb.stb.eq(0)
+                for i in range(40):
+                    yield Tick()
+                adr += 1
+
+        def sim_test():
+            for i in range(500):
+                yield Tick()
+            # nothing is sent until started
+            self.assertEqual(received, [])
+            yield from send(ord("i"))
+            for b in (0, 0, 200):
+                yield from send(b)
+            self.assertEqual((yield dut.interval), 200)
+            yield from send(ord("s"))
+            for i in range(2000):
+                yield Tick()
+            yield from send(ord("p"))
+            for i in range(1000):
+                yield Tick()
+            samples = records()
+            self.assertEqual(samples[-1], 1 << 27)
+            samples = samples[:-1]
+            self.assertGreater(len(samples), 8)
+            # fetch addresses, going up
+            for s in samples:
+                self.assertEqual(s & 0x3fc000, 0x3f8000)
+            self.assertEqual(samples, sorted(samples))
+            # a slow uart drops samples and reports how many
+            del received[:]
+            yield from send(ord("c"))
+            yield from send(ord("i"))
+            for b in (0, 0, 10):
+                yield from send(b)
+            yield from send(ord("s"))
+            for i in range(3000):
+                yield Tick()
+            yield from send(ord("p"))
+            for i in range(3000):
+                yield Tick()
+            status = records()[-1]
+            self.assertEqual(status >> 27, 1)
+            self.assertGreater(status & ((1 << 27) - 1), 0)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(receiver)
+        sim.add_sync_process(cpu)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
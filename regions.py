@@ -0,0 +1,181 @@
+import unittest
+from nmigen import *
+from nmigen.sim import *
+
+
+# the 68000 address map as data. a Region is a byte address window with
+# where accesses to it go and how they may be treated:
+#   target: "ext" for the host bus, or the name of a local target ("sdram",
+#           "bram", ...) that the System connects
+#   cacheable: reads may be kept in the cache
+#   posted: writes may be acked before they reach the host
+#   prefetchable: program fetches may read ahead
+#   min_wait: the fewest clocks the host takes to assert dtack
+class Region:
+    def __init__(self, name, base, size, target="ext", cacheable=False, posted=False,
+                 prefetchable=False, min_wait=0):
+        self.name = name
+        self.base = base
+        self.size = size
+        self.target = target
+        self.cacheable = cacheable
+        self.posted = posted
+        self.prefetchable = prefetchable
+        self.min_wait = min_wait
+
+    def __repr__(self):
+        return "Region({!r}, 0x{:06x}, 0x{:x}, {!r})".format(self.name, self.base, self.size, self.target)
+
+# a list of regions on granularity sized boundaries. addresses outside all of
+# them belong to default, an uncached, unposted host window.
+class RegionMap:
+    def __init__(self, regions, granularity=16, default=None):
+        self.regions = sorted(regions, key=lambda r: r.base)
+        self.granularity = granularity
+        self.default = default or Region("default", 0, 1 << 24)
+        end = 0
+        for r in self.regions:
+            if (r.base | r.size) & ((1 << granularity) - 1):
+                raise ValueError("{} is not on a {} byte boundary".format(r, 1 << granularity))
+            if r.base < end:
+                raise ValueError("{} overlaps the region before it".format(r))
+            end = r.base + r.size
+        if end > 1 << 24:
+            raise ValueError("regions end past 0x1000000")
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def lookup(self, addr):
+        for r in self.regions:
+            if r.base <= addr < r.base + r.size:
+                return r
+        return self.default
+
+    def index(self, name):
+        return [r.name for r in self.regions].index(name)
+
+    # (start, end) byte address ranges, end exclusive, of the regions where
+    # pred is true. pred is an attribute name or a function of a Region.
+    # neighbouring ranges are merged.
+    def ranges(self, pred):
+        if isinstance(pred, str):
+            attr = pred
+            pred = lambda r: getattr(r, attr)
+        ranges = []
+        for r in self.regions:
+            if not pred(r):
+                continue
+            if ranges and ranges[-1][1] == r.base:
+                ranges[-1] = (ranges[-1][0], r.base + r.size)
+            else:
+                ranges.append((r.base, r.base + r.size))
+        return ranges
+
+    # one entry per granule: region index (len(regions) for default) and the
+    # attribute bits, as laid out by RegionDecoder
+    def table(self):
+        entries = []
+        for g in range(1 << (24 - self.granularity)):
+            r = self.lookup(g << self.granularity)
+            index = self.regions.index(r) if r is not self.default else len(self.regions)
+            entries.append(index | r.cacheable << 8 | r.posted << 9 | r.prefetchable << 10 |
+                           min(r.min_wait, 15) << 11)
+        return entries
+
+# the x68000 map. local_ram is the (base, size) of main ram served from the
+# sdram, shadow_rom puts the ipl rom in block ram. host main ram is only
+# cacheable with cache_host_ram, the dmac writes it behind the cpu's back and
+# the cache then relies on the writes the bridge snoops while the bus is
+# granted. video ram is never cached, the crtc raster copy, fast clear and
+# multi-plane writes change it without a host bus cycle the fpga can see.
+def x68000_regions(local_ram=(0x200000, 0xa00000), shadow_rom=True, cache_host_ram=False):
+    ram = [(0x000000, 0xc00000)]
+    if local_ram is not None:
+        base, size = local_ram
+        ram = [(0x000000, base), (base, base + size), (base + size, 0xc00000)]
+    regions = []
+    for start, end in ram:
+        if end > start:
+            local = local_ram is not None and start == local_ram[0]
+            regions.append(Region("sdram" if local else "main_ram", start, end - start,
+                                  "sdram" if local else "ext",
+                                  cacheable=local or cache_host_ram, posted=True,
+                                  prefetchable=True))
+    regions += [
+        Region("gvram", 0xc00000, 0x200000, posted=True, min_wait=1),
+        Region("tvram", 0xe00000, 0x080000, posted=True, min_wait=1),
+        Region("io", 0xe80000, 0x080000, min_wait=2),
+        Region("cgrom", 0xf00000, 0x0c0000, min_wait=1),
+        Region("ipl_rom", 0xfe0000, 0x020000, "bram" if shadow_rom else "ext",
+               cacheable=True, prefetchable=True),
+    ]
+    return RegionMap(regions)
+
+# single cycle lookup of the region of a byte address, a table indexed by
+# the granule the address is in
+class RegionDecoder(Elaboratable):
+    def __init__(self, regions):
+        self.regions = regions
+        self.addr = Signal(24)
+        self.region = Signal(range(len(regions.regions) + 1))
+        self.cacheable = Signal()
+        self.posted = Signal()
+        self.prefetchable = Signal()
+        self.min_wait = Signal(4)
+        self.mem = Memory(width=15, depth=1 << (24 - regions.granularity), init=regions.table())
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rdport = rdport = self.mem.read_port(domain="comb")
+        m.d.comb += [
+            rdport.addr.eq(self.addr[self.regions.granularity:]),
+            self.region.eq(rdport.data[0:8]),
+            self.cacheable.eq(rdport.data[8]),
+            self.posted.eq(rdport.data[9]),
+            self.prefetchable.eq(rdport.data[10]),
+            self.min_wait.eq(rdport.data[11:15]),
+        ]
+        return m
+
+class Test(unittest.TestCase):
+    def test_map(self):
+        regions = x68000_regions()
+        self.assertEqual(regions.lookup(0x100000).name, "main_ram")
+        self.assertEqual(regions.lookup(0x9fffff).target, "sdram")
+        self.assertEqual(regions.lookup(0xe8e000).name, "io")
+        self.assertIs(regions.lookup(0xfc0000), regions.default)
+        self.assertEqual(regions.ranges("cacheable"), [(0x200000, 0xc00000), (0xfe0000, 0x1000000)])
+        self.assertEqual(x68000_regions(cache_host_ram=True).ranges("cacheable"),
+                         [(0x000000, 0xc00000), (0xfe0000, 0x1000000)])
+        self.assertEqual(x68000_regions(local_ram=None).ranges("cacheable"), [(0xfe0000, 0x1000000)])
+        self.assertEqual(regions.ranges("prefetchable"), [(0x000000, 0xc00000), (0xfe0000, 0x1000000)])
+        self.assertEqual(regions.ranges(lambda r: r.target == "sdram"), [(0x200000, 0xc00000)])
+        with self.assertRaises(ValueError):
+            RegionMap([Region("a", 0, 0x20000), Region("b", 0x10000, 0x10000)])
+        with self.assertRaises(ValueError):
+            RegionMap([Region("a", 0x100, 0x10000)])
+
+    def test_decoder(self):
+        regions = x68000_regions()
+        dut = RegionDecoder(regions)
+
+        def sim_test():
+            for addr in [0x000000, 0x1ffffe, 0x200000, 0xc12344, 0xe80000, 0xefffff,
+                         0xfc0000, 0xfe0000, 0xffffff]:
+                yield dut.addr.eq(addr)
+                yield Settle()
+                r = regions.lookup(addr)
+                index = len(regions.regions) if r is regions.default else regions.index(r.name)
+                self.assertEqual((yield dut.region), index, hex(addr))
+                self.assertEqual((yield dut.cacheable), r.cacheable, hex(addr))
+                self.assertEqual((yield dut.posted), r.posted, hex(addr))
+                self.assertEqual((yield dut.prefetchable), r.prefetchable, hex(addr))
+                self.assertEqual((yield dut.min_wait), r.min_wait, hex(addr))
+
+        sim = Simulator(dut)
+        sim.add_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,276 @@
+import unittest
+from math import ceil
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+
+
+# single port sdram controller with a 32 bit wishbone front end, one access
+# at a time with auto precharge. defaults match the 32MB AS4C16M16 on the
+# ulx3s: 16 bit wide, 13 row bits, 9 column bits, 4 banks.
+# the control outputs are active high, the ulx3s resource inverts them.
+# the sdram clock has to lag the controller clock by half a cycle, see
+# ECP5PLL's shifted output. commands and write data are then sampled in the
+# middle of the cycle they are driven in, and the first read word comes out
+# half a clock after the edge cas_latency after the READ, for the controller
+# to take on the next one. this needs half a clock to be more than tAC.
+class SDRAMController(Elaboratable):
+    def __init__(self, clk_freq=25e6, row_bits=13, col_bits=9, bank_bits=2,
+                 cas_latency=2, init_us=200):
+        self.clk_freq = clk_freq
+        self.row_bits = row_bits
+        self.col_bits = col_bits
+        self.bank_bits = bank_bits
+        self.cas_latency = cas_latency
+        self.init_us = init_us
+        # two 16 bit columns per longword
+        self.addr_width = row_bits + col_bits + bank_bits - 1
+        self.bus = wishbone.Interface(addr_width = self.addr_width, data_width = 32, granularity = 8)
+
+        self.clk_en = Signal(reset = 1)
+        self.cs = Signal()
+        self.ras = Signal()
+        self.cas = Signal()
+        self.we = Signal()
+        self.a = Signal(max(row_bits, 11))
+        self.ba = Signal(bank_bits)
+        self.dqm = Signal(2)
+        self.dq_o = Signal(16)
+        self.dq_i = Signal(16)
+        self.dq_oe = Signal()
+
+    def cycles(self, ns):
+        return max(1, ceil(ns * self.clk_freq / 1e9))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        t_rp = self.cycles(18)
+        t_rcd = self.cycles(18)
+        t_rc = self.cycles(63)
+        t_wr = 2
+        t_mrd = 2
+        t_refi = int(7.8e-6 * self.clk_freq)
+        t_init = int(self.init_us * 1e-6 * self.clk_freq)
+
+        col = Signal(self.col_bits)
+        bank = Signal(self.bank_bits)
+        row = Signal(self.row_bits)
+        m.d.comb += col.eq(self.bus.adr << 1)
+        m.d.comb += bank.eq(self.bus.adr[self.col_bits - 1:])
+        m.d.comb += row.eq(self.bus.adr[self.col_bits - 1 + self.bank_bits:])
+
+        timer = Signal(range(max(t_init, t_refi, t_rc + t_wr) + 1))
+        refresh_timer = Signal(range(t_refi + 1), reset = t_refi)
+        refresh_due = Signal()
+        init_refreshes = Signal(range(3))
+        dat_r = Signal(32)
+
+        with m.If(timer != 0):
+            m.d.sync += timer.eq(timer - 1)
+        with m.If(refresh_timer != 0):
+            m.d.sync += refresh_timer.eq(refresh_timer - 1)
+        with m.Else():
+            m.d.sync += refresh_timer.eq(t_refi)
+            m.d.sync += refresh_due.eq(1)
+
+        def command(cmd):
+            ras, cas, we = {
+                "NOP":       (0, 0, 0),
+                "ACTIVE":    (1, 0, 0),
+                "READ":      (0, 1, 0),
+                "WRITE":     (0, 1, 1),
+                "PRECHARGE": (1, 0, 1),
+                "REFRESH":   (1, 1, 0),
+                "MODE":      (1, 1, 1),
+            }[cmd]
+            m.d.comb += [
+                self.cs.eq(1),
+                self.ras.eq(ras),
+                self.cas.eq(cas),
+                self.we.eq(we),
+            ]
+
+        m.d.comb += self.bus.dat_r.eq(dat_r)
+
+        with m.FSM(reset="INIT"):
+            with m.State("INIT"):
+                m.d.sync += timer.eq(t_init)
+                m.next = "INIT_WAIT"
+            with m.State("INIT_WAIT"):
+                with m.If(timer == 0):
+                    # precharge all banks
+                    command("PRECHARGE")
+                    m.d.comb += self.a[10].eq(1)
+                    m.d.sync += timer.eq(t_rp - 1)
+                    m.d.sync += init_refreshes.eq(2)
+                    m.next = "INIT_REFRESH"
+            with m.State("INIT_REFRESH"):
+                with m.If(timer == 0):
+                    with m.If(init_refreshes != 0):
+                        command("REFRESH")
+                        m.d.sync += init_refreshes.eq(init_refreshes - 1)
+                        m.d.sync += timer.eq(t_rc - 1)
+                    with m.Else():
+                        # burst length 2, sequential, burst writes
+                        command("MODE")
+                        m.d.comb += self.a.eq(0b001 | (self.cas_latency << 4))
+                        m.d.sync += timer.eq(t_mrd - 1)
+                        m.next = "IDLE"
+            with m.State("IDLE"):
+                with m.If((timer == 0) & refresh_due):
+                    command("REFRESH")
+                    m.d.sync += refresh_due.eq(0)
+                    m.d.sync += timer.eq(t_rc - 1)
+                with m.Elif((timer == 0) & self.bus.cyc & self.bus.stb):
+                    command("ACTIVE")
+                    m.d.comb += self.a.eq(row)
+                    m.d.comb += self.ba.eq(bank)
+                    m.d.sync += timer.eq(t_rcd - 1)
+                    m.next = "ACTIVE"
+            with m.State("ACTIVE"):
+                m.d.comb += self.ba.eq(bank)
+                # column address with auto precharge
+                m.d.comb += self.a.eq(col | (1 << 10))
+                with m.If(timer == 0):
+                    with m.If(self.bus.we):
+                        command("WRITE")
+                        m.d.comb += self.dq_oe.eq(1)
+                        m.d.comb += self.dq_o.eq(self.bus.dat_w[16:32])
+                        m.d.comb += self.dqm.eq(~Cat(self.bus.sel[2], self.bus.sel[3]))
+                        m.next = "WRITE1"
+                    with m.Else():
+                        command("READ")
+                        # first word is captured cas_latency + 1 edges later
+                        m.d.sync += timer.eq(self.cas_latency - 1)
+                        m.next = "READ0"
+            with m.State("WRITE1"):
+                m.d.comb += self.dq_oe.eq(1)
+                m.d.comb += self.dq_o.eq(self.bus.dat_w[0:16])
+                m.d.comb += self.dqm.eq(~Cat(self.bus.sel[0], self.bus.sel[1]))
+                m.d.comb += self.bus.ack.eq(1)
+                m.d.sync += timer.eq(t_wr + t_rp - 1)
+                m.next = "IDLE"
+            with m.State("READ0"):
+                with m.If(timer == 0):
+                    m.d.sync += dat_r[16:32].eq(self.dq_i)
+                    m.next = "READ1"
+            with m.State("READ1"):
+                m.d.sync += dat_r[0:16].eq(self.dq_i)
+                m.next = "DONE"
+            with m.State("DONE"):
+                m.d.comb += self.bus.ack.eq(1)
+                m.d.sync += timer.eq(t_rp - 1)
+                m.next = "IDLE"
+
+        return m
+
+class Test(unittest.TestCase):
+    def test_simple(self):
+        for cas_latency in (2, 3):
+            with self.subTest(cas_latency=cas_latency):
+                self.sdram_test(cas_latency)
+
+    def sdram_test(self, cas_latency):
+        dut = SDRAMController(init_us=10, cas_latency=cas_latency)
+        banks = {}
+        open_rows = {}
+        log = []
+
+        # behavioural model of the sdram, burst length 2, clocked half a
+        # cycle after the controller. each read word is on dq for one cycle,
+        # dq is junk otherwise.
+        def sdram():
+            yield Passive()
+            pending = []
+            write_col = None
+            while True:
+                yield Settle()
+                cmd = ((yield dut.cs), (yield dut.ras), (yield dut.cas), (yield dut.we))
+                a = yield dut.a
+                ba = yield dut.ba
+                dq_i = 0xdead
+                for p in pending:
+                    p[0] -= 1
+                    if p[0] == 0:
+                        dq_i = banks.get((p[1], p[2], p[3]), 0)
+                pending = [p for p in pending if p[0] > 0]
+                yield dut.dq_i.eq(dq_i)
+                if write_col is not None:
+                    self.assertEqual((yield dut.dq_oe), 1)
+                    key = write_col
+                    dqm = yield dut.dqm
+                    old = banks.get(key, 0)
+                    new = yield dut.dq_o
+                    mask = (0 if dqm & 1 else 0xff) | (0 if dqm & 2 else 0xff00)
+                    banks[key] = (old & ~mask) | (new & mask)
+                    write_col = None
+                if cmd == (1, 1, 0, 0):
+                    log.append("ACTIVE")
+                    open_rows[ba] = a
+                elif cmd == (1, 0, 1, 0):
+                    log.append("READ")
+                    self.assertEqual(a & (1 << 10), 1 << 10)
+                    col = a & 0x1ff
+                    row = open_rows.pop(ba)
+                    pending.append([cas_latency, ba, row, col])
+                    pending.append([cas_latency + 1, ba, row, col + 1])
+                elif cmd == (1, 0, 1, 1):
+                    log.append("WRITE")
+                    col = a & 0x1ff
+                    row = open_rows.pop(ba)
+                    dqm = yield dut.dqm
+                    mask = (0 if dqm & 1 else 0xff) | (0 if dqm & 2 else 0xff00)
+                    banks[(ba, row, col)] = (banks.get((ba, row, col), 0) & ~mask) | ((yield dut.dq_o) & mask)
+                    write_col = (ba, row, col + 1)
+                elif cmd == (1, 1, 1, 0):
+                    log.append("REFRESH")
+                    self.assertEqual(open_rows, {})
+                elif cmd == (1, 1, 1, 1):
+                    log.append("MODE")
+                    self.assertEqual(a, 0b001 | (cas_latency << 4))
+                elif cmd == (1, 1, 0, 1):
+                    log.append("PRECHARGE")
+                yield Tick()
+
+        def access(adr, we=0, sel=0xf, dat=0):
+            yield dut.bus.adr.eq(adr)
+            yield dut.bus.we.eq(we)
+            yield dut.bus.sel.eq(sel)
+            yield dut.bus.dat_w.eq(dat)
+            yield dut.bus.cyc.eq(1)
+            yield dut.bus.stb.eq(1)
+            yield Delay(1e-9)
+            while (yield dut.bus.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+            dat_r = yield dut.bus.dat_r
+            yield Tick()
+            yield dut.bus.cyc.eq(0)
+            yield dut.bus.stb.eq(0)
+            return dat_r
+
+        def sim_test():
+            yield from access(0x123456, we=1, dat=0x11223344)
+            yield from access(0x000001, we=1, dat=0x55667788)
+            self.assertEqual(log[:4], ["PRECHARGE", "REFRESH", "REFRESH", "MODE"])
+            self.assertEqual((yield from access(0x123456)), 0x11223344)
+            self.assertEqual((yield from access(0x000001)), 0x55667788)
+            # byte writes only touch the selected lanes
+            yield from access(0x123456, we=1, sel=0x9, dat=0xaabbccdd)
+            self.assertEqual((yield from access(0x123456)), 0xaa2233dd)
+            # periodic refresh keeps happening while idle
+            refreshes = log.count("REFRESH")
+            for i in range(1000):
+                yield Tick()
+            self.assertGreaterEqual(log.count("REFRESH") - refreshes, 4)
+            self.assertEqual((yield from access(0x000001)), 0x55667788)
+
+        sim = Simulator(dut)
+        sim.add_clock(1 / 25e6)
+        sim.add_sync_process(sdram)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
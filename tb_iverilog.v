@@ -7,7 +7,7 @@ module tb();
    reg nreset;
    
 
-   top top (
+   anubis top (
             .clk(clk),
             .rst(nreset)
             );
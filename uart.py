@@ -0,0 +1,113 @@
+import unittest
+from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.sim import *
+
+
+# 8n1 uart, divisor is clocks per bit.
+# tx sends data while valid and ready are both high.
+class UARTTx(Elaboratable):
+    def __init__(self, divisor):
+        self.divisor = divisor
+        self.data = Signal(8)
+        self.valid = Signal()
+        self.ready = Signal()
+        self.tx = Signal(reset = 1)
+
+    def elaborate(self, platform):
+        m = Module()
+        timer = Signal(range(self.divisor))
+        bits = Signal(10)
+        count = Signal(range(11))
+        m.d.comb += self.ready.eq(count == 0)
+        with m.If(self.ready):
+            with m.If(self.valid):
+                m.d.sync += [
+                    bits.eq(Cat(0, self.data, 1)),
+                    count.eq(10),
+                    timer.eq(self.divisor - 1),
+                    self.tx.eq(0),
+                ]
+        with m.Elif(timer != 0):
+            m.d.sync += timer.eq(timer - 1)
+        with m.Else():
+            m.d.sync += [
+                bits.eq(bits >> 1),
+                count.eq(count - 1),
+                timer.eq(self.divisor - 1),
+                self.tx.eq(bits[1] | (count == 1)),
+            ]
+        return m
+
+# rx pulses valid for a clock with each received byte, bytes with a bad
+# stop bit are dropped
+class UARTRx(Elaboratable):
+    def __init__(self, divisor):
+        self.divisor = divisor
+        self.rx = Signal(reset = 1)
+        self.data = Signal(8)
+        self.valid = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        rx = Signal(reset = 1)
+        m.submodules.rx_sync = FFSynchronizer(self.rx, rx, reset=1)
+        timer = Signal(range(self.divisor * 3 // 2 + 1))
+        bits = Signal(9)
+        count = Signal(range(10))
+        with m.If(count == 0):
+            with m.If(~rx):
+                # the middle of the first data bit
+                m.d.sync += timer.eq(self.divisor * 3 // 2 - 1)
+                m.d.sync += count.eq(9)
+        with m.Elif(timer != 0):
+            m.d.sync += timer.eq(timer - 1)
+        with m.Else():
+            m.d.sync += [
+                bits.eq(Cat(bits[1:], rx)),
+                count.eq(count - 1),
+                timer.eq(self.divisor - 1),
+            ]
+            with m.If((count == 1) & rx):
+                m.d.comb += self.valid.eq(1)
+        m.d.comb += self.data.eq(bits[1:9])
+        return m
+
+class Test(unittest.TestCase):
+    def test_loopback(self):
+        m = Module()
+        m.submodules.tx = tx = UARTTx(8)
+        m.submodules.rx = rx = UARTRx(8)
+        m.d.comb += rx.rx.eq(tx.tx)
+        received = []
+
+        def receiver():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield rx.valid):
+                    received.append((yield rx.data))
+
+        def sim_test():
+            for byte in [0x55, 0x00, 0xff, 0xa5]:
+                yield tx.data.eq(byte)
+                yield tx.valid.eq(1)
+                yield Settle()
+                while not (yield tx.ready):
+                    yield Tick()
+                    yield Settle()
+                yield Tick()
+                yield tx.valid.eq(0)
+            for i in range(200):
+                yield Tick()
+            self.assertEqual(received, [0x55, 0x00, 0xff, 0xa5])
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(receiver)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,340 @@
+import unittest
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from wb_util import connect_wishbone
+from regions import RegionDecoder, x68000_regions
+
+
+# write-through longword cache between the ao68000 wishbone bus and the
+# 68000 bus bridge. ways = 1 is direct mapped, more ways is set associative.
+# cacheable is a list of (start, end) byte address ranges, end exclusive,
+# cacheable_fc the function codes that may be cached (never cpu space 7).
+# with a RegionMap as regions its cacheable regions are used instead.
+# by default only the ipl rom is cached: host ram is written by the dmac and
+# video ram by the crtc behind the cpu's back.
+# snoop_adr is a longword another bus master has written, taken when
+# snoop_valid and snoop_ready are both high. its index is dropped from every
+# way. a flush pulse is remembered until the cache is free to do it.
+class WishboneCache(Elaboratable):
+    def __init__(self, wb, wb_fc, index_width=10, ways=1,
+                 cacheable=[(0xfe0000, 0x1000000)], cacheable_fc=[1, 2, 5, 6], regions=None):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.index_width = index_width
+        self.ways = ways
+        self.cacheable = cacheable
+        self.cacheable_fc = [fc for fc in cacheable_fc if fc != 0x7]
+        self.regions = regions
+        self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.flush = Signal()
+        self.snoop_adr = Signal(22)
+        self.snoop_valid = Signal()
+        self.snoop_ready = Signal()
+        self.tag_width = 22 - index_width
+        self.tag_mems = [Memory(width=self.tag_width + 1, depth=2**index_width) for w in range(ways)]
+        self.data_mems = [Memory(width=32, depth=2**index_width) for w in range(ways)]
+
+    def elaborate(self, platform):
+        m = Module()
+        index = Signal(self.index_width)
+        tag = Signal(self.tag_width)
+        addr = Signal(24) # 68000 byte address
+        m.d.comb += index.eq(self.wb.adr[:self.index_width])
+        m.d.comb += tag.eq(self.wb.adr[self.index_width:22])
+        m.d.comb += addr.eq(self.wb.adr << 2)
+
+        cacheable = Signal()
+        in_range = Signal()
+        if self.regions is not None:
+            m.submodules.regions = regions = RegionDecoder(self.regions)
+            m.d.comb += regions.addr.eq(addr)
+            m.d.comb += in_range.eq(regions.cacheable)
+        else:
+            m.d.comb += in_range.eq(Cat((addr >= start) & (addr < end)
+                                        for start, end in self.cacheable).any())
+        m.d.comb += cacheable.eq(in_range & Cat(self.wb_fc == fc
+                                                for fc in self.cacheable_fc).any())
+
+        hit = Signal(self.ways)
+        hit_r = Signal(self.ways)
+        valid = Signal(self.ways)
+        victim = Signal(self.ways)
+        victim_r = Signal(self.ways)
+        rr = Signal(range(self.ways)) # round robin replacement
+        hit_data = Signal(32)
+        flush_index = Signal(self.index_width)
+
+        tag_wrports = []
+        data_wrports = []
+        for w in range(self.ways):
+            tag_rdport = self.tag_mems[w].read_port(transparent=False)
+            tag_wrport = self.tag_mems[w].write_port()
+            data_rdport = self.data_mems[w].read_port(transparent=False)
+            data_wrport = self.data_mems[w].write_port(granularity=8)
+            m.submodules["tag_rdport_%d" % w] = tag_rdport
+            m.submodules["tag_wrport_%d" % w] = tag_wrport
+            m.submodules["data_rdport_%d" % w] = data_rdport
+            m.submodules["data_wrport_%d" % w] = data_wrport
+            m.d.comb += tag_rdport.addr.eq(index)
+            m.d.comb += data_rdport.addr.eq(index)
+            m.d.comb += tag_wrport.addr.eq(index)
+            m.d.comb += data_wrport.addr.eq(index)
+            m.d.comb += valid[w].eq(tag_rdport.data[-1])
+            m.d.comb += hit[w].eq(valid[w] & (tag_rdport.data[:-1] == tag))
+            with m.If(hit[w]):
+                m.d.comb += hit_data.eq(data_rdport.data)
+            tag_wrports.append(tag_wrport)
+            data_wrports.append(data_wrport)
+
+        # fill an invalid way first, otherwise round robin
+        m.d.comb += victim.eq(Const(1, self.ways) << rr)
+        for w in reversed(range(self.ways)):
+            with m.If(~valid[w]):
+                m.d.comb += victim.eq(1 << w)
+
+        flush_request = Signal()
+        with m.If(self.flush):
+            m.d.sync += flush_request.eq(1)
+
+        with m.FSM(reset="FLUSH"):
+            with m.State("IDLE"):
+                m.d.comb += self.snoop_ready.eq(1)
+                with m.If(self.flush | flush_request):
+                    m.d.sync += flush_request.eq(0)
+                    m.next = "FLUSH"
+                with m.Elif(self.snoop_valid):
+                    for w in range(self.ways):
+                        m.d.comb += tag_wrports[w].addr.eq(self.snoop_adr[:self.index_width])
+                        m.d.comb += tag_wrports[w].data.eq(0)
+                        m.d.comb += tag_wrports[w].en.eq(1)
+                with m.Elif(self.wb.cyc & self.wb.stb):
+                    with m.If(cacheable):
+                        m.next = "LOOKUP"
+                    with m.Else():
+                        m.next = "FORWARD"
+            with m.State("LOOKUP"):
+                # tag and data ram outputs are valid for this address now
+                m.d.sync += hit_r.eq(hit)
+                m.d.sync += victim_r.eq(victim)
+                with m.If(hit.any() & ~self.wb.we):
+                    m.d.comb += self.wb.dat_r.eq(hit_data)
+                    m.d.comb += self.wb.ack.eq(1)
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "FORWARD"
+            with m.State("FORWARD"):
+                connect_wishbone(m, self.wb, self.bus)
+                # always fetch the whole longword on a cacheable read miss
+                with m.If(cacheable & ~self.wb.we):
+                    m.d.comb += self.bus.sel.eq(0xf)
+                with m.Else():
+                    m.d.comb += self.bus.sel.eq(self.wb.sel)
+                with m.If(self.bus.ack):
+                    with m.If(cacheable & self.wb.we):
+                        for w in range(self.ways):
+                            with m.If(hit_r[w]):
+                                m.d.comb += data_wrports[w].data.eq(self.wb.dat_w)
+                                m.d.comb += data_wrports[w].en.eq(self.wb.sel)
+                    with m.Elif(cacheable):
+                        for w in range(self.ways):
+                            with m.If(victim_r[w]):
+                                m.d.comb += tag_wrports[w].data.eq(Cat(tag, 1))
+                                m.d.comb += tag_wrports[w].en.eq(1)
+                                m.d.comb += data_wrports[w].data.eq(self.bus.dat_r)
+                                m.d.comb += data_wrports[w].en.eq(0xf)
+                        if self.ways > 1:
+                            m.d.sync += rr.eq(rr + 1)
+                    m.next = "IDLE"
+                with m.If(self.bus.err | self.bus.rty):
+                    m.next = "IDLE"
+            with m.State("FLUSH"):
+                for w in range(self.ways):
+                    m.d.comb += tag_wrports[w].addr.eq(flush_index)
+                    m.d.comb += tag_wrports[w].data.eq(0)
+                    m.d.comb += tag_wrports[w].en.eq(1)
+                m.d.sync += flush_index.eq(flush_index + 1)
+                with m.If(flush_index == 2**self.index_width - 1):
+                    m.next = "IDLE"
+
+        return m
+
+class Test(unittest.TestCase):
+    def run_cache(self, dut, test):
+        mem = {}
+        self.accesses = 0
+
+        def slave():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.bus.ack):
+                    yield dut.bus.ack.eq(0)
+                    continue
+                if (yield dut.bus.cyc) & (yield dut.bus.stb):
+                    adr = yield dut.bus.adr
+                    sel = yield dut.bus.sel
+                    self.accesses += 1
+                    if (yield dut.bus.we):
+                        dat = yield dut.bus.dat_w
+                        old = mem.get(adr, 0)
+                        for b in range(4):
+                            if sel & (1 << b):
+                                old = (old & ~(0xff << (b * 8))) | (dat & (0xff << (b * 8)))
+                        mem[adr] = old
+                    else:
+                        yield dut.bus.dat_r.eq(mem.get(adr, adr))
+                    yield dut.bus.ack.eq(1)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(slave)
+        sim.add_sync_process(test)
+        sim.run()
+
+    def access(self, dut, adr, fc=5, we=0, sel=0xf, dat=0):
+        yield dut.wb.adr.eq(adr)
+        yield dut.wb_fc.eq(fc)
+        yield dut.wb.we.eq(we)
+        yield dut.wb.sel.eq(sel)
+        yield dut.wb.dat_w.eq(dat)
+        yield dut.wb.cyc.eq(1)
+        yield dut.wb.stb.eq(1)
+        yield Delay(1e-9)
+        while (yield dut.wb.ack) == 0:
+            yield Tick()
+            yield Delay(1e-9)
+        dat_r = yield dut.wb.dat_r
+        yield Tick()
+        yield dut.wb.cyc.eq(0)
+        yield dut.wb.stb.eq(0)
+        return dat_r
+
+    def test_read_hit(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneCache(wb, Signal(3), index_width=4, ways=2, cacheable=[(0, 0xe80000)])
+
+        def sim_test():
+            for i in range(20):
+                yield Tick()
+            self.assertEqual((yield from self.access(dut, 0x123)), 0x123)
+            self.assertEqual(self.accesses, 1)
+            self.assertEqual((yield from self.access(dut, 0x123, sel=0x1)), 0x123)
+            self.assertEqual((yield from self.access(dut, 0x123, fc=6)), 0x123)
+            self.assertEqual(self.accesses, 1)
+            # same index, different tag goes to the second way
+            self.assertEqual((yield from self.access(dut, 0x133)), 0x133)
+            self.assertEqual((yield from self.access(dut, 0x123)), 0x123)
+            self.assertEqual((yield from self.access(dut, 0x133)), 0x133)
+            self.assertEqual(self.accesses, 2)
+            # third tag evicts one of them
+            self.assertEqual((yield from self.access(dut, 0x143)), 0x143)
+            self.assertEqual(self.accesses, 3)
+
+        self.run_cache(dut, sim_test)
+
+    def test_uncacheable(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneCache(wb, Signal(3), index_width=4)
+
+        def sim_test():
+            for i in range(20):
+                yield Tick()
+            # i/o space
+            yield from self.access(dut, 0xe88000 >> 2)
+            yield from self.access(dut, 0xe88000 >> 2)
+            self.assertEqual(self.accesses, 2)
+            # interrupt acknowledge
+            yield from self.access(dut, 0x3fffffff, fc=7)
+            yield from self.access(dut, 0x3fffffff, fc=7)
+            self.assertEqual(self.accesses, 4)
+
+        self.run_cache(dut, sim_test)
+
+    def test_write_through(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneCache(wb, Signal(3), index_width=4, cacheable=[(0, 0xe80000)])
+
+        def sim_test():
+            for i in range(20):
+                yield Tick()
+            yield from self.access(dut, 0x10)
+            yield from self.access(dut, 0x10, we=1, sel=0x3, dat=0xaaaabbbb)
+            self.assertEqual(self.accesses, 2)
+            self.assertEqual((yield from self.access(dut, 0x10)), 0x0000bbbb)
+            self.assertEqual(self.accesses, 2)
+            # write miss does not allocate
+            yield from self.access(dut, 0x20, we=1, dat=0x12345678)
+            self.assertEqual((yield from self.access(dut, 0x20)), 0x12345678)
+            self.assertEqual(self.accesses, 4)
+
+        self.run_cache(dut, sim_test)
+
+    def test_flush(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneCache(wb, Signal(3), index_width=4, cacheable=[(0, 0xe80000)])
+
+        def sim_test():
+            for i in range(20):
+                yield Tick()
+            yield from self.access(dut, 0x10)
+            yield from self.access(dut, 0x10)
+            self.assertEqual(self.accesses, 1)
+            yield dut.flush.eq(1)
+            yield Tick()
+            yield dut.flush.eq(0)
+            for i in range(20):
+                yield Tick()
+            yield from self.access(dut, 0x10)
+            self.assertEqual(self.accesses, 2)
+
+        self.run_cache(dut, sim_test)
+
+    def test_snoop(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneCache(wb, Signal(3), index_width=4, cacheable=[(0, 0xe80000)])
+
+        def sim_test():
+            for i in range(20):
+                yield Tick()
+            yield from self.access(dut, 0x11)
+            yield from self.access(dut, 0x12)
+            self.assertEqual(self.accesses, 2)
+            # a host write to 0x11 drops it, 0x12 stays
+            yield dut.snoop_adr.eq(0x11)
+            yield dut.snoop_valid.eq(1)
+            yield Settle()
+            while not (yield dut.snoop_ready):
+                yield Tick()
+                yield Settle()
+            yield Tick()
+            yield dut.snoop_valid.eq(0)
+            yield from self.access(dut, 0x12)
+            self.assertEqual(self.accesses, 2)
+            yield from self.access(dut, 0x11)
+            self.assertEqual(self.accesses, 3)
+            # the default only caches the ipl rom
+            self.assertEqual(WishboneCache(wb, Signal(3)).cacheable, [(0xfe0000, 0x1000000)])
+
+        self.run_cache(dut, sim_test)
+
+    def test_regions(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneCache(wb, Signal(3), index_width=4, regions=x68000_regions())
+
+        def sim_test():
+            for i in range(20):
+                yield Tick()
+            # host main ram is not cacheable by default, local ram is
+            yield from self.access(dut, 0x100000 >> 2)
+            yield from self.access(dut, 0x100000 >> 2)
+            self.assertEqual(self.accesses, 2)
+            yield from self.access(dut, 0x200010 >> 2)
+            yield from self.access(dut, 0x200010 >> 2)
+            self.assertEqual(self.accesses, 3)
+
+        self.run_cache(dut, sim_test)
+
+if __name__ == "__main__":
+    unittest.main()
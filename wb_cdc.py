@@ -0,0 +1,176 @@
+import unittest
+from nmigen import *
+from nmigen.lib.fifo import AsyncFIFO
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from regions import RegionDecoder
+
+
+# wishbone clock domain crossing. requests from wb in the sync domain go
+# through an async fifo to bus in o_domain, responses come back the same way.
+# writes below io_base, or to the posted regions of a RegionMap given as
+# regions, are acked once they are queued, everything else waits for the
+# response, which is either ack or rty. requests stay in order, so reads see
+# earlier writes.
+class WishboneCDC(Elaboratable):
+    def __init__(self, wb, wb_fc, o_domain="bus", depth=4, io_base=0xe80000, regions=None):
+        self.wb = wb
+        self.wb_fc = wb_fc
+        self.o_domain = o_domain
+        self.depth = depth
+        self.io_base = io_base
+        self.regions = regions
+        self.bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.fc = Signal(3)
+
+    def elaborate(self, platform):
+        m = Module()
+        req_layout = [
+            ("adr", 30),
+            ("sel", 4),
+            ("we", 1),
+            ("dat_w", 32),
+            ("fc", 3),
+            ("cti", 3),
+            ("bte", 2),
+            ("posted", 1),
+        ]
+        req_w = Record(req_layout)
+        req_r = Record(req_layout)
+        m.submodules.req = req = AsyncFIFO(width=len(req_w), depth=self.depth,
+                                           w_domain="sync", r_domain=self.o_domain)
+        # only one response is ever outstanding
+        m.submodules.resp = resp = AsyncFIFO(width=33, depth=2,
+                                             w_domain=self.o_domain, r_domain="sync")
+
+        addr = Signal(24) # 68000 byte address
+        m.d.comb += addr.eq(self.wb.adr << 2)
+        waiting = Signal()
+        posted = Signal()
+        if self.regions is not None:
+            m.submodules.regions = regions = RegionDecoder(self.regions)
+            m.d.comb += regions.addr.eq(addr)
+            m.d.comb += posted.eq(regions.posted)
+        else:
+            m.d.comb += posted.eq(addr < self.io_base)
+        m.d.comb += [
+            req_w.adr.eq(self.wb.adr),
+            req_w.sel.eq(self.wb.sel),
+            req_w.we.eq(self.wb.we),
+            req_w.dat_w.eq(self.wb.dat_w),
+            req_w.fc.eq(self.wb_fc),
+            req_w.cti.eq(self.wb.cti),
+            req_w.bte.eq(self.wb.bte),
+            req_w.posted.eq(self.wb.we & (self.wb_fc != 0x7) & posted),
+            req.w_data.eq(req_w),
+            self.wb.dat_r.eq(resp.r_data[:32]),
+        ]
+        with m.If(self.wb.cyc & self.wb.stb & ~waiting & req.w_rdy):
+            m.d.comb += req.w_en.eq(1)
+            with m.If(req_w.posted):
+                m.d.comb += self.wb.ack.eq(1)
+            with m.Else():
+                m.d.sync += waiting.eq(1)
+        with m.If(waiting & resp.r_rdy):
+            m.d.comb += resp.r_en.eq(1)
+            m.d.comb += self.wb.ack.eq(~resp.r_data[32])
+            m.d.comb += self.wb.rty.eq(resp.r_data[32])
+            m.d.sync += waiting.eq(0)
+
+        m.d.comb += [
+            req_r.eq(req.r_data),
+            self.bus.adr.eq(req_r.adr),
+            self.bus.sel.eq(req_r.sel),
+            self.bus.we.eq(req_r.we),
+            self.bus.dat_w.eq(req_r.dat_w),
+            self.bus.cti.eq(req_r.cti),
+            self.bus.bte.eq(req_r.bte),
+            self.fc.eq(req_r.fc),
+            self.bus.cyc.eq(req.r_rdy),
+            self.bus.stb.eq(req.r_rdy),
+            resp.w_data.eq(Cat(self.bus.dat_r, self.bus.rty)),
+        ]
+        with m.If(self.bus.ack | self.bus.rty):
+            m.d.comb += req.r_en.eq(1)
+            m.d.comb += resp.w_en.eq(~req_r.posted)
+
+        return m
+
+class Test(unittest.TestCase):
+    def test_simple(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        dut = WishboneCDC(wb, wb_fc)
+        m = Module()
+        m.domains.sync = ClockDomain()
+        m.domains.bus = ClockDomain()
+        m.submodules.dut = dut
+        seen = []
+
+        def slave():
+            yield Passive()
+            while True:
+                yield Tick("bus")
+                yield Settle()
+                if (yield dut.bus.ack) | (yield dut.bus.rty):
+                    yield dut.bus.ack.eq(0)
+                    yield dut.bus.rty.eq(0)
+                    continue
+                if (yield dut.bus.cyc) & (yield dut.bus.stb):
+                    adr = yield dut.bus.adr
+                    seen.append((adr, (yield dut.bus.we), (yield dut.bus.dat_w), (yield dut.fc)))
+                    yield dut.bus.dat_r.eq(adr + 0x1000)
+                    if (yield dut.fc) == 7:
+                        yield dut.bus.rty.eq(1)
+                    else:
+                        yield dut.bus.ack.eq(1)
+
+        def access(adr, we=0, dat=0, fc=5):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.sel.eq(0xf)
+            yield wb.dat_w.eq(dat)
+            yield wb_fc.eq(fc)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            clocks = 1
+            while ((yield wb.ack) | (yield wb.rty)) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+                clocks += 1
+            dat_r = yield wb.dat_r
+            self.rty = yield wb.rty
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            return dat_r, clocks
+
+        def sim_test():
+            for i in range(10):
+                yield Tick()
+            # writes are acked at once
+            for i in range(3):
+                _, clocks = yield from access(0x10 + i, we=1, dat=i)
+                self.assertEqual(clocks, 1)
+            # the read comes back after the writes
+            dat_r, clocks = yield from access(0x20, fc=6)
+            self.assertEqual(dat_r, 0x1020)
+            self.assertEqual(seen, [(0x10, 1, 0, 5), (0x11, 1, 1, 5), (0x12, 1, 2, 5), (0x20, 0, 0, 6)])
+            # i/o writes wait for the slave
+            _, clocks = yield from access(0xe88000 >> 2, we=1)
+            self.assertGreater(clocks, 1)
+            self.assertEqual(seen[-1][:2], (0xe88000 >> 2, 1))
+            # autovectored interrupt acknowledge
+            yield from access(0x3fffffff, fc=7)
+            self.assertEqual(self.rty, 1)
+
+        sim = Simulator(m)
+        sim.add_clock(1 / 50e6)
+        sim.add_clock(1 / 10e6, domain="bus")
+        sim.add_sync_process(slave, domain="bus")
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
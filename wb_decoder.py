@@ -0,0 +1,223 @@
+import unittest
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from regions import Region, RegionMap, RegionDecoder
+
+
+# routes windows of the 68000 address space to fpga local wishbone targets,
+# everything else goes out on ext_bus to the 68000 bus bridge.
+# writes to a write_through range of a local window are also sent to the
+# host, for memory that host dma or video reads back.
+# with a RegionMap as regions, add_target routes the regions of a target by
+# the single cycle region lookup instead of address compares.
+class LocalDecoder(Elaboratable):
+    def __init__(self, wb, regions=None):
+        self.wb = wb
+        self.regions = regions
+        self.ext_bus = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        self.locals = []
+
+    # base and size in bytes, write_through is a list of (start, end) byte
+    # address ranges, end exclusive. offset is the byte address on bus the
+    # window starts at.
+    def add_local(self, bus, base, size, write_through=[], offset=0):
+        self.locals.append((bus, base, size, write_through, offset, None))
+
+    # every region of regions with this target, packed one after another on
+    # bus from address 0
+    def add_target(self, bus, target, write_through=[]):
+        offset = 0
+        for index, r in enumerate(self.regions):
+            if r.target == target:
+                self.locals.append((bus, r.base, r.size, write_through, offset, index))
+                offset += r.size
+
+    def elaborate(self, platform):
+        m = Module()
+        addr = Signal(24) # 68000 byte address
+        m.d.comb += addr.eq(self.wb.adr << 2)
+        request = self.wb.cyc & self.wb.stb
+
+        ext = Signal()
+        ext_done = Signal()
+        local_done = Signal()
+        m.d.comb += ext.eq(1)
+
+        ext_bus = self.ext_bus
+        m.d.comb += [
+            ext_bus.adr.eq(self.wb.adr),
+            ext_bus.dat_w.eq(self.wb.dat_w),
+            ext_bus.sel.eq(self.wb.sel),
+            ext_bus.we.eq(self.wb.we),
+            ext_bus.cti.eq(self.wb.cti),
+            ext_bus.bte.eq(self.wb.bte),
+            ext_bus.lock.eq(self.wb.lock),
+        ]
+
+        if self.regions is not None:
+            m.submodules.regions = regions = RegionDecoder(self.regions)
+            m.d.comb += regions.addr.eq(addr)
+
+        for bus, base, size, write_through, offset, index in self.locals:
+            hit = Signal()
+            through = Signal()
+            if index is not None:
+                m.d.comb += hit.eq(regions.region == index)
+            else:
+                m.d.comb += hit.eq((addr >= base) & (addr < base + size))
+            m.d.comb += through.eq(self.wb.we & Cat((addr >= start) & (addr < end)
+                                                    for start, end in write_through).any())
+            m.d.comb += [
+                bus.dat_w.eq(self.wb.dat_w),
+                bus.sel.eq(self.wb.sel),
+                bus.we.eq(self.wb.we),
+            ]
+            with m.If(hit):
+                # a bus may have several windows, each sets the address it hits
+                m.d.comb += bus.adr.eq(self.wb.adr - ((base - offset) >> 2))
+                m.d.comb += ext.eq(0)
+                m.d.comb += bus.cyc.eq(self.wb.cyc & ~local_done)
+                m.d.comb += bus.stb.eq(self.wb.stb & ~local_done)
+                m.d.comb += self.wb.dat_r.eq(bus.dat_r)
+                with m.If(through):
+                    # both sides have to finish, each is dropped once it acks
+                    m.d.comb += ext_bus.cyc.eq(self.wb.cyc & ~ext_done)
+                    m.d.comb += ext_bus.stb.eq(self.wb.stb & ~ext_done)
+                    with m.If((bus.ack | local_done) & (ext_bus.ack | ext_done)):
+                        m.d.comb += self.wb.ack.eq(1)
+                        m.d.sync += local_done.eq(0)
+                        m.d.sync += ext_done.eq(0)
+                    with m.Else():
+                        with m.If(bus.ack):
+                            m.d.sync += local_done.eq(1)
+                        with m.If(ext_bus.ack):
+                            m.d.sync += ext_done.eq(1)
+                with m.Else():
+                    m.d.comb += self.wb.ack.eq(bus.ack)
+
+        with m.If(ext):
+            m.d.comb += [
+                ext_bus.cyc.eq(self.wb.cyc),
+                ext_bus.stb.eq(self.wb.stb),
+                self.wb.dat_r.eq(ext_bus.dat_r),
+                self.wb.ack.eq(ext_bus.ack),
+                self.wb.err.eq(ext_bus.err),
+                self.wb.rty.eq(ext_bus.rty),
+            ]
+
+        return m
+
+class Test(unittest.TestCase):
+    def test_simple(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        local = wishbone.Interface(addr_width = 20, data_width = 32, granularity = 8)
+        dut = LocalDecoder(wb)
+        dut.add_local(local, 0x200000, 0x400000, write_through=[(0x300000, 0x380000)])
+        seen = []
+
+        def slave(bus, name, latency):
+            def process():
+                yield Passive()
+                while True:
+                    yield Tick()
+                    yield Settle()
+                    if (yield bus.ack):
+                        yield bus.ack.eq(0)
+                        continue
+                    if (yield bus.cyc) & (yield bus.stb):
+                        for i in range(latency):
+                            yield Tick()
+                        seen.append((name, (yield bus.adr), (yield bus.we)))
+                        yield bus.dat_r.eq(0x1000 if name == "local" else 0x2000)
+                        yield bus.ack.eq(1)
+            return process
+
+        def access(adr, we=0):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.sel.eq(0xf)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            while (yield wb.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+            dat_r = yield wb.dat_r
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            return dat_r
+
+        def sim_test():
+            self.assertEqual((yield from access(0x100000 >> 2)), 0x2000)
+            self.assertEqual((yield from access(0x200004 >> 2)), 0x1000)
+            self.assertEqual((yield from access(0x5ffffc >> 2)), 0x1000)
+            self.assertEqual((yield from access(0x600000 >> 2)), 0x2000)
+            self.assertEqual(seen, [("ext", 0x100000 >> 2, 0), ("local", 1, 0),
+                                    ("local", 0x3fffff >> 2, 0), ("ext", 0x600000 >> 2, 0)])
+            del seen[:]
+            # written through to the host, read locally
+            yield from access(0x300000 >> 2, we=1)
+            self.assertEqual(sorted(seen), [("ext", 0x300000 >> 2, 1), ("local", 0x100000 >> 2, 1)])
+            del seen[:]
+            yield from access(0x300000 >> 2)
+            yield from access(0x380000 >> 2, we=1)
+            self.assertEqual(seen, [("local", 0x100000 >> 2, 0), ("local", 0x180000 >> 2, 1)])
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(slave(dut.ext_bus, "ext", 3))
+        sim.add_sync_process(slave(local, "local", 0))
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_regions(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        local = wishbone.Interface(addr_width = 20, data_width = 32, granularity = 8)
+        regions = RegionMap([Region("low", 0x100000, 0x10000, "local"),
+                             Region("host", 0x110000, 0x10000),
+                             Region("high", 0x400000, 0x20000, "local")])
+        dut = LocalDecoder(wb, regions)
+        dut.add_target(local, "local")
+        seen = []
+
+        def slave(bus, name):
+            def process():
+                yield Passive()
+                while True:
+                    yield Tick()
+                    yield Settle()
+                    if (yield bus.ack):
+                        yield bus.ack.eq(0)
+                    elif (yield bus.cyc) & (yield bus.stb):
+                        seen.append((name, (yield bus.adr)))
+                        yield bus.ack.eq(1)
+            return process
+
+        def sim_test():
+            for adr in [0x100000, 0x10fffc, 0x110000, 0x400000, 0x41fffc, 0x420000]:
+                yield wb.adr.eq(adr >> 2)
+                yield wb.cyc.eq(1)
+                yield wb.stb.eq(1)
+                yield Settle()
+                while (yield wb.ack) == 0:
+                    yield Tick()
+                    yield Settle()
+                yield Tick()
+                yield wb.cyc.eq(0)
+                yield wb.stb.eq(0)
+            # the second window follows the first on the local bus
+            self.assertEqual(seen, [("local", 0), ("local", 0xfffc >> 2), ("ext", 0x110000 >> 2),
+                                    ("local", 0x10000 >> 2), ("local", 0x2fffc >> 2),
+                                    ("ext", 0x420000 >> 2)])
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(slave(dut.ext_bus, "ext"))
+        sim.add_sync_process(slave(local, "local"))
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()
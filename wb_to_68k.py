@@ -1,11 +1,15 @@
 import unittest
 from nmigen import *
 from nmigen_soc import wishbone
+from nmigen.sim import *
+from nmigen.lib.cdc import FFSynchronizer
+from regions import RegionDecoder
 
 
 # 32 bit wishbone to 16 bit 68000 bus
 class WishboneTo68000(Elaboratable):
-    def __init__(self, wb, wb_fc, wb_ipl):
+    def __init__(self, wb, wb_fc, wb_ipl, as_high_clocks=1, write_depth=4, io_base=0xe80000,
+                 release="cycle", regions=None, dtack_sync=False, iack_timeout=None):
         self.wb = wb
         self.wb_fc = wb_fc
         self.wb_ipl = wb_ipl
@@ -13,7 +17,7 @@ class WishboneTo68000(Elaboratable):
         self.fc = Signal(3)
         self.ipl = Signal(3)
         self.o_data = Signal(16)
-        self.i_data = Signal(16)
+        self.i_data = Signal(16) # taken when dtack_ is seen, so dtack_ must lag it
         self.uds_ = Signal(reset = 1)
         self.lds_ = Signal(reset = 1)
         self.as_ = Signal(reset = 1)
@@ -22,88 +26,423 @@ class WishboneTo68000(Elaboratable):
         self.br_ = Signal(reset = 1)
         self.bg_ = Signal(reset = 1)
         self.bgack_ = Signal(reset = 1)
+        # vpa during interrupt acknowledge asks for an autovector, passed on
+        # to the cpu as rty
+        self.vpa_ = Signal(reset = 1)
         self.bus_assert = Signal(reset = 1)
+        # the other master's bus while granted, i_as_ synchronized
+        self.i_addr = Signal(23)
+        self.i_as_ = Signal(reset = 1)
+        self.i_rw_ = Signal(reset = 1)
+        self.granted = Signal()
+        self.snoop = Signal()
+        self.snoop_adr = Signal(22)
+        self.as_high_clocks = as_high_clocks
+        self.write_depth = write_depth
+        self.io_base = io_base
+        self.regions = regions
+        self.dtack_sync = dtack_sync
+        self.iack_timeout = iack_timeout
+        assert release in ("transaction", "burst", "cycle")
+        self.release = release
+        # performance counters, counted all the time and copied to these
+        # registers on perf_snapshot. dtack_latency<n> is a histogram of
+        # clocks waited for dtack per 68000 cycle, the last bin is n or more.
+        # grant_holdoff counts clocks br waits for bg, grant_stall clocks a
+        # wishbone request waits while the bus is given away.
+        self.perf_snapshot = Signal()
+        self.perf_clear = Signal()
+        names = ["clocks", "reads", "writes", "longwords", "bytes",
+                 "dtack_wait0", "dtack_wait1", "bus_grant", "bus_grant_ack"]
+        names += ["dtack_latency%d" % i for i in range(8)]
+        names += ["grants", "grant_holdoff", "grant_stall", "grant_holdoff_max"]
+        self.perf = [(name, Signal(32, name="perf_" + name)) for name in names]
+        self.perf_live = {name: Signal(32, name="count_" + name) for name in names}
 
     def elaborate(self, platform):
         m = Module()
         i_data_high = Signal(16) # register to hold high bytes (low address)
                                  # of 32 bit read
-        #m.d.comb += self.rw_.eq(~self.wb.we)
-        m.d.comb += self.wb.dat_r.eq(Cat(self.i_data, i_data_high))
-        m.d.comb += self.fc.eq(self.wb_fc)
+        data_high = Signal(16)
+        as_wait = Signal(range(self.as_high_clocks + 1))
+        beat_adr = Signal(22) # longword address of the current beat
+        next_adr = Signal(22) # longword address of the next burst beat
+        m.d.comb += self.wb.dat_r.eq(Cat(self.i_data, data_high))
+        m.d.comb += data_high.eq(i_data_high)
+
+        # write buffer, entries are 32 bit wishbone writes that have already
+        # been acked. rd is the oldest entry, the one being drained. writes
+        # below io_base, or to posted regions, go here unless write_depth is 0
+        depth = max(self.write_depth, 1)
+        wq_valid = Array(Signal(name="wq_valid%d" % i) for i in range(depth))
+        wq_adr = Array(Signal(30, name="wq_adr%d" % i) for i in range(depth))
+        wq_sel = Array(Signal(4, name="wq_sel%d" % i) for i in range(depth))
+        wq_dat = Array(Signal(32, name="wq_dat%d" % i) for i in range(depth))
+        wq_fc = Array(Signal(3, name="wq_fc%d" % i) for i in range(depth))
+        rd = Signal(range(depth))
+        wr = Signal(range(depth))
+        tail = Signal(range(depth))
+        count = Signal(range(depth + 1))
+        push = Signal()
+        pop = Signal()
+        draining = Signal() # the current bus cycle comes from the buffer
+        drain_start = Signal()
+        m.d.comb += tail.eq(Mux(wr == 0, depth - 1, wr - 1))
+
+        # the transaction the fsm works on, from the buffer or straight
+        # from wishbone
+        use_fifo = Signal()
+        cur_sel = Signal(4)
+        cur_we = Signal()
+        cur_dat_w = Signal(32)
+        cur_fc = Signal(3)
+        cur_adr = Signal(30)
+        m.d.comb += use_fifo.eq(draining)
+        with m.If(use_fifo):
+            m.d.comb += [
+                cur_adr.eq(wq_adr[rd]),
+                cur_sel.eq(wq_sel[rd]),
+                cur_we.eq(1),
+                cur_dat_w.eq(wq_dat[rd]),
+                cur_fc.eq(wq_fc[rd]),
+            ]
+        with m.Else():
+            m.d.comb += [
+                cur_adr.eq(self.wb.adr),
+                cur_sel.eq(self.wb.sel),
+                cur_we.eq(self.wb.we),
+                cur_dat_w.eq(self.wb.dat_w),
+                cur_fc.eq(self.wb_fc),
+            ]
+        m.d.comb += self.fc.eq(cur_fc)
+
+        addr = Signal(24) # 68000 byte address
+        m.d.comb += addr.eq(self.wb.adr << 2)
+        request = Signal()
+        io = Signal()
+        postable = Signal()
+        match = Signal()
+        forward = Signal()
+        cpu_go = Signal()
+        m.d.comb += request.eq(self.wb.cyc & self.wb.stb)
+        if self.regions is not None:
+            m.submodules.regions = regions = RegionDecoder(self.regions)
+            m.d.comb += regions.addr.eq(addr)
+            m.d.comb += io.eq((self.wb_fc == 0x7) | ~regions.posted)
+        else:
+            m.d.comb += io.eq((self.wb_fc == 0x7) | (addr >= self.io_base))
+        m.d.comb += match.eq(Cat(wq_valid[i] & (wq_adr[i] == self.wb.adr)
+                                 for i in range(depth)).any())
+        if self.write_depth:
+            m.d.comb += postable.eq(self.wb.we & ~io)
+            # read after write, the newest entry has every byte asked for
+            m.d.comb += forward.eq(~self.wb.we & ~io & wq_valid[tail] &
+                                   (wq_adr[tail] == self.wb.adr) &
+                                   ((self.wb.sel & ~wq_sel[tail]) == 0))
+        # reads may pass queued writes to other addresses, i/o and interrupt
+        # ack wait for the buffer to be empty
+        m.d.comb += cpu_go.eq(request & ~postable & Mux(io, count == 0, ~match))
+
         m.d.comb += self.wb_ipl.eq(self.ipl)
+        # as stays negated as_high_clocks between cycles
+        with m.If(as_wait != 0):
+            m.d.sync += as_wait.eq(as_wait - 1)
+        # a new cycle may assert as. synchronized dtack_ and vpa_ lag as, so
+        # with dtack_sync wait for them to negate
+        as_ready = Signal()
+        if self.dtack_sync:
+            m.d.comb += as_ready.eq((as_wait == 0) & self.dtack_ & self.vpa_)
+        else:
+            m.d.comb += as_ready.eq(as_wait == 0)
+
+        # incrementing burst address, wrapping per bte
+        m.d.comb += next_adr.eq(beat_adr + 1)
+        for bte, bits in ((0b01, 2), (0b10, 3), (0b11, 4)):
+            with m.If(self.wb.bte == bte):
+                m.d.comb += next_adr.eq(Cat((beat_adr + 1)[:bits], beat_adr[bits:]))
+
+        def first_addr(adr):
+            with m.If((cur_fc == 0x7) | ~(cur_sel[2] | cur_sel[3])):
+                m.d.comb += self.addr.eq((adr << 1) + 1)
+            with m.Else():
+                m.d.comb += self.addr.eq(adr << 1)
+
+        def start_beat(adr):
+            m.d.sync += beat_adr.eq(adr)
+            with m.If(cur_fc == 0x7):
+                m.next = "STROBE1" # only do a 16 bit read for int ack
+            with m.Elif(cur_sel[2] | cur_sel[3]):
+                with m.If(cur_we):
+                    m.next = "STROBE0_W"
+                with m.Else():
+                    m.next = "STROBE0"
+            with m.Else():
+                with m.If(cur_we):
+                    m.next = "STROBE1_W"
+                with m.Else():
+                    m.next = "STROBE1"
+
+        # bus arbitration. bg goes out when br is seen, the bus is free at the
+        # end of the cycle at a release boundary: "transaction", "burst" or
+        # "cycle" (the halves of a longword)
+        br = Signal()
+        grant = Signal() # bg is out, the bus goes at the end of this cycle
+        resume = Signal() # granted between the halves of a longword
+        quiet = Signal() # no queued writes left once this cycle is done
+        last_beat = Signal()
+        m.d.comb += [
+            br.eq(~self.br_),
+            self.bg_.eq(~grant),
+            quiet.eq((count == 0) | ((count == 1) & draining)),
+            last_beat.eq(draining | (self.wb.cti != wishbone.CycleType.INCR_BURST) |
+                         (self.wb_fc == 0x7) | (self.release != "transaction")),
+        ]
+
+        def early_grant(boundary):
+            with m.If(br & quiet & boundary):
+                m.d.sync += grant.eq(1)
+
+        def end_grant():
+            m.d.sync += resume.eq(0)
+            with m.If(resume):
+                m.next = "ADDR1"
+            with m.Else():
+                m.next = "WAIT0"
+
+        beat_done = Signal()
+        iack_expired = Signal() # no dtack for iack_timeout clocks
+
+        def end_beat():
+            m.d.comb += beat_done.eq(1)
+            m.d.sync += as_wait.eq(self.as_high_clocks - 1)
+            with m.If(draining):
+                m.d.comb += pop.eq(1)
+                m.d.sync += draining.eq(0)
+                m.next = "WAIT0"
+            with m.Elif((self.wb.cti == wishbone.CycleType.INCR_BURST) & (self.wb_fc != 0x7)):
+                m.d.comb += self.wb.ack.eq(1)
+                m.d.sync += beat_adr.eq(next_adr)
+                m.next = "BURST"
+            with m.Else():
+                m.d.comb += self.wb.ack.eq(1)
+                m.next = "WAIT0"
+
         with m.FSM() as fsm:
             with m.State("WAIT0"):
                 m.d.comb += self.as_.eq(1)
-                with m.If(self.br_ == 0):
+                # drain when nothing else can go, and before a bus grant
+                m.d.comb += use_fifo.eq((count != 0) & ((self.br_ == 0) | ~cpu_go))
+                # present the address in the same cycle the request is seen
+                first_addr(cur_adr)
+                with m.If(grant | ((as_wait == 0) & br & (count == 0))):
+                    m.d.comb += self.bus_assert.eq(0)
+                    m.d.sync += grant.eq(0)
                     m.next = "BUS_GRANT"
-                with m.Elif(self.wb.cyc & self.wb.stb):
-                    with m.If(self.wb_fc == 0x7):
-                        m.next = "ADDR1" # only do a 16 bit read for int ack
-                    with m.Elif(self.wb.sel[2] | self.wb.sel[3]):
-                        m.next = "ADDR0"
-                    with m.Else():
-                        m.next = "ADDR1"
-            with m.State("ADDR0"):
-                m.d.comb += self.addr.eq(self.wb.adr << 1)
-                with m.If(self.wb.we):
-                    m.next = "STROBE0_W"
-                with m.Else():
-                    m.next = "STROBE0"
+                with m.Elif(as_ready & use_fifo):
+                    m.d.comb += drain_start.eq(1)
+                    m.d.sync += draining.eq(1)
+                    start_beat(cur_adr)
+                with m.Elif(as_ready & cpu_go):
+                    start_beat(cur_adr)
+                with m.Elif(as_ready & request & postable & (count == 0)):
+                    # the buffer is empty, the write is queued and goes out
+                    # in the same cycle
+                    m.d.comb += drain_start.eq(1)
+                    m.d.sync += draining.eq(1)
+                    start_beat(cur_adr)
+            with m.State("BURST"):
+                # next beat of an incrementing burst, the address has already
+                # advanced so the strobes follow without going through WAIT0
+                m.d.comb += self.as_.eq(1)
+                first_addr(beat_adr)
+                # a beat that hits a buffered write goes back through WAIT0,
+                # so does a bus request if the burst may be interrupted
+                with m.If(grant):
+                    m.d.comb += self.bus_assert.eq(0)
+                    m.d.sync += grant.eq(0)
+                    m.next = "BUS_GRANT"
+                with m.Elif(~self.wb.cyc | match | (br & (self.release != "transaction"))):
+                    m.next = "WAIT0"
+                with m.Elif(as_ready & self.wb.stb):
+                    start_beat(beat_adr)
             with m.State("STROBE0_W"):
-                m.d.comb += self.addr.eq(self.wb.adr << 1)
-                m.d.comb += self.rw_.eq(~self.wb.we)
+                early_grant(Mux(cur_sel[1] | cur_sel[0], self.release == "cycle", last_beat))
+                m.d.comb += self.addr.eq(beat_adr << 1)
+                m.d.comb += self.rw_.eq(~cur_we)
                 m.d.comb += self.as_.eq(0)
+                m.d.comb += self.o_data.eq(cur_dat_w[16:32])
                 m.next = "STROBE0"
             with m.State("STROBE0"):
-                m.d.comb += self.addr.eq(self.wb.adr << 1)
-                m.d.comb += self.rw_.eq(~self.wb.we)
-                m.d.comb += self.uds_.eq(~self.wb.sel[3])
-                m.d.comb += self.lds_.eq(~self.wb.sel[2])
+                early_grant(Mux(cur_sel[1] | cur_sel[0], self.release == "cycle", last_beat))
+                m.d.comb += self.addr.eq(beat_adr << 1)
+                m.d.comb += self.rw_.eq(~cur_we)
+                m.d.comb += self.uds_.eq(~cur_sel[3])
+                m.d.comb += self.lds_.eq(~cur_sel[2])
                 m.d.comb += self.as_.eq(0)
-                m.d.comb += self.o_data.eq(self.wb.dat_w[16:32])
+                m.d.comb += self.o_data.eq(cur_dat_w[16:32])
+                m.d.comb += data_high.eq(self.i_data)
                 with m.If(~self.dtack_):
                     m.d.sync += i_data_high.eq(self.i_data)
-                    with m.If(self.wb.sel[1] | self.wb.sel[0]):
+                    with m.If(cur_sel[1] | cur_sel[0]):
+                        m.d.sync += as_wait.eq(self.as_high_clocks - 1)
                         m.next = "ADDR1"
                     with m.Else():
-                        m.next = "DTACK1"
+                        end_beat()
             with m.State("ADDR1"):
-                with m.If(self.wb.we):
+                # second half address goes out while as is negated
+                m.d.comb += self.addr.eq((beat_adr << 1) + 1)
+                with m.If(grant | ((self.release == "cycle") & br & quiet)):
+                    m.d.comb += self.bus_assert.eq(0)
+                    m.d.sync += grant.eq(0)
+                    m.d.sync += resume.eq(1)
+                    m.next = "BUS_GRANT"
+                with m.Elif(as_ready & cur_we):
                     m.next = "STROBE1_W"
-                with m.Else():
+                with m.Elif(as_ready):
                     m.next = "STROBE1"
             with m.State("STROBE1_W"):
-                m.d.comb += self.addr.eq((self.wb.adr << 1) + 1)
-                m.d.comb += self.rw_.eq(~self.wb.we)
+                early_grant(last_beat)
+                m.d.comb += self.addr.eq((beat_adr << 1) + 1)
+                m.d.comb += self.rw_.eq(~cur_we)
                 m.d.comb += self.as_.eq(0)
+                m.d.comb += self.o_data.eq(cur_dat_w[0:16])
                 m.next = "STROBE1"
             with m.State("STROBE1"):
-                m.d.comb += self.addr.eq((self.wb.adr << 1) + 1)
-                m.d.comb += self.rw_.eq(~self.wb.we)
-                m.d.comb += self.uds_.eq(~self.wb.sel[1])
-                m.d.comb += self.lds_.eq(~self.wb.sel[0])
+                early_grant(last_beat)
+                m.d.comb += self.addr.eq((beat_adr << 1) + 1)
+                m.d.comb += self.rw_.eq(~cur_we)
+                m.d.comb += self.uds_.eq(~cur_sel[1])
+                m.d.comb += self.lds_.eq(~cur_sel[0])
                 m.d.comb += self.as_.eq(0)
-                m.d.comb += self.o_data.eq(self.wb.dat_w[0:16])
+                m.d.comb += self.o_data.eq(cur_dat_w[0:16])
                 with m.If(~self.dtack_):
-                    m.next = "DTACK1"
-            with m.State("DTACK1"):
-                m.d.comb += self.addr.eq((self.wb.adr << 1) + 1)
-                m.d.comb += self.wb.ack.eq(1)
-                m.next = "WAIT0"
+                    end_beat()
+                with m.Elif((~self.vpa_ | iack_expired) & (cur_fc == 0x7)):
+                    m.d.comb += self.wb.rty.eq(1)
+                    m.d.sync += as_wait.eq(self.as_high_clocks - 1)
+                    m.next = "WAIT0"
             with m.State("BUS_GRANT"):
                 m.d.comb += self.bg_.eq(0)
                 m.d.comb += self.bus_assert.eq(0)
                 m.next = "BUS_GRANT"
-                with m.If(self.br_ == 1):
-                    m.next = "WAIT0"
                 with m.If(self.bgack_ == 0):
                     m.next = "BUS_GRANT_ACK"
+                with m.Elif(self.br_ == 1):
+                    end_grant()
             with m.State("BUS_GRANT_ACK"):
                 m.d.comb += self.bus_assert.eq(0)
                 m.next = "BUS_GRANT_ACK"
                 with m.If(self.bgack_ == 1):
-                    m.next = "WAIT0"
+                    end_grant()
+
+        # no vpa pin, autovector an iack without dtack
+        if self.iack_timeout is not None:
+            iack_wait = Signal(range(self.iack_timeout + 1))
+            with m.If(fsm.ongoing("STROBE1") & (cur_fc == 0x7)):
+                with m.If(iack_wait != self.iack_timeout):
+                    m.d.sync += iack_wait.eq(iack_wait + 1)
+            with m.Else():
+                m.d.sync += iack_wait.eq(0)
+            m.d.comb += iack_expired.eq(iack_wait == self.iack_timeout)
+
+        # writes are taken into the buffer whenever the fsm is not running a
+        # cycle for the cpu. a write to the same longword as the newest entry
+        # is merged into it, unless that entry is already on the bus. while br
+        # is asserted the buffer is only drained, so the grant is not held
+        # off by new writes.
+        cpu_cycle = Signal()
+        granted = Signal()
+        coalesce = Signal()
+        m.d.comb += granted.eq(fsm.ongoing("BUS_GRANT") | fsm.ongoing("BUS_GRANT_ACK"))
+        m.d.comb += self.granted.eq(granted)
+
+        # write cycles of the other master, for copies of host memory
+        i_as_q = Signal(reset = 1)
+        m.d.sync += i_as_q.eq(self.i_as_)
+        m.d.comb += self.snoop.eq(granted & ~self.i_as_ & i_as_q & ~self.i_rw_)
+        m.d.comb += self.snoop_adr.eq(self.i_addr[1:])
+        m.d.comb += cpu_cycle.eq(~draining & ~fsm.ongoing("WAIT0") & ~(granted & ~resume))
+        m.d.comb += coalesce.eq(wq_valid[tail] & (wq_adr[tail] == self.wb.adr) &
+                                (wq_fc[tail] == self.wb_fc) &
+                                ((count > 1) | ~(draining | drain_start)))
+        with m.If(request & ~cpu_cycle & postable & (~br | granted)):
+            with m.If(coalesce):
+                m.d.comb += self.wb.ack.eq(1)
+                m.d.sync += wq_sel[tail].eq(wq_sel[tail] | self.wb.sel)
+                for b in range(4):
+                    with m.If(self.wb.sel[b]):
+                        m.d.sync += wq_dat[tail][b*8:b*8+8].eq(self.wb.dat_w[b*8:b*8+8])
+            with m.Elif(count != depth):
+                m.d.comb += self.wb.ack.eq(1)
+                m.d.comb += push.eq(1)
+        with m.If(request & ~cpu_cycle & forward):
+            m.d.comb += self.wb.ack.eq(1)
+            m.d.comb += self.wb.dat_r.eq(wq_dat[tail])
+
+        with m.If(push):
+            m.d.sync += [
+                wq_valid[wr].eq(1),
+                wq_adr[wr].eq(self.wb.adr),
+                wq_sel[wr].eq(self.wb.sel),
+                wq_dat[wr].eq(self.wb.dat_w),
+                wq_fc[wr].eq(self.wb_fc),
+                wr.eq(Mux(wr == depth - 1, 0, wr + 1)),
+            ]
+        with m.If(pop):
+            m.d.sync += [
+                wq_valid[rd].eq(0),
+                rd.eq(Mux(rd == depth - 1, 0, rd + 1)),
+            ]
+        m.d.sync += count.eq(count + push - pop)
+
+        latency = Signal(3)
+        strobe = fsm.ongoing("STROBE0") | fsm.ongoing("STROBE1")
+        events = [
+            1,
+            beat_done & ~cur_we,
+            beat_done & cur_we,
+            beat_done & (cur_sel == 0xf),
+            beat_done & Cat(cur_sel == (1 << b) for b in range(4)).any(),
+            fsm.ongoing("STROBE0") & self.dtack_,
+            fsm.ongoing("STROBE1") & self.dtack_,
+            fsm.ongoing("BUS_GRANT"),
+            fsm.ongoing("BUS_GRANT_ACK"),
+        ]
+        events += [strobe & ~self.dtack_ & (latency == i) for i in range(8)]
+        bg_q = Signal(reset = 1)
+        m.d.sync += bg_q.eq(self.bg_)
+        events += [
+            ~self.bg_ & bg_q,
+            br & self.bg_,
+            request & ~self.wb.ack & (~self.bg_ | fsm.ongoing("BUS_GRANT_ACK")),
+        ]
+        with m.If(strobe & self.dtack_):
+            with m.If(latency != 7):
+                m.d.sync += latency.eq(latency + 1)
+        with m.Else():
+            m.d.sync += latency.eq(0)
+        # every counter but the last, grant_holdoff_max, counts an event
+        for (name, snapshot), event in zip(self.perf, events):
+            counter = self.perf_live[name]
+            with m.If(self.perf_clear):
+                m.d.sync += counter.eq(0)
+            with m.Elif(event):
+                m.d.sync += counter.eq(counter + 1)
+            with m.If(self.perf_snapshot):
+                m.d.sync += snapshot.eq(counter)
+        # the longest wait from br to bg
+        holdoff = Signal(32)
+        holdoff_max = self.perf_live["grant_holdoff_max"]
+        with m.If(br & self.bg_):
+            m.d.sync += holdoff.eq(holdoff + 1)
+        with m.Else():
+            m.d.sync += holdoff.eq(0)
+        with m.If(self.perf_clear):
+            m.d.sync += holdoff_max.eq(0)
+        with m.Elif(br & ~self.bg_ & bg_q & (holdoff > holdoff_max)):
+            m.d.sync += holdoff_max.eq(holdoff)
+        with m.If(self.perf_snapshot):
+            m.d.sync += self.perf[-1][1].eq(holdoff_max)
 
         return m
 
@@ -132,13 +471,14 @@ class Test(unittest.TestCase):
                 self.assertEqual((yield dut.as_), 0)
                 yield dut.i_data.eq((yield dut.addr))
                 yield dut.dtack_.eq(0)
-                yield Tick()
                 yield Delay(1e-9)
                 while (yield wb.ack) == 0:
                     yield Tick()
                     yield Delay(1e-9)
+                yield Tick()
                 yield wb.cyc.eq(0)
                 yield wb.stb.eq(0)
+                yield Delay(1e-9)
                 self.assertEqual((yield dut.as_), 1)
                 self.assertEqual((yield dut.lds_), 1)
                 self.assertEqual((yield dut.uds_), 1)
@@ -172,6 +512,7 @@ class Test(unittest.TestCase):
                 yield Tick()
                 yield Delay(1e-9)
             yield Tick()
+            yield Delay(1e-9)
 
             # test interrupt
             yield wb.adr.eq(0xfffffff9) # 32 bit level lower 3 bits
@@ -204,6 +545,535 @@ class Test(unittest.TestCase):
         with sim.write_vcd(vcd_file=open("wb_to_68k.vcd", "w")):
             sim.run()
 
+    def test_vpa(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        dut = WishboneTo68000(wb, wb_fc, Signal(3))
+
+        def sim_test():
+            yield wb.adr.eq(0x3ffffffd)
+            yield wb_fc.eq(0x7)
+            yield wb.sel.eq(0xf)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            while ((yield dut.lds_) & (yield dut.uds_)) != 0:
+                yield Tick()
+                yield Delay(1e-9)
+            yield dut.vpa_.eq(0)
+            yield Delay(1e-9)
+            self.assertEqual((yield wb.rty), 1)
+            self.assertEqual((yield wb.ack), 0)
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            yield dut.vpa_.eq(1)
+            yield Delay(1e-9)
+            self.assertEqual((yield dut.as_), 1)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_iack_timeout(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        dut = WishboneTo68000(wb, wb_fc, Signal(3), iack_timeout=8)
+
+        def sim_test():
+            # nothing answers, the cycle is autovectored after the timeout
+            yield wb.adr.eq(0x3ffffffb)
+            yield wb_fc.eq(0x7)
+            yield wb.sel.eq(0xf)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            clocks = 0
+            while (yield wb.rty) == 0:
+                self.assertEqual((yield wb.ack), 0)
+                yield Tick()
+                yield Delay(1e-9)
+                clocks += 1
+            self.assertGreaterEqual(clocks, 8)
+            self.assertLess(clocks, 12)
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            yield Delay(1e-9)
+            self.assertEqual((yield dut.as_), 1)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_cycles(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        wb_ipl = Signal(3)
+        dut = WishboneTo68000(wb, wb_fc, wb_ipl, write_depth=0)
+
+        # clocks from cyc & stb to ack with zero wait states, unbuffered
+        # (we, sel, clocks before pipelining, clocks now)
+        accesses = [
+            (0, 0x1, 4, 2), # byte read
+            (0, 0x3, 4, 2), # word read, low address
+            (0, 0xc, 4, 2), # word read, high address
+            (0, 0xf, 6, 4), # longword read
+            (1, 0x1, 5, 3), # byte write
+            (1, 0xc, 5, 3), # word write
+            (1, 0xf, 8, 6), # longword write
+        ]
+
+        def sim_test():
+            yield dut.dtack_.eq(0)
+            yield dut.i_data.eq(0x1234)
+            for we, sel, before, after in accesses:
+                yield wb.adr.eq(0x100)
+                yield wb.we.eq(we)
+                yield wb.sel.eq(sel)
+                yield wb.cyc.eq(1)
+                yield wb.stb.eq(1)
+                yield Delay(1e-9)
+                clocks = 1
+                while (yield wb.ack) == 0:
+                    yield Tick()
+                    yield Delay(1e-9)
+                    clocks += 1
+                self.assertEqual(clocks, after)
+                if not we:
+                    self.assertEqual((yield wb.dat_r) & 0xffff, 0x1234)
+                    if sel & 0xc:
+                        self.assertEqual((yield wb.dat_r) >> 16, 0x1234)
+                # the next request starts in the cycle after ack
+                yield Tick()
+                yield wb.cyc.eq(0)
+                yield wb.stb.eq(0)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_burst(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        wb_ipl = Signal(3)
+        dut = WishboneTo68000(wb, wb_fc, wb_ipl, release="transaction")
+        bus_addrs = []
+
+        def bus():
+            yield Passive()
+            while True:
+                yield Delay(1e-9)
+                if ((yield dut.uds_) & (yield dut.lds_)) == 0:
+                    bus_addrs.append((yield dut.addr))
+                yield Tick()
+
+        def burst(adrs, bte, request_bus=False):
+            yield wb.bte.eq(bte)
+            yield wb.sel.eq(0xf)
+            yield wb.we.eq(0)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            clocks = 0
+            for i, adr in enumerate(adrs):
+                yield wb.adr.eq(adr)
+                if i == len(adrs) - 1:
+                    yield wb.cti.eq(wishbone.CycleType.END_OF_BURST)
+                else:
+                    yield wb.cti.eq(wishbone.CycleType.INCR_BURST)
+                yield Delay(1e-9)
+                clocks += 1
+                while (yield wb.ack) == 0:
+                    # the bus must not be granted in the middle of a burst
+                    self.assertEqual((yield dut.bg_), 1)
+                    yield Tick()
+                    yield Delay(1e-9)
+                    clocks += 1
+                if request_bus:
+                    yield dut.br_.eq(0)
+                yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            return clocks
+
+        def sim_test():
+            yield dut.dtack_.eq(0)
+            # one clock of address setup, then two 68000 cycles per beat with
+            # a single as negated clock between them and between beats
+            self.assertEqual((yield from burst([0x40, 0x41, 0x42, 0x43], 0, request_bus=True)), 16)
+            self.assertEqual(bus_addrs, [0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87])
+            # the grant waits for the end of the burst
+            yield Tick()
+            yield Delay(1e-9)
+            self.assertEqual((yield dut.bg_), 0)
+            yield dut.br_.eq(1)
+            yield Tick()
+            yield Tick()
+            del bus_addrs[:]
+            self.assertEqual((yield from burst([0x46, 0x47, 0x44, 0x45], wishbone.BurstTypeExt.WRAP_4)), 16)
+            self.assertEqual(bus_addrs, [0x8c, 0x8d, 0x8e, 0x8f, 0x88, 0x89, 0x8a, 0x8b])
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(bus)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_posted(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        wb_ipl = Signal(3)
+        dut = WishboneTo68000(wb, wb_fc, wb_ipl)
+        cycles = []
+
+        # one entry per 68000 cycle: (addr, rw_, uds_, lds_, o_data)
+        def bus():
+            yield Passive()
+            strobe = False
+            while True:
+                yield Delay(1e-9)
+                if ((yield dut.uds_) & (yield dut.lds_)) == 0:
+                    if not strobe:
+                        cycles.append(((yield dut.addr), (yield dut.rw_), (yield dut.uds_),
+                                       (yield dut.lds_), (yield dut.o_data)))
+                    strobe = True
+                else:
+                    strobe = False
+                yield Tick()
+
+        def access(adr, we=0, sel=0xf, dat=0, fc=5):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.sel.eq(sel)
+            yield wb.dat_w.eq(dat)
+            yield wb_fc.eq(fc)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            clocks = 1
+            while (yield wb.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+                clocks += 1
+            dat_r = yield wb.dat_r
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            return dat_r, clocks
+
+        def drain():
+            for i in range(40):
+                yield Tick()
+
+        def sim_test():
+            # hold off dtack, four writes are acked at once, the fifth waits
+            for i in range(4):
+                _, clocks = yield from access(0x100 + i, we=1, sel=0xc, dat=0x11110000 * (i + 1))
+                self.assertEqual(clocks, 1)
+            for i in range(10):
+                yield Tick()
+            self.assertEqual(len(cycles), 1)
+            yield dut.dtack_.eq(0)
+            _, clocks = yield from access(0x104, we=1, sel=0xc)
+            self.assertGreater(clocks, 1)
+            yield from drain()
+            self.assertEqual([c[0] for c in cycles], [0x200, 0x202, 0x204, 0x206, 0x208])
+            self.assertEqual(cycles[1], (0x202, 0, 0, 0, 0x2222))
+            del cycles[:]
+
+            # byte writes to the same word go out as one cycle
+            yield dut.dtack_.eq(1)
+            yield from access(0x180, we=1, sel=0x1, dat=0x12345678)
+            yield Tick()
+            yield from access(0x181, we=1, sel=0x2, dat=0x0000aa00)
+            yield from access(0x181, we=1, sel=0x1, dat=0x000000bb)
+            yield dut.dtack_.eq(0)
+            yield from drain()
+            self.assertEqual(cycles, [(0x301, 0, 1, 0, 0x5678), (0x303, 0, 0, 0, 0xaabb)])
+            del cycles[:]
+
+            # a read of buffered data is answered from the buffer
+            yield dut.dtack_.eq(1)
+            yield from access(0x200, we=1, dat=0xcafef00d)
+            dat_r, clocks = yield from access(0x200)
+            self.assertEqual((dat_r, clocks), (0xcafef00d, 1))
+            dat_r, clocks = yield from access(0x200, sel=0x3)
+            self.assertEqual((dat_r & 0xffff, clocks), (0xf00d, 1))
+            yield dut.dtack_.eq(0)
+            yield from drain()
+            self.assertEqual([c[0] for c in cycles], [0x400, 0x401])
+            del cycles[:]
+
+            # a write to an empty buffer goes straight out, reads elsewhere
+            # go ahead of the rest of the buffer, i/o waits for it
+            yield dut.dtack_.eq(1)
+            yield from access(0x280, we=1, sel=0x3)
+            yield from access(0x281, we=1, sel=0x3)
+            yield dut.dtack_.eq(0)
+            yield from access(0x300)
+            yield from access(0xe88000 >> 2, sel=0x3)
+            yield from drain()
+            self.assertEqual([c[:2] for c in cycles], [(0x501, 0), (0x600, 1), (0x601, 1), (0x503, 0),
+                                                        ((0xe88000 >> 1) + 1, 1)])
+            del cycles[:]
+            # i/o writes are not buffered
+            yield from access(0xe88000 >> 2, we=1, sel=0x3)
+            self.assertEqual([c[:2] for c in cycles], [((0xe88000 >> 1) + 1, 0)])
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(bus)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_grant(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        wb_fc = Signal(3)
+        wb_ipl = Signal(3)
+        dut = WishboneTo68000(wb, wb_fc, wb_ipl)
+        events = []
+        dma = []
+
+        # two clocks of wait states on every 68000 cycle
+        def bus():
+            yield Passive()
+            waited = 0
+            while True:
+                yield Tick()
+                yield Settle()
+                if ((yield dut.uds_) & (yield dut.lds_)) == 0:
+                    if waited == 0:
+                        events.append((yield dut.addr))
+                    waited += 1
+                    yield dut.dtack_.eq(waited <= 2)
+                else:
+                    waited = 0
+                    yield dut.dtack_.eq(1)
+
+        # another bus master, asks for the bus a number of clocks after it
+        # is put in dma and keeps it for four clocks
+        def master():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if not dma:
+                    continue
+                for i in range(dma.pop()):
+                    yield Tick()
+                yield dut.br_.eq(0)
+                yield Tick()
+                yield Settle()
+                while (yield dut.bg_) | ((yield dut.as_) == 0):
+                    yield Tick()
+                    yield Settle()
+                events.append("dma")
+                yield dut.bgack_.eq(0)
+                yield dut.br_.eq(1)
+                for i in range(4):
+                    yield Tick()
+                    yield Settle()
+                    self.assertEqual((yield dut.bus_assert), 0)
+                yield dut.bgack_.eq(1)
+
+        def access(adr, we=0, sel=0xf, dat=0):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.sel.eq(sel)
+            yield wb.dat_w.eq(dat)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            clocks = 1
+            while (yield wb.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+                clocks += 1
+            dat_r = yield wb.dat_r
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            return dat_r, clocks
+
+        def sim_test():
+            # bg goes out while the first half of a longword is on the bus,
+            # the bus is given away before the second half
+            dma.append(1)
+            yield from access(0x40)
+            self.assertEqual(events, [0x80, "dma", 0x81])
+            del events[:]
+            # queued writes go out before the grant, a write while br is
+            # asserted waits for the grant
+            yield from access(0x100, we=1, sel=0x3)
+            yield from access(0x101, we=1, sel=0x3)
+            dma.append(0)
+            yield Tick()
+            _, clocks = yield from access(0x102, we=1, sel=0x3)
+            self.assertGreater(clocks, 1)
+            for i in range(20):
+                yield Tick()
+            self.assertEqual(events, [0x201, 0x203, "dma", 0x205])
+            yield dut.perf_snapshot.eq(1)
+            yield Tick()
+            yield dut.perf_snapshot.eq(0)
+            yield Tick()
+            perf = {}
+            for name, snapshot in dut.perf:
+                perf[name] = yield snapshot
+            self.assertEqual(perf["grants"], 2)
+            self.assertGreater(perf["grant_holdoff"], 0)
+            self.assertGreater(perf["grant_stall"], 0)
+            self.assertGreater(perf["grant_holdoff_max"], 0)
+            self.assertLessEqual(perf["grant_holdoff_max"], perf["grant_holdoff"])
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(bus)
+        sim.add_sync_process(master)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_snoop(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneTo68000(wb, Signal(3), Signal(3))
+        snooped = []
+
+        def watch():
+            yield Passive()
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.snoop):
+                    snooped.append((yield dut.snoop_adr))
+
+        # one cycle of the other master
+        def cycle(addr, rw_):
+            yield dut.i_addr.eq(addr)
+            yield dut.i_rw_.eq(rw_)
+            yield dut.i_as_.eq(0)
+            for i in range(3):
+                yield Tick()
+            yield dut.i_as_.eq(1)
+            yield dut.i_rw_.eq(1)
+            yield Tick()
+
+        def sim_test():
+            # nothing is snooped while the bridge has the bus
+            yield from cycle(0x1001, 0)
+            self.assertEqual(snooped, [])
+            yield dut.br_.eq(0)
+            yield Settle()
+            while (yield dut.granted) == 0:
+                yield Tick()
+                yield Settle()
+            yield dut.bgack_.eq(0)
+            yield dut.br_.eq(1)
+            yield Tick()
+            yield from cycle(0x1001, 0)
+            yield from cycle(0x2000, 1)
+            yield from cycle(0x2003, 0)
+            self.assertEqual(snooped, [0x800, 0x1001])
+            yield dut.bgack_.eq(1)
+            for i in range(2):
+                yield Tick()
+            yield Settle()
+            self.assertEqual((yield dut.granted), 0)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(watch)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
+    def test_dtack_sync(self):
+        wb = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dut = WishboneTo68000(wb, Signal(3), Signal(3), dtack_sync=True)
+        host_dtack_ = Signal(reset = 1)
+        m = Module()
+        m.submodules.dut = dut
+        # as in anubis.System
+        m.submodules.dtack_sync = FFSynchronizer(host_dtack_, dut.dtack_, reset=1)
+        mem = {}
+        cycles = []
+
+        # a memory with one clock of wait states, dtack is negated as soon
+        # as as is. read data only comes a clock after dtack, the data bus is
+        # junk otherwise.
+        def host():
+            yield Passive()
+            waited = 0
+            while True:
+                yield Tick()
+                yield Settle()
+                if (yield dut.as_) == 0 and ((yield dut.uds_) & (yield dut.lds_)) == 0:
+                    waited += 1
+                    if waited == 2:
+                        addr = yield dut.addr
+                        cycles.append((addr, (yield dut.rw_)))
+                        word = mem.get(addr, 0)
+                        if not (yield dut.rw_):
+                            o_data = yield dut.o_data
+                            if (yield dut.uds_) == 0:
+                                word = (word & 0x00ff) | (o_data & 0xff00)
+                            if (yield dut.lds_) == 0:
+                                word = (word & 0xff00) | (o_data & 0x00ff)
+                            mem[addr] = word
+                        yield host_dtack_.eq(0)
+                    elif waited == 3 and (yield dut.rw_):
+                        yield dut.i_data.eq(mem.get((yield dut.addr), 0))
+                else:
+                    waited = 0
+                    yield host_dtack_.eq(1)
+                    yield dut.i_data.eq(0xdead)
+
+        def access(adr, we=0, sel=0xf, dat=0):
+            yield wb.adr.eq(adr)
+            yield wb.we.eq(we)
+            yield wb.sel.eq(sel)
+            yield wb.dat_w.eq(dat)
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield Delay(1e-9)
+            while (yield wb.ack) == 0:
+                yield Tick()
+                yield Delay(1e-9)
+            dat_r = yield wb.dat_r
+            yield Tick()
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            return dat_r
+
+        def sim_test():
+            for i in range(4):
+                yield from access(0x100 + i, we=1, dat=0x11223344 * (i + 1) & 0xffffffff)
+            yield from access(0x101, we=1, sel=0x2, dat=0x00ab0000 >> 8)
+            for i in range(4):
+                dat_r = yield from access(0x100 + i)
+                expected = 0x11223344 * (i + 1) & 0xffffffff
+                if i == 1:
+                    expected = (expected & 0xffff00ff) | 0xab00
+                self.assertEqual(dat_r, expected)
+            # every strobe got its own dtack, reads may pass queued writes
+            self.assertEqual([addr for addr, rw_ in cycles if not rw_], list(range(0x200, 0x208)) + [0x203])
+            self.assertEqual([addr for addr, rw_ in cycles if rw_], list(range(0x200, 0x208)))
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(host)
+        sim.add_sync_process(sim_test)
+        sim.run()
+
 if __name__ == "__main__":
     test = Test()
     test.test_simple()
+    test.test_vpa()
+    test.test_iack_timeout()
+    test.test_cycles()
+    test.test_burst()
+    test.test_posted()
+    test.test_grant()
+    test.test_snoop()
+    test.test_dtack_sync()
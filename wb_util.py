@@ -0,0 +1,83 @@
+import unittest
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+
+
+# passes the wishbone master on src straight through to dst: the request
+# goes out, data and the cycle end come back. with src_fc and dst_fc the
+# 68000 function code goes along with it. fields missing on either side are
+# left alone, and anything assigned after this in the same domain wins, so
+# a caller can still change sel or hold back the ack.
+def connect_wishbone(m, src, dst, src_fc=None, dst_fc=None):
+    m.d.comb += [
+        dst.adr.eq(src.adr),
+        dst.dat_w.eq(src.dat_w),
+        dst.sel.eq(src.sel),
+        dst.cyc.eq(src.cyc),
+        dst.stb.eq(src.stb),
+        dst.we.eq(src.we),
+        src.dat_r.eq(dst.dat_r),
+        src.ack.eq(dst.ack),
+    ]
+    for name in ("cti", "bte", "lock"):
+        if hasattr(src, name) and hasattr(dst, name):
+            m.d.comb += getattr(dst, name).eq(getattr(src, name))
+    for name in ("err", "rty"):
+        if hasattr(src, name) and hasattr(dst, name):
+            m.d.comb += getattr(src, name).eq(getattr(dst, name))
+    if src_fc is not None and dst_fc is not None:
+        m.d.comb += dst_fc.eq(src_fc)
+
+class Test(unittest.TestCase):
+    def test_connect(self):
+        src = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        dst = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8, features = ["err", "rty", "cti", "bte", "lock"])
+        plain = wishbone.Interface(addr_width = 30, data_width = 32, granularity = 8)
+        src_fc = Signal(3)
+        dst_fc = Signal(3)
+        m = Module()
+        with m.If(src.adr[29]):
+            connect_wishbone(m, src, plain)
+        with m.Else():
+            connect_wishbone(m, src, dst, src_fc, dst_fc)
+            m.d.comb += dst.sel.eq(0xf)
+
+        def values(*signals):
+            result = []
+            for s in signals:
+                result.append((yield s))
+            return result
+
+        def sim_test():
+            yield src.adr.eq(0x123)
+            yield src.dat_w.eq(0xdeadbeef)
+            yield src.sel.eq(0x3)
+            yield src.cyc.eq(1)
+            yield src.stb.eq(1)
+            yield src.we.eq(1)
+            yield src.cti.eq(wishbone.CycleType.INCR_BURST)
+            yield src.lock.eq(1)
+            yield src_fc.eq(5)
+            yield dst.dat_r.eq(0x12345678)
+            yield dst.rty.eq(1)
+            yield Settle()
+            self.assertEqual((yield from values(dst.adr, dst.dat_w, dst.sel, dst.cyc, dst.stb, dst.we,
+                                                dst.cti, dst.lock, dst_fc)),
+                             [0x123, 0xdeadbeef, 0xf, 1, 1, 1, wishbone.CycleType.INCR_BURST.value, 1, 5])
+            self.assertEqual((yield from values(src.dat_r, src.ack, src.err, src.rty)),
+                             [0x12345678, 0, 0, 1])
+            self.assertEqual((yield plain.cyc), 0)
+            # no err or rty on the other side
+            yield src.adr.eq(1 << 29)
+            yield plain.ack.eq(1)
+            yield Settle()
+            self.assertEqual((yield from values(plain.cyc, plain.sel, src.ack, src.rty, dst.cyc)),
+                             [1, 0x3, 1, 0, 0])
+
+        sim = Simulator(m)
+        sim.add_process(sim_test)
+        sim.run()
+
+if __name__ == "__main__":
+    unittest.main()